@@ -1,8 +1,28 @@
 from make_some_noise import *
+from make_some_noise import _column_samples, _iter_song, _peak, _plan_jobs, \
+    _process_song, _segment_track, _song_digest
 import helpers as helper
 import numpy as np
+import render_cache
+import tracing
+from playback import PlaybackEngine, render_ahead
+import asyncio
+import contextlib
+import io
+import json
+import os
 import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import wave
+
+# Sounds are played on a dummy audio device, so that the tests run on
+# machines without one. pygame opens the mixer lazily, so this is in time.
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
 
 
 def count_wave(temp):
@@ -112,6 +132,54 @@ class test_complexwave(unittest.TestCase):
         temp1.__add__(temp1)
         np.testing.assert_allclose(temp1, self.complex2.play())
 
+    def test_play_batched(self):
+        waves = [SimpleWave(200, 0.5, 0.5), SimpleWave(300, 1, 1), Rest(0.3),
+                 SimpleWave(450, 1, 0.2), SimpleWave(0, 1, 1)]
+        exp = np.zeros(helper._SAMPLE_RATE)
+        for wave in waves:
+            array = wave.play()
+            exp[:len(array)] += array
+        exp = exp * (1 / np.absolute(exp).max())
+        np.testing.assert_array_equal(exp, ComplexWave(waves).play())
+
+    def test_simplify(self):
+        wave = self.complex4 + SimpleWave(100, 1, 0) + SimpleWave(0, 1, 1)
+        wave.simplify()
+        self.assertEqual(2, wave.complexity())
+        self.assertEqual([(200, 1, 1.0), (300, 1, 2)],
+                         [(w._frequency, w.get_duration(), w._get_amplitude())
+                          for w in wave.get_waves()])
+        self.assertEqual(1, wave._get_amplitude())
+        self.assertEqual(1, wave.get_duration())
+
+    def test_simplify_play(self):
+        for wave in [self.complex2, self.complex4,
+                     SquareWave(262, 1, 1) + SquareWave(393, 1, 1),
+                     ComplexWave([SimpleWave(30000, 1, 1),
+                                  SimpleWave(300, 0.5, 1)])]:
+            exp = np.zeros(wave._num_samples())
+            for w in wave.get_waves():
+                if abs(round(w._frequency)) < helper._SAMPLE_RATE / 2:
+                    array = w.play()
+                    exp[:len(array)] += array
+            exp *= wave._get_amplitude() / np.abs(exp).max()
+            wave.simplify()
+            np.testing.assert_allclose(exp, wave.play(), atol=1e-12)
+
+    def test_simplify_gaffophone(self):
+        wave = SquareWave(262, 1, 1) + SquareWave(393, 1, 1)
+        wave.simplify()
+        self.assertEqual(17, wave.complexity())
+
+    def test_simplify_keeps_duration(self):
+        wave = ComplexWave([SimpleWave(300, 0.5, 1), SimpleWave(0, 2, 1),
+                            SimpleWave(25000, 3, 1)])
+        wave.simplify()
+        self.assertEqual(2, wave.complexity())
+        self.assertEqual(3 * helper._SAMPLE_RATE, len(wave.play()))
+        self.rest.simplify()
+        self.assertEqual(1, self.rest.complexity())
+        self.assertEqual(10 * helper._SAMPLE_RATE, len(self.rest.play()))
 
 
 class test_Note(unittest.TestCase):
@@ -179,6 +247,16 @@ class test_Note(unittest.TestCase):
         self.assertTrue(max(temp) <= 1 and max(new_temp) <= 1)
         self.assertTrue(min(temp) >= -1 and min(temp) >= -1)
 
+    def test_play_out(self):
+        exp = self.note2.play()
+        out = np.full(len(exp) + 5, 7.0)
+        res = self.note2.play(out[:len(exp)])
+        self.assertTrue(np.shares_memory(res, out))
+        np.testing.assert_array_equal(exp, out[:len(exp)])
+        self.assertTrue(np.all(out[len(exp):] == 7.0))
+        stu = StutterNote(440, 1.01, 0.8)
+        self.assertEqual(len(stu.play()), stu._num_samples())
+
 
 class test_square(unittest.TestCase):
     def setUp(self):
@@ -407,5 +485,1368 @@ class test_gaffophone(unittest.TestCase):
 
 
 
+class test_render_song(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'song.wav')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read_frames(self):
+        with wave.open(self.path, 'rb') as w:
+            self.assertEqual(1, w.getnchannels())
+            self.assertEqual(2, w.getsampwidth())
+            self.assertEqual(helper._SAMPLE_RATE, w.getframerate())
+            return np.frombuffer(w.readframes(w.getnframes()), dtype=np.int16)
+
+    def test_render(self):
+        render_song('base_songs/line_2_d_equal_1.csv', 1.0, self.path)
+        frames = self.read_frames()
+        self.assertEqual(helper._SAMPLE_RATE, len(frames))
+        b, h, g = Baliset(), Holophonor(), Gaffophone()
+        b.next_notes([("5:4", 1.0, 0.6), ("5:4", 1.0, 0.4)])
+        h.next_notes([("3:2", 0.5, 0.4), ("3:2", 0.5, 0.6)])
+        g.next_notes([("3:2", 0.5, 0.3), ("3:2", 0.5, 0.7)])
+        exp = np.zeros(helper._SAMPLE_RATE, dtype=np.int16)
+        for playable in [b, h, g]:
+            array = helper.make_int16_array(playable.play())
+            exp[:len(array)] += array
+        np.testing.assert_array_equal(exp, frames)
+
+    def test_render_oscillator(self):
+        render_song('swan_lake.csv', 0.2, self.path)
+        exp = self.read_frames()
+        render_song('swan_lake.csv', 0.2, self.path, helper.Wavetable(1e-6))
+        act = self.read_frames()
+        self.assertEqual(len(exp), len(act))
+        self.assertTrue(np.abs(exp.astype(int) - act).max() <= 1)
+
+    def test_render_long_notes(self):
+        render_song('base_songs/line_2_d_greater_1.csv', 1.0, self.path)
+        frames = self.read_frames()
+        self.assertEqual(7 * helper._SAMPLE_RATE, len(frames))
+        self.assertTrue(np.abs(frames).max() > 0)
+
+    def test_render_workers(self):
+        for song in ['spanish_violin.csv', 'base_songs/line_2_d_greater_1.csv']:
+            for oscillator in [None, helper.Wavetable(1e-6)]:
+                render_song(song, 0.5, self.path, oscillator)
+                exp = self.read_frames()
+                render_song(song, 0.5, self.path, oscillator, workers=2)
+                np.testing.assert_array_equal(exp, self.read_frames())
+
+    def test_render_workers_empty(self):
+        path = os.path.join(self.dir.name, 'empty.csv')
+        with open(path, 'w') as song:
+            song.write('Baliset,Holophonor,Gaffophone\n')
+        render_song(path, 1.0, self.path, workers=2)
+        self.assertEqual(0, len(self.read_frames()))
+
+
+class test_wavetable(unittest.TestCase):
+    def setUp(self):
+        self.table = helper.Wavetable(1e-6)
+
+    def test_accuracy(self):
+        for wave in [SimpleWave(440, 1, 1), SawtoothWave(98, 0.41, 0.5),
+                     StutterNote(130, 0.5, 1)]:
+            exp = wave.play()
+            with helper.use_oscillator(self.table):
+                act = wave.play()
+            self.assertEqual(len(exp), len(act))
+            np.testing.assert_allclose(exp, act, atol=1e-5)
+
+    def test_rest(self):
+        with helper.use_oscillator(self.table):
+            self.assertTrue(np.all(Rest(0.5).play() == 0))
+        self.assertTrue(helper._OSCILLATOR.get() is None)
+
+    def test_error_bound(self):
+        for error in [1e-3, 1e-8]:
+            table = helper.Wavetable(error)
+            with helper.use_oscillator(table):
+                act = helper.make_sine_wave_array(4000, 1)
+            exp = helper.make_sine_wave_array(4000, 1)
+            self.assertTrue(np.abs(exp - act).max() <= error)
+
+
+class test_wave_cache(unittest.TestCase):
+    def setUp(self):
+        import make_some_noise
+        self.cache = make_some_noise.WAVE_CACHE
+        self.max_bytes = self.cache.max_bytes
+        self.cache.clear()
+
+    def tearDown(self):
+        self.cache.max_bytes = self.max_bytes
+        self.cache.clear()
+
+    def test_hits(self):
+        exp = SawtoothWave(440, 0.5, 0.8).play()
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+        act = SawtoothWave(440, 0.5, 0.8).play()
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        self.assertTrue(act is exp)
+        self.assertFalse(act.flags.writeable)
+        SawtoothWave(440, 0.5, 0.7).play()
+        SquareWave(440, 0.5, 0.8).play()
+        self.assertEqual((1, 3), (self.cache.hits, self.cache.misses))
+
+    def test_same_result(self):
+        waves = [SimpleWave(440, 1, 0.5), SquareWave(131, 0.4, 1),
+                 StutterNote(65, 1, 0.5),
+                 SquareWave(262, 1, 1) + SquareWave(393, 1, 1)]
+        for wave in waves:
+            first = wave.play()
+            self.cache.clear()
+            out = np.empty(len(first))
+            wave.play(out)
+            np.testing.assert_array_equal(first, wave.play(out))
+            self.assertTrue(out.flags.writeable)
+        self.assertTrue(self.cache.hits > 0)
+
+    def test_stutter_amplitude(self):
+        stutter = StutterNote(100, 0.5, 0.5)
+        exp = stutter.play()
+        stutter.amplitude = 0.1
+        np.testing.assert_allclose(exp * 0.2, stutter.play())
+
+    def test_eviction(self):
+        self.cache.max_bytes = 3 * int(helper._SAMPLE_RATE * 0.5) * 8
+        for frequency in [100, 200, 300, 400]:
+            SawtoothWave(frequency, 0.5, 1).play()
+        self.assertEqual(1, self.cache.evictions)
+        self.assertEqual(3, len(self.cache))
+        self.assertTrue(self.cache.nbytes() <= self.cache.max_bytes)
+        SawtoothWave(100, 0.5, 1).play()
+        self.assertEqual(0, self.cache.hits)
+
+
+class test_disk_cache(unittest.TestCase):
+    def setUp(self):
+        import make_some_noise
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = make_some_noise.WAVE_CACHE
+        self.cache.clear()
+
+    def tearDown(self):
+        self.cache.disk = None
+        self.cache.clear()
+        self.dir.cleanup()
+
+    def test_put_get(self):
+        disk = render_cache.DiskCache(self.dir.name)
+        self.assertTrue(disk.get(('a', 1)) is None)
+        disk.put(('a', 1), np.arange(10.0))
+        array = disk.get(('a', 1))
+        self.assertTrue(isinstance(array, np.memmap))
+        self.assertFalse(array.flags.writeable)
+        np.testing.assert_array_equal(np.arange(10.0), array)
+        self.assertEqual((1, 1), (disk.hits, disk.misses))
+
+    def test_prune(self):
+        disk = render_cache.DiskCache(self.dir.name)
+        for i in range(3):
+            disk.put(('a', i), np.zeros(1000))
+            path = disk._path(('a', i))
+            os.utime(path, (i, i))
+        size = os.path.getsize(disk._path(('a', 0)))
+        self.assertEqual(1, disk.prune(2 * size))
+        self.assertTrue(disk.get(('a', 0)) is None)
+        self.assertTrue(disk.get(('a', 2)) is not None)
+        disk.max_bytes = 2 * size
+        disk.put(('a', 3), np.zeros(1000))
+        self.assertEqual(1, len(disk.entries()))
+        self.assertEqual(3, disk.evictions)
+
+    def test_prune_low_water(self):
+        disk = render_cache.DiskCache(self.dir.name)
+        disk.put(('a', 0), np.zeros(1000))
+        disk.put(('a', 0), np.zeros(1000))
+        self.assertEqual(disk.nbytes(), disk._nbytes)
+        disk.max_bytes = 10 * disk.nbytes()
+        for i in range(1, 11):
+            disk.put(('a', i), np.zeros(1000))
+        self.assertEqual(2, disk.evictions)
+        self.assertEqual(9, len(disk.entries()))
+        disk.put(('a', 11), np.zeros(1000))
+        self.assertEqual(2, disk.evictions)
+
+    def test_shared_between_processes(self):
+        self.cache.disk = render_cache.DiskCache(self.dir.name)
+        exp = SquareWave(131, 0.5, 1).play()
+        self.cache.clear()
+        self.cache.disk = render_cache.DiskCache(self.dir.name)
+        act = SquareWave(131, 0.5, 1).play()
+        self.assertEqual(1, self.cache.disk.hits)
+        np.testing.assert_array_equal(exp, act)
+
+    def test_command_line(self):
+        disk = render_cache.DiskCache(self.dir.name)
+        disk.put(('a', 1), np.zeros(1000))
+        disk.put(('a', 2), np.zeros(1000))
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            render_cache.main([self.dir.name, 'info'])
+            render_cache.main([self.dir.name, 'prune', '--max-bytes', '9K'])
+            render_cache.main([self.dir.name, 'clear'])
+        lines = out.getvalue().splitlines()
+        self.assertTrue('2 arrays' in lines[0])
+        self.assertTrue('removed 1 arrays' in lines[1])
+        self.assertEqual([], disk.entries())
+
+
+class test_iter_song(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.songs = ['song.csv', 'swan_lake.csv', 'spanish_violin.csv'] + [
+            os.path.join('base_songs', name)
+            for name in sorted(os.listdir('base_songs'))
+            if name.endswith('.csv')]
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_same_columns(self):
+        for song in self.songs:
+            for beat in [0.2, 0.5, 1.0, 1.5]:
+                max_len, first, v_lst = _process_song(song, beat)
+                exp = [[v_lst[i][c]._next_notes for i in range(len(first))]
+                       for c in range(max_len)]
+                act = [[p._next_notes for p in column]
+                       for column in _iter_song(song, beat)]
+                self.assertEqual(exp, act, song)
+
+    def test_lazy(self):
+        path = os.path.join(self.dir.name, 'broken.csv')
+        with open(path, 'w') as song:
+            song.write('Baliset,Holophonor\n1:1:1:1,rest:1\n')
+            song.write('not:a:note:at all,1:1:1:1\n')
+        columns = _iter_song(path, 1.0)
+        column = next(columns)
+        self.assertEqual([[('1:1', 1.0, 1.0)], [('1:1', 0.0, 1.0)]],
+                         [p._next_notes for p in column])
+        self.assertRaises(ValueError, next, columns)
+
+
+class test_segment_track(unittest.TestCase):
+    def setUp(self):
+        self.expected = {'line_1_d_equal_1.csv': [[[('5:4', 1.0, 1.0)]],
+                                  [[('3:2', 0.5, 1.0)]],
+                                  [[('3:2', 0.5, 1.0)]]],
+         'line_1_d_greater_1.csv': [[[('5:4', 1.0, 1.0)],
+                                     [('5:4', 1.0, 1.0)],
+                                     [('1:1', 0, 1)],
+                                     [('1:1', 0, 1)]],
+                                    [[('3:2', 0.5, 1.0)],
+                                     [('3:2', 0.5, 1.0)],
+                                     [('3:2', 0.5, 1.0)],
+                                     [('3:2', 0.5, 1.0)]],
+                                    [[('3:2', 0.5, 1.0)],
+                                     [('3:2', 0.5, 1.0)],
+                                     [('1:1', 0, 1)],
+                                     [('1:1', 0, 1)]]],
+         'line_1_d_less_1.csv': [[[('5:4', 1.0, 0.6), ('1:1', 0.0, 0.4)]],
+                                 [[('3:2', 0.5, 0.4), ('1:1', 0.0, 0.6)]],
+                                 [[('3:2', 0.5, 0.3), ('1:1', 0.0, 0.7)]]],
+         'line_2_d_equal_1.csv': [[[('5:4', 1.0, 0.6), ('5:4', 1.0, 0.4)]],
+                                  [[('3:2', 0.5, 0.4), ('3:2', 0.5, 0.6)]],
+                                  [[('3:2', 0.5, 0.3), ('3:2', 0.5, 0.7)]]],
+         'line_2_d_greater_1.csv': [[[('5:4', 1.0, 0.6), ('5:4', 1.0, 0.4)],
+                                     [('5:4', 1.0, 1.0)],
+                                     [('5:4', 1.0, 0.6), ('5:4', 1.0, 0.4)],
+                                     [('5:4', 1.0, 0.6), ('1:1', 0.0, 0.4)],
+                                     [('1:1', 0, 1)],
+                                     [('1:1', 0, 1)],
+                                     [('1:1', 0, 1)]],
+                                    [[('3:2', 0.5, 0.4), ('3:2', 0.5, 0.6)],
+                                     [('3:2', 0.5, 1.0)],
+                                     [('3:2', 0.5, 0.4), ('3:2', 0.5, 0.6)],
+                                     [('3:2', 0.5, 0.4), ('3:2', 0.5, 0.6)],
+                                     [('3:2', 0.5, 0.4), ('3:2', 0.5, 0.6)],
+                                     [('3:2', 0.5, 0.4), ('3:2', 0.5, 0.6)],
+                                     [('3:2', 0.5, 0.4), ('1:1', 0.0, 0.6)]],
+                                    [[('3:2', 0.5, 1.0)],
+                                     [('3:2', 0.5, 1.0)],
+                                     [('3:2', 0.5, 1.0)],
+                                     [('3:2', 0.5, 1.0)],
+                                     [('3:2', 0.5, 1.0)],
+                                     [('3:2', 0.5, 1.0)],
+                                     [('3:2', 0.5, 1.0)]]],
+         'line_2_d_less_1.csv': [[[('5:4', 1.0, 0.6), ('5:4', 1.0, 0.2)],
+                                  [('1:1', 0, 1)]],
+                                 [[('3:2', 0.5, 1.0)],
+                                  [('3:2', 0.5, 0.2), ('3:2', 0.5, 0.6)]],
+                                 [[('3:2', 0.5, 0.2), ('3:2', 0.5, 0.7)],
+                                  [('1:1', 0, 1)]]]}
+
+    def test_base_songs(self):
+        for name, expected in self.expected.items():
+            max_len, first, v_lst = _process_song(
+                os.path.join('base_songs', name), 1.0)
+            act = [[v_lst[i][c]._next_notes for c in range(max_len)]
+                   for i in range(len(first))]
+            self.assertEqual(expected, act, name)
+
+    def test_long_note(self):
+        bars = list(_segment_track([('1:1', 1, 3.5), ('2:1', 1, 0.5)]))
+        self.assertEqual([[('1:1', 1, 1.0)],
+                          [('1:1', 1, 0.5), ('1:1', 1, 0.5)],
+                          [('1:1', 1, 0.5), ('1:1', 1, 0.5)],
+                          [('1:1', 1, 0.5), ('2:1', 1, 0.5)]], bars)
+
+    def test_short_notes(self):
+        bars = list(_segment_track([('1:1', 1, 0.4), ('2:1', 1, 0.4),
+                                    ('3:1', 1, 0.4), ('4:1', 1, 0.1)]))
+        self.assertEqual([[('1:1', 1, 0.4), ('2:1', 1, 0.4), ('3:1', 1, 0.2)],
+                          [('3:1', 1, 0.2), ('4:1', 1, 0.1)]], bars)
+        bars = list(_segment_track([('1:1', 1, 0.25)]))
+        self.assertEqual([[('1:1', 1, 0.25), ('1:1', 0.0, 0.75)]], bars)
+        self.assertEqual([], list(_segment_track([])))
+
+    def test_lazy(self):
+        notes = iter([('1:1', 1, 0.5), ('2:1', 1, 0.5), ('3:1', 1, 1),
+                      ('4:1', 1, 1)])
+        bars = _segment_track(notes)
+        self.assertEqual([('1:1', 1, 0.5), ('2:1', 1, 0.5)], next(bars))
+        self.assertEqual([('3:1', 1, 1)], list(notes)[:1])
+
+
+class test_playback_engine(unittest.TestCase):
+    def setUp(self):
+        self.bars = [np.full(2205, i, dtype=np.int16) for i in range(3)]
+
+    def test_plays_every_bar(self):
+        engine = PlaybackEngine()
+        engine.play(self.bars, lambda bar: bar)
+        self.assertEqual(3, engine.bars_played)
+        self.assertEqual(0, engine.underruns)
+        self.assertEqual(3, helper.audio_backend().free_channels())
+
+    def test_underruns(self):
+        def slow(bar):
+            if bar[0]:
+                time.sleep(0.15)
+            return bar
+        engine = PlaybackEngine(lookahead=1)
+        engine.play(self.bars, slow)
+        self.assertEqual(3, engine.bars_played)
+        self.assertEqual(2, engine.underruns)
+
+    def test_render_error(self):
+        def broken(bar):
+            if bar[0] == 1:
+                raise ValueError('broken bar')
+            return bar
+        engine = PlaybackEngine()
+        self.assertRaises(ValueError, engine.play, self.bars, broken)
+        self.assertEqual(1, engine.bars_played)
+        self.assertEqual(3, helper.audio_backend().free_channels())
+
+    def test_context(self):
+        oscillators = []
+        def render(bar):
+            oscillators.append(helper._OSCILLATOR.get())
+            return bar
+        wavetable = Wavetable()
+        with use_oscillator(wavetable):
+            PlaybackEngine().play(self.bars, render)
+        self.assertEqual([wavetable] * 3, oscillators)
+
+    def test_lookahead(self):
+        self.assertRaises(ValueError, PlaybackEngine, 0)
+
+    def test_play_song(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bar.csv')
+            with open(path, 'w') as song:
+                song.write('Baliset,Holophonor,Gaffophone\n')
+                song.write('1:1:1:0.5,2:1:1:1,rest:1\n1:1:1:0.5,,\n')
+            engine = PlaybackEngine()
+            play_song(path, 1.0, engine)
+        self.assertEqual(1, engine.bars_played)
+
+
+class test_note_table(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'song.csv')
+        with open(self.path, 'w') as song:
+            song.write('Baliset,Gaffophone\n')
+            song.write('3:2:0.5:0.5,1:1:1:2\n2:1:1:1,\nrest:0.25,\n')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_from_song(self):
+        table = NoteTable.from_song(self.path, 1.0)
+        self.assertEqual(['baliset', 'gaffophone'], table.instruments)
+        self.assertEqual(2, table.num_bars())
+        self.assertEqual(6, len(table))
+        exp = [(0, 0, 0.0, 3, 2, 294, 0.5, 0.5),
+               (0, 0, 0.5, 2, 1, 392, 1.0, 0.5),
+               (1, 0, 0.0, 1, 1, 131, 1.0, 1.0),
+               (0, 1, 0.0, 2, 1, 392, 1.0, 0.5),
+               (0, 1, 0.5, 1, 1, 196, 0.0, 0.25),
+               (1, 1, 0.0, 1, 1, 131, 1.0, 1.0)]
+        self.assertEqual(exp, table.notes.tolist())
+        np.testing.assert_array_equal(
+            table.notes[table.notes['instrument'] == 1]['bar'], [0, 1])
+
+    def test_same_columns(self):
+        for song in [self.path, 'swan_lake.csv',
+                     'base_songs/line_2_d_greater_1.csv']:
+            for beat in [0.5, 1.0]:
+                table = NoteTable.from_song(song, beat)
+                columns = list(_iter_song(song, beat))
+                self.assertEqual(len(columns), table.num_bars())
+                for exp, act in zip(columns, table.columns()):
+                    for e, a in zip(exp, act):
+                        self.assertIs(type(e), type(a))
+                        np.testing.assert_array_equal(e.play(), a.play())
+
+    def test_select_bars(self):
+        table = NoteTable.from_song(self.path, 1.0)
+        part = table.select_bars(1, 3)
+        self.assertEqual(1, part.num_bars())
+        self.assertEqual([r[2:] for r in table.bar(1, 0).tolist()],
+                         [r[2:] for r in part.bar(0, 0).tolist()])
+        self.assertEqual(0, part.notes['bar'][0])
+
+    def test_bar_samples(self):
+        with open(self.path, 'w') as song:
+            song.write('Holophonor,Baliset,Gaffophone\n')
+            song.write('1:1:1:0.33,rest:0.2,5:4:1:0.7\n,3:2:0.5:1.1,\n')
+        for song in [self.path, 'swan_lake.csv',
+                     'base_songs/line_2_d_greater_1.csv']:
+            for rate in [helper._SAMPLE_RATE, PREVIEW_RATE]:
+                with use_sample_rate(rate):
+                    table = NoteTable.from_song(song, 0.5)
+                    exp = [_column_samples(c) for c in table.columns()]
+                    self.assertEqual(exp, table.bar_samples().tolist())
+
+    def test_compact(self):
+        with open(self.path, 'w') as song:
+            song.write('Baliset,Holophonor,Gaffophone\n')
+            for _ in range(5000):
+                song.write('3:2:0.5:0.5,1:1:1:0.25,5:4:1:0.75\n')
+        table = NoteTable.from_song(self.path, 1.0)
+        self.assertTrue(table.nbytes() <= 64 * len(table))
+
+
+class test_tracing(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'song.wav')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_disabled(self):
+        self.assertIs(tracing.span('bar', bar=0), tracing.span('other'))
+        with tracing.span('bar', bar=0):
+            pass
+
+    def test_render_song(self):
+        WAVE_CACHE.clear()
+        with tracing.tracing() as tracer:
+            render_song('song.csv', 1.0, self.path)
+        totals = tracer.totals()
+        for name in ['read_csv', 'segment', 'playables', 'mix', 'instrument',
+                     'synthesize', 'normalize', 'int16', 'write']:
+            self.assertIn(name, totals)
+        self.assertEqual(len(list(_iter_song('song.csv', 1.0))),
+                         totals['mix'][0])
+        for count, total, own in totals.values():
+            self.assertTrue(0 <= own <= total)
+        self.assertIn('synthesize', tracer.summary())
+        with tracing.span('after'):
+            pass
+        self.assertNotIn('after', tracer.totals())
+
+    def test_chrome_trace(self):
+        with tracing.tracing() as tracer:
+            with tracing.span('outer', bar=1, wave=Wavetable()):
+                with tracing.span('inner'):
+                    pass
+        trace_path = os.path.join(self.dir.name, 'trace.json')
+        tracer.save_chrome_trace(trace_path)
+        with open(trace_path) as file:
+            events = json.load(file)['traceEvents']
+        self.assertEqual(['outer', 'inner'], [e['name'] for e in events])
+        self.assertEqual({'bar': 1, 'wave': 'Wavetable(max_error=1e-06)'},
+                         events[0]['args'])
+        self.assertTrue(all(e['ph'] == 'X' for e in events))
+        self.assertTrue(events[0]['dur'] >= events[1]['dur'])
+
+    def test_threads(self):
+        bars = [np.zeros(441, dtype=np.int16) for _ in range(2)]
+        with tracing.tracing() as tracer:
+            PlaybackEngine().play(bars, lambda bar: bar)
+        threads = {e[2] for e in tracer.events if e[0] == 'render'}
+        self.assertEqual(2, tracer.totals()['render'][0])
+        self.assertNotIn(threading.get_ident(), threads)
+
+
+class test_precision(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'song.wav')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read_frames(self):
+        with wave.open(self.path, 'rb') as w:
+            return np.frombuffer(w.readframes(w.getnframes()), dtype=np.int16)
+
+    def test_dtype(self):
+        holophonor = Holophonor()
+        holophonor.next_notes([('3:2', 1, 0.5), ('2:1', 0.5, 0.5)])
+        waves = [SimpleWave(440, 1, 1), SawtoothWave(440, 0.5, 1),
+                 Note([SimpleWave(440, 0.2, 1), Rest(0.3)]), holophonor]
+        for wave in waves:
+            self.assertEqual(np.float64, wave.play().dtype)
+            with helper.use_dtype(np.float32):
+                self.assertEqual(np.float32, wave.play().dtype)
+                with helper.use_oscillator(helper.Wavetable()):
+                    self.assertEqual(np.float32, wave.play().dtype)
+            self.assertEqual(np.float64, wave.play().dtype)
+
+    def test_int16_out(self):
+        array = SawtoothWave(440, 0.5, 1).play()
+        out = np.empty(len(array), dtype=np.int16)
+        self.assertIs(out, helper.make_int16_array(array, out))
+        np.testing.assert_array_equal(helper.make_int16_array(array), out)
+
+    def test_one_lsb(self):
+        for column in _iter_song('swan_lake.csv', 0.5):
+            for playable in column:
+                exp = helper.make_int16_array(playable.play()).astype(int)
+                with helper.use_dtype(np.float32):
+                    act = helper.make_int16_array(playable.play())
+                self.assertTrue(np.abs(exp - act).max() <= 1)
+
+    def test_render(self):
+        render_song('spanish_violin.csv', 0.5, self.path)
+        exp = self.read_frames().astype(int)
+        render_song('spanish_violin.csv', 0.5, self.path, dtype=np.float32)
+        act = self.read_frames()
+        self.assertEqual(len(exp), len(act))
+        # Each of the three instruments is within one step on its own
+        self.assertTrue(np.abs(exp - act).max() <= 3)
+        render_song('spanish_violin.csv', 0.5, self.path, workers=2,
+                    dtype=np.float32)
+        np.testing.assert_array_equal(act, self.read_frames())
+
+
+class test_lazy_waves(unittest.TestCase):
+    def setUp(self):
+        WAVE_CACHE.clear()
+
+    def built(self, wave):
+        wave.get_waves()
+        return wave
+
+    def test_lazy(self):
+        waves = [SawtoothWave(440, 1, 1), SquareWave(440, 1, 1),
+                 StutterNote(440, 1.01, 0.8)]
+        for wave in waves:
+            self.assertIsNone(wave._built)
+            wave.play()
+            self.assertIsNone(wave._built)
+            self.assertEqual(len(wave.play()), wave._num_samples())
+            self.assertEqual(10 if wave is not waves[2] else 41,
+                             len(wave.get_waves()))
+            self.assertIsNotNone(wave._built)
+
+    def test_complexity(self):
+        self.assertEqual(10, SawtoothWave(440, 1, 1).complexity())
+        square = SquareWave(440, 1, 1)
+        square.simplify()
+        self.assertEqual(10, square.complexity())
+
+    def test_same_waves(self):
+        for cls in [SawtoothWave, SquareWave]:
+            waves = cls(220, 0.5, 2).get_waves()
+            step = 2 if cls is SawtoothWave else 1
+            for m, simple in zip(range(1, 20, step), waves):
+                self.assertEqual(SimpleWave(220 * m, 0.5, 1 / m), simple)
+
+    def test_same_play(self):
+        for duration in [0, 0.02, 0.025, 0.05, 0.0501, 0.07, 0.333, 1.5]:
+            for amplitude in [0.3, 1, 1.7]:
+                lazy = StutterNote(440, duration, amplitude)
+                key, exp = lazy._cache_key(), lazy.play().copy()
+                WAVE_CACHE.clear()
+                built = self.built(StutterNote(440, duration, amplitude))
+                self.assertEqual(key, built._cache_key())
+                self.assertEqual(lazy.get_duration(), built.get_duration())
+                np.testing.assert_array_equal(exp, built.play())
+                WAVE_CACHE.clear()
+        for cls in [SawtoothWave, SquareWave]:
+            exp = cls(440, 0.7, 1.3).play().copy()
+            WAVE_CACHE.clear()
+            np.testing.assert_array_equal(
+                exp, self.built(cls(440, 0.7, 1.3)).play())
+
+    def test_cache_key(self):
+        self.assertEqual(('SawtoothWave', 440, 1, 1),
+                         SawtoothWave(440, 1, 2)._cache_key())
+        self.assertEqual(('SquareWave', 440, 1, 0.5),
+                         SquareWave(440, 1, 0.5)._cache_key())
+        self.assertEqual(('StutterNote', 440, 0, 1, 0),
+                         StutterNote(440, 0, 1)._cache_key())
+
+    def test_edited_waves(self):
+        saw = SawtoothWave(440, 1, 1)
+        saw.get_waves().pop()
+        self.assertEqual(9, saw.complexity())
+        exp = ComplexWave(saw.get_waves())
+        exp._amplitude = 1
+        np.testing.assert_array_equal(exp.play(), saw.play())
+
+
+class test_incremental(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.song = os.path.join(self.dir.name, 'song.csv')
+        self.out = os.path.join(self.dir.name, 'out.wav')
+        self.exp = os.path.join(self.dir.name, 'exp.wav')
+        self.rows = ['1:1:1:1, 3:2:0.5:1, 2:1:1:1'] * 3 + \
+            ['5:4:1:1, rest:1, 3:2:0.7:1'] * 3
+        self.write()
+        self.renderer = IncrementalRenderer(self.song, 1.0, self.out)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, header='Baliset,Holophonor,Gaffophone'):
+        with open(self.song, 'w') as song:
+            song.write('\n'.join([header] + self.rows) + '\n')
+
+    def assert_rendered(self):
+        render_song(self.song, 1.0, self.exp)
+        with open(self.exp, 'rb') as exp, open(self.out, 'rb') as act:
+            self.assertEqual(exp.read(), act.read())
+
+    def test_first_render(self):
+        self.assertEqual(6, self.renderer.render())
+        self.assertFalse(self.renderer.in_place)
+        self.assert_rendered()
+
+    def test_unchanged(self):
+        self.renderer.render()
+        self.assertEqual(0, self.renderer.render())
+        self.assertEqual(6, self.renderer.bars_reused)
+        self.assertTrue(self.renderer.in_place)
+        self.assert_rendered()
+
+    def test_edit_one_cell(self):
+        self.renderer.render()
+        self.rows[4] = '5:4:0.3:1, rest:1, 3:2:0.7:1'
+        self.write()
+        self.assertEqual(1, self.renderer.render())
+        self.assertTrue(self.renderer.in_place)
+        self.assert_rendered()
+
+    def test_moved_bars(self):
+        self.renderer.render()
+        self.rows = self.rows[3:] + self.rows[:3]
+        self.write()
+        self.assertEqual(0, self.renderer.render())
+        self.assertTrue(self.renderer.in_place)
+        self.assert_rendered()
+
+    def test_new_layout(self):
+        self.renderer.render()
+        self.rows[3] = '5:4:0.3:1, rest:1, 3:2:0.7:1'
+        del self.rows[0]
+        self.write()
+        self.assertEqual(1, self.renderer.render())
+        self.assertFalse(self.renderer.in_place)
+        self.assert_rendered()
+
+    def test_new_header(self):
+        self.renderer.render()
+        self.write('Gaffophone,Holophonor,Baliset')
+        self.assertEqual(6, self.renderer.render())
+        self.assert_rendered()
+
+    def test_out_path_changed(self):
+        self.renderer.render()
+        with open(self.out, 'wb') as out:
+            out.write(b'not a wave file')
+        self.assertEqual(6, self.renderer.render())
+        self.assert_rendered()
+
+    def test_unreadable_song(self):
+        self.renderer.render()
+        with open(self.out, 'rb') as out:
+            before = out.read()
+        self.rows[1] = '1:1:loud:1, 3:2:0.5:1, 2:1:1:1'
+        self.write()
+        self.assertRaises(ValueError, self.renderer.render)
+        with open(self.out, 'rb') as out:
+            self.assertEqual(before, out.read())
+
+    def test_watch(self):
+        stop, renders = threading.Event(), []
+
+        def on_render(renderer):
+            renders.append(renderer.bars_synthesized)
+            if len(renders) == 1:
+                self.rows[5] = 'rest:1, rest:1, rest:1'
+                self.write()
+                os.utime(self.song, ns=(0, 1))
+            else:
+                stop.set()
+
+        watch_song(self.song, 1.0, self.out, 0.01, self.renderer, on_render,
+                   stop)
+        self.assertEqual([6, 1], renders)
+        self.assert_rendered()
+
+    def test_watch_unwritable(self):
+        self.out = os.path.join(self.dir.name, 'wav', 'out.wav')
+        renderer, stop = IncrementalRenderer(self.song, 1.0, self.out), \
+            threading.Event()
+
+        def fix():
+            os.mkdir(os.path.dirname(self.out))
+            os.utime(self.song, ns=(0, 1))
+
+        timer, printed = threading.Timer(0.1, fix), io.StringIO()
+        timer.start()
+        with contextlib.redirect_stdout(printed):
+            watch_song(self.song, 1.0, self.out, 0.01, renderer,
+                       lambda renderer: stop.set(), stop)
+        timer.join()
+        self.assertIn('could not render', printed.getvalue())
+        self.assert_rendered()
+
+
+class test_compiled_score(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.song = os.path.join(self.dir.name, 'swan_lake.csv')
+        with open('swan_lake.csv') as src, open(self.song, 'w') as dst:
+            dst.write(src.read())
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def assert_same(self, exp, act):
+        self.assertEqual(exp.instruments, act.instruments)
+        np.testing.assert_array_equal(exp.notes, act.notes)
+        np.testing.assert_array_equal(exp._offsets, act._offsets)
+
+    def test_compile(self):
+        path = compile_song(self.song, 0.5)
+        self.assertEqual(os.path.join(self.dir.name, 'swan_lake.bin'), path)
+        table = load_song(self.song, 0.5)
+        self.assertIsInstance(table.notes, np.memmap)
+        self.assert_same(NoteTable.from_song(self.song, 0.5), table)
+
+    def test_columns(self):
+        compile_song(self.song, 0.5)
+        for exp, act in zip(_iter_song(self.song, 0.5),
+                            load_song(self.song, 0.5).columns()):
+            for e, a in zip(exp, act):
+                np.testing.assert_array_equal(e.play(), a.play())
+
+    def test_render(self):
+        exp, act = [os.path.join(self.dir.name, name)
+                    for name in ['exp.wav', 'act.wav']]
+        render_song(self.song, 0.5, exp)
+        compile_song(self.song, 0.5)
+        render_song(self.song, 0.5, act)
+        with open(exp, 'rb') as e, open(act, 'rb') as a:
+            self.assertEqual(e.read(), a.read())
+
+    def test_stale(self):
+        compile_song(self.song, 0.5)
+        with open(self.song, 'a') as song:
+            song.write('1:1:1:4, 1:1:1:4, 1:1:1:4\n')
+        table = load_song(self.song, 0.5)
+        self.assertNotIsInstance(table.notes, np.memmap)
+        self.assert_same(NoteTable.from_song(self.song, 0.5), table)
+        self.assertNotIsInstance(load_song(self.song, 1.0).notes, np.memmap)
+
+    def test_invalid(self):
+        path = compile_song(self.song, 0.5)
+        with open(path, 'r+b') as score:
+            score.write(b'NOTASCOR')
+        self.assertNotIsInstance(load_song(self.song, 0.5).notes, np.memmap)
+        with open(path, 'wb') as score:
+            score.write(b'short')
+        self.assertNotIsInstance(load_song(self.song, 0.5).notes, np.memmap)
+
+    def test_truncated(self):
+        exp, act = [os.path.join(self.dir.name, name)
+                    for name in ['exp.wav', 'act.wav']]
+        render_song(self.song, 0.5, exp)
+        path = compile_song(self.song, 0.5)
+        with open(path, 'r+b') as score:
+            score.truncate(os.path.getsize(path) - 16)
+        self.assertIsNone(NoteTable.load(path, 0.5, _song_digest(self.song)))
+        render_song(self.song, 0.5, act)
+        with open(exp, 'rb') as e, open(act, 'rb') as a:
+            self.assertEqual(e.read(), a.read())
+
+    def test_many_instruments(self):
+        with open(self.song, 'w') as song:
+            song.write(','.join(['Baliset', 'Gaffophone'] * 150) + '\n')
+            song.write(','.join(['1:1:1:0.1'] * 300) + '\n')
+        compile_song(self.song, 1.0)
+        table = load_song(self.song, 1.0)
+        self.assertIsInstance(table.notes, np.memmap)
+        self.assertEqual(299, table.notes['instrument'].max())
+        exp, act = [os.path.join(self.dir.name, name)
+                    for name in ['exp.wav', 'act.wav']]
+        render_song(self.song, 1.0, exp)
+        render_song(self.song, 1.0, act, workers=2)
+        with open(exp, 'rb') as e, open(act, 'rb') as a:
+            self.assertEqual(e.read(), a.read())
+
+    def test_empty(self):
+        with open(self.song, 'w') as song:
+            song.write('Baliset,Holophonor,Gaffophone\n')
+        compile_song(self.song, 0.5)
+        table = load_song(self.song, 0.5)
+        self.assertEqual(0, table.num_bars())
+        self.assertEqual(['baliset', 'holophonor', 'gaffophone'],
+                         table.instruments)
+
+
+class test_render_library(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.songs = os.path.join(self.dir.name, 'songs')
+        self.out = os.path.join(self.dir.name, 'out')
+        os.makedirs(os.path.join(self.songs, 'base'))
+        with open('song.csv') as src:
+            song = src.read()
+        for name in ['song.csv', os.path.join('base', 'song.csv')]:
+            with open(os.path.join(self.songs, name), 'w') as dst:
+                dst.write(song)
+        with open(os.path.join(self.songs, 'notes.txt'), 'w') as dst:
+            dst.write(song)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def statuses(self, results):
+        return sorted((os.path.relpath(r['out'], self.out), r['status'])
+                      for r in results)
+
+    def test_render(self):
+        results = render_library(self.songs, [0.5, 1], self.out)
+        self.assertEqual([(os.path.join('base', 'song_0.5.wav'), 'rendered'),
+                          (os.path.join('base', 'song_1.wav'), 'rendered'),
+                          ('song_0.5.wav', 'rendered'),
+                          ('song_1.wav', 'rendered')],
+                         self.statuses(results))
+        exp = os.path.join(self.dir.name, 'exp.wav')
+        render_song('song.csv', 0.5, exp)
+        with open(exp, 'rb') as e, \
+                open(os.path.join(self.out, 'song_0.5.wav'), 'rb') as a:
+            self.assertEqual(e.read(), a.read())
+
+    def test_up_to_date(self):
+        render_library(self.songs, [0.5], self.out)
+        results = render_library(self.songs, [0.5], self.out)
+        self.assertEqual(['up to date'] * 2, [r['status'] for r in results])
+        os.utime(os.path.join(self.songs, 'song.csv'),
+                 (time.time() + 10, time.time() + 10))
+        results = render_library(self.songs, [0.5], self.out)
+        self.assertEqual([(os.path.join('base', 'song_0.5.wav'),
+                           'up to date'), ('song_0.5.wav', 'rendered')],
+                         self.statuses(results))
+        results = render_library(self.songs, [0.5], self.out, force=True)
+        self.assertEqual(['rendered'] * 2, [r['status'] for r in results])
+
+    def test_failure(self):
+        with open(os.path.join(self.songs, 'bad.csv'), 'w') as bad:
+            bad.write('Baliset\n1:x:1:1\n')
+        results = render_library(self.songs, [1], self.out)
+        failed = [r for r in results if r['status'] == 'failed']
+        self.assertEqual(1, len(failed))
+        self.assertIn('ValueError', failed[0]['error'])
+        self.assertFalse(os.path.exists(failed[0]['out']))
+        self.assertFalse(os.path.exists(failed[0]['out'] + '.tmp'))
+
+    def test_jobs(self):
+        results = render_library(self.songs, [0.5, 1], self.out, jobs=2)
+        self.assertEqual(['rendered'] * 4, [r['status'] for r in results])
+        self.assertEqual((2, 2 ** 29 - 2 ** 25), _plan_jobs(2, 2 ** 30))
+        self.assertEqual(1, _plan_jobs(8, 2 ** 20)[0])
+
+    def test_main(self):
+        report = os.path.join(self.dir.name, 'report.json')
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(0, main(['render', self.songs, '--beat', '0.5',
+                                      '--jobs', '1', '--out', self.out,
+                                      '--report', report]))
+        self.assertIn('2 rendered, 0 up to date, 0 failed', out.getvalue())
+        with open(report) as file:
+            self.assertEqual({'rendered': 2}, json.load(file)['counts'])
+
+
+class test_audio_backend(unittest.TestCase):
+    def run_python(self, code):
+        env = dict(os.environ, SDL_AUDIODRIVER='dummy')
+        result = subprocess.run([sys.executable, '-c', code], env=env,
+                                capture_output=True, text=True)
+        self.assertEqual(0, result.returncode, result.stderr)
+        return result.stdout
+
+    def test_import_without_pygame(self):
+        out = self.run_python(
+            'import sys, tempfile, os\n'
+            'sys.modules["pygame"] = None\n'
+            'import make_some_noise\n'
+            'with tempfile.TemporaryDirectory() as d:\n'
+            '    make_some_noise.render_song("song.csv", 1.0,\n'
+            '                                os.path.join(d, "s.wav"))\n'
+            'print(make_some_noise.SimpleWave(440, 1, 1).play().shape)\n')
+        self.assertEqual('(44100,)', out.strip())
+
+    def test_opened_on_first_sound(self):
+        out = self.run_python(
+            'import sys, helpers, make_some_noise\n'
+            'print("pygame" in sys.modules, helpers._BACKEND.is_open())\n'
+            'helpers.play_sound(make_some_noise.SimpleWave(440, 0.05, 1))\n'
+            'print("pygame" in sys.modules, helpers._BACKEND.is_open())\n')
+        self.assertEqual(['False False', 'True True'], out.splitlines())
+
+    def test_context(self):
+        out = self.run_python(
+            'import helpers, make_some_noise\n'
+            'with helpers.AudioBackend(num_channels=2) as audio, \\\n'
+            '        helpers.use_backend(audio):\n'
+            '    helpers.play_sounds([make_some_noise.SimpleWave(440, 1, 1)])\n'
+            '    print(audio.is_open(), audio.free_channels())\n'
+            'print(audio.is_open(), helpers._BACKEND.is_open())\n')
+        self.assertEqual(['True 2', 'False False'], out.splitlines())
+
+    def test_free_channels(self):
+        backend = helper.AudioBackend()
+        self.assertFalse(backend.is_open())
+        self.assertEqual(3, backend.free_channels())
+
+
+class test_mix_bus(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.song = os.path.join(self.dir.name, 'ensemble.csv')
+        r = random.Random(0)
+        names = (['Baliset', 'Holophonor', 'Gaffophone'] * 6)[:16]
+        with open(self.song, 'w') as song:
+            song.write(','.join(names) + '\n')
+            for _ in range(4):
+                song.write(','.join(
+                    f'{r.randint(1, 4)}:{r.randint(1, 4)}:1:1'
+                    for _ in names) + '\n')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def waves(self, n):
+        return [SimpleWave(110 * (i + 1), 0.5, 1) for i in range(n)]
+
+    def test_gain(self):
+        bus = MixBus()
+        for n in range(4):
+            self.assertEqual(helper._MAX_AMPLITUDE, bus.gain(n))
+        self.assertEqual(int(32767 / 16), bus.gain(16))
+        self.assertEqual(helper._MAX_AMPLITUDE,
+                         MixBus(headroom='fixed').gain(16))
+        self.assertRaises(ValueError, MixBus, headroom='loud')
+        self.assertRaises(ValueError, MixBus, limiter='none')
+        self.assertRaises(ValueError, MixBus, voices=0)
+
+    def test_three_voices(self):
+        waves = self.waves(3) + [SimpleWave(440, 0.3, 1)]
+        for n in range(5):
+            exp = np.zeros(max([w._num_samples() for w in waves[:n]],
+                               default=0), dtype=np.int16)
+            for wave in waves[:n]:
+                array = helper.make_int16_array(wave.play())
+                exp[:len(array)] += array
+            if n <= 3:
+                np.testing.assert_array_equal(exp, MixBus().mix(waves[:n]))
+
+    def test_many_voices(self):
+        mixed = MixBus().mix(self.waves(16)).astype(int)
+        exp = sum((w.play() * int(32767 / 16)).astype(np.int16).astype(int)
+                  for w in self.waves(16))
+        np.testing.assert_array_equal(exp, mixed)
+        self.assertTrue(np.abs(mixed).max() <= 32767)
+
+    def test_duck_typed(self):
+        class Playable:
+            def __init__(self, wave):
+                self.wave = wave
+
+            def get_duration(self):
+                return self.wave.get_duration()
+
+            def play(self):
+                return self.wave.play()
+
+        waves = self.waves(2) + [SimpleWave(440, 0.3, 1)]
+        np.testing.assert_array_equal(
+            MixBus().mix(waves),
+            MixBus().mix([waves[0], Playable(waves[1]), Playable(waves[2])]))
+
+    def test_limiters(self):
+        waves = [SimpleWave(220, 0.5, 1)] * 16
+        clipped = MixBus(headroom='fixed').mix(waves)
+        self.assertEqual(32767, clipped.max())
+        self.assertEqual(-32767, clipped.min())
+        soft = MixBus(headroom='fixed', limiter='soft').mix(waves)
+        self.assertTrue(np.abs(soft.astype(int)).max() <= 32767)
+        quiet = MixBus(limiter='soft', knee=0.9).mix(self.waves(2))
+        np.testing.assert_array_equal(MixBus().mix(self.waves(2)), quiet)
+        ramp = np.arange(-200000, 200000, 7, dtype=np.int32)
+        limited = ramp.copy()
+        MixBus(limiter='soft')._limit(limited)
+        self.assertTrue(np.all(np.diff(limited) >= 0))
+        self.assertTrue(np.abs(limited).max() <= 32767)
+        knee = np.abs(ramp) <= 0.75 * 32767
+        np.testing.assert_array_equal(ramp[knee], limited[knee])
+
+    def test_render(self):
+        serial = os.path.join(self.dir.name, 'serial.wav')
+        parallel = os.path.join(self.dir.name, 'parallel.wav')
+        render_song(self.song, 1.0, serial)
+        render_song(self.song, 1.0, parallel, workers=2)
+        with wave.open(serial, 'rb') as w:
+            frames = np.frombuffer(w.readframes(w.getnframes()), np.int16)
+        self.assertEqual(4 * 44100, len(frames))
+        column = next(_iter_song(self.song, 1.0))
+        np.testing.assert_array_equal(MixBus().mix(column),
+                                      frames[:44100])
+        with open(serial, 'rb') as s, open(parallel, 'rb') as p:
+            self.assertEqual(s.read(), p.read())
+
+    def test_play_sounds(self):
+        helper.play_sounds([SimpleWave(110 * i, 1, 1) for i in range(1, 6)])
+        self.assertEqual(3, helper.audio_backend().free_channels())
+
+
+class test_peak_tracking(unittest.TestCase):
+    def setUp(self):
+        import make_some_noise
+        self.cache = make_some_noise.WAVE_CACHE
+        self.max_bytes = self.cache.max_bytes
+        self.cache.clear()
+
+    def tearDown(self):
+        self.cache.resize(self.max_bytes)
+        self.cache.clear()
+
+    def test_peak(self):
+        self.assertEqual(2, _peak(np.array([0.5, -0.25, 0.75, -0.5])))
+        self.assertEqual(1, _peak(np.array([0.5, -0.75, 0.25])))
+        self.assertIsNone(_peak(np.array([])))
+
+    def test_reported_peaks(self):
+        waves = [SimpleWave(440, 0.5, 0.5), SquareWave(131, 0.4, 1),
+                 StutterNote(65, 1, 0.5), StutterNote(65, 0.2, 0.5),
+                 Note([SawtoothWave(220, 0.2, 0.3), Rest(0.1),
+                       SquareWave(330, 0.3, 0.9)])]
+        for wave in waves:
+            for _ in range(2):
+                array, peak = wave._play_peak()
+                self.assertEqual(np.abs(array).max(), abs(array[peak]))
+        self.assertIsNone(Rest(0.5)._play_peak()[1])
+
+    def test_instruments(self):
+        for instrument in [Baliset(), Holophonor(), Gaffophone()]:
+            instrument.next_notes([('1:1', 0.5, 0.6), ('3:2', 1, 0.2),
+                                   ('1:2', 0, 0.2)])
+            array = instrument.play()
+            self.assertAlmostEqual(instrument._get_amplitude(),
+                                   np.abs(array).max())
+
+    def test_cached_peaks(self):
+        wave = SawtoothWave(440, 0.5, 0.8)
+        array, peak = wave._play_peak()
+        key = wave._cache_key() + helper.synthesis_key()
+        self.assertEqual(peak, self.cache.peak(key, np.zeros(len(array))))
+        self.cache.resize(0)
+        self.assertEqual(0, len(self.cache._peaks))
+        self.assertEqual(peak, wave._play_peak()[1])
+
+
+class test_async_playback(unittest.TestCase):
+    def setUp(self):
+        self.bars = [np.full(2205, i, dtype=np.int16) for i in range(3)]
+
+    async def collect_async(self, stream):
+        return [bar async for bar in stream]
+
+    def collect(self, stream):
+        return asyncio.run(self.collect_async(stream))
+
+    def test_stream_matches_render_song(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'song.wav')
+            render_song('song.csv', 0.5, path)
+            with wave.open(path) as song:
+                exp = song.readframes(song.getnframes())
+        act = self.collect(render_song_stream('song.csv', 0.5))
+        self.assertEqual(exp, b''.join(bar.tobytes() for bar in act))
+
+    def test_concurrent_streams(self):
+        async def both():
+            return await asyncio.gather(
+                *[self.collect_async(render_song_stream(song, 0.5))
+                  for song in ['song.csv', 'swan_lake.csv']])
+        together = asyncio.run(both())
+        for song, bars in zip(['song.csv', 'swan_lake.csv'], together):
+            alone = self.collect(render_song_stream(song, 0.5))
+            self.assertEqual(len(alone), len(bars))
+            self.assertTrue(all(np.array_equal(a, b)
+                                for a, b in zip(alone, bars)))
+
+    def test_backpressure(self):
+        rendered = []
+        def render(bar):
+            rendered.append(bar)
+            return bar
+        async def slow():
+            stream = render_ahead(range(100), render, 2)
+            first = await stream.__anext__()
+            await asyncio.sleep(0.1)
+            count = len(rendered)
+            await stream.aclose()
+            await asyncio.sleep(0.05)
+            return first, count
+        first, count = asyncio.run(slow())
+        self.assertEqual(0, first)
+        self.assertLessEqual(count, 4)
+        self.assertLessEqual(len(rendered), 5)
+
+    def test_render_error(self):
+        def broken(bar):
+            if bar[0] == 1:
+                raise ValueError('broken bar')
+            return bar
+        self.assertRaises(ValueError, self.collect,
+                          render_ahead(self.bars, broken))
+        self.assertRaises(ValueError, self.collect,
+                          render_ahead(self.bars, broken, 0))
+
+    def test_context(self):
+        oscillators = []
+        def render(bar):
+            oscillators.append(helper._OSCILLATOR.get())
+            return bar
+        wavetable = Wavetable()
+        async def play():
+            with use_oscillator(wavetable):
+                await PlaybackEngine().play_async(self.bars, render)
+        asyncio.run(play())
+        self.assertEqual([wavetable] * 3, oscillators)
+
+    def test_play_async(self):
+        engine = PlaybackEngine()
+        asyncio.run(engine.play_async(self.bars, lambda bar: bar))
+        self.assertEqual(3, engine.bars_played)
+        self.assertEqual(3, helper.audio_backend().free_channels())
+
+    def test_cancel(self):
+        bars = [np.zeros(helper._SAMPLE_RATE, dtype=np.int16)] * 10
+        engine = PlaybackEngine()
+        async def cancel():
+            task = asyncio.ensure_future(
+                engine.play_async(bars, lambda bar: bar))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await asyncio.wait([task])
+            if not task.cancelled():
+                task.result()
+            return task.cancelled()
+        self.assertTrue(asyncio.run(cancel()))
+        self.assertLess(engine.bars_played, 10)
+        self.assertEqual(3, helper.audio_backend().free_channels())
+
+    def test_play_song_async(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bar.csv')
+            with open(path, 'w') as song:
+                song.write('Baliset,Holophonor,Gaffophone\n')
+                song.write('1:1:1:0.5,2:1:1:1,rest:1\n1:1:1:0.5,,\n')
+            engine = PlaybackEngine()
+            asyncio.run(play_song_async(path, 1.0, engine))
+        self.assertEqual(1, engine.bars_played)
+
+    def test_play_sounds_async(self):
+        baliset = Baliset()
+        baliset.next_notes([('1:1', 0.5, 0.1)])
+        asyncio.run(play_sounds_async([baliset]))
+        asyncio.run(play_sound_async(SimpleWave(440, 0.1, 1)))
+        self.assertEqual(3, helper.audio_backend().free_channels())
+
+
+class test_stream(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.wav = os.path.join(self.dir.name, 'song.wav')
+        render_song('song.csv', 0.5, self.wav)
+        with wave.open(self.wav) as song:
+            self.frames = song.readframes(song.getnframes())
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_same_frames(self):
+        for chunk in [1, 1000, 4096, 10 ** 6]:
+            out = io.BytesIO()
+            frames = stream_song('song.csv', 0.5, out, chunk)
+            self.assertEqual(self.frames, out.getvalue())
+            self.assertEqual(len(self.frames) // 2, frames)
+
+    def test_chunks(self):
+        writes = []
+        class Pipe(io.RawIOBase):
+            def writable(self):
+                return True
+            def write(self, data):
+                writes.append(bytes(data))
+                return len(writes[-1])
+        sink = PCMSink(Pipe(), 100)
+        for length in [30, 250, 70, 5, 0, 200]:
+            sink.write(np.arange(length, dtype=np.int16))
+        sink.close()
+        self.assertEqual([200] * 5 + [110], [len(w) for w in writes])
+        self.assertEqual((555, 6), (sink.frames_written, sink.chunks_written))
+        self.assertRaises(ValueError, PCMSink, io.BytesIO(), 0)
+
+    def test_wav_header(self):
+        out = io.BytesIO()
+        stream_song('song.csv', 0.5, out, wav_header=True)
+        with open(self.wav, 'rb') as file:
+            self.assertEqual(file.read(), out.getvalue())
+
+    def test_unknown_length(self):
+        class Pipe(io.BytesIO):
+            def seekable(self):
+                return False
+        out = Pipe()
+        stream_song('song.csv', 0.5, out, wav_header=True)
+        with wave.open(io.BytesIO(out.getvalue())) as song:
+            self.assertEqual(self.frames, song.readframes(10 ** 9))
+        self.assertEqual(b'\xff' * 4, out.getvalue()[40:44])
+
+    def test_main(self):
+        path = os.path.join(self.dir.name, 'song.pcm')
+        self.assertEqual(0, main(['stream', 'song.csv', '--beat', '0.5',
+                                  '--out', path, '--chunk', '512']))
+        with open(path, 'rb') as file:
+            self.assertEqual(self.frames, file.read())
+        result = subprocess.run(
+            [sys.executable, 'make_some_noise.py', 'stream', 'song.csv',
+             '--beat', '0.5', '--wav'], capture_output=True, check=True)
+        with wave.open(io.BytesIO(result.stdout)) as song:
+            self.assertEqual(self.frames, song.readframes(10 ** 9))
+
+
+class test_sample_rate(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_use_sample_rate(self):
+        self.assertEqual(44100, helper.sample_rate())
+        with helper.use_sample_rate(PREVIEW_RATE):
+            self.assertEqual(PREVIEW_RATE, helper.sample_rate())
+            self.assertEqual(PREVIEW_RATE // 2,
+                             len(helper.make_sine_wave_array(440, 0.5)))
+            self.assertEqual(PREVIEW_RATE, len(SawtoothWave(440, 1, 1).play()))
+            self.assertIn(PREVIEW_RATE, helper.synthesis_key())
+        self.assertEqual(44100, len(SawtoothWave(440, 1, 1).play()))
+        with self.assertRaises(ValueError):
+            with helper.use_sample_rate(0):
+                pass
+
+    def test_prunes_partials(self):
+        with helper.use_sample_rate(PREVIEW_RATE):
+            wave = SawtoothWave(1000, 1, 1).play()
+        spectrum = np.abs(np.fft.rfft(wave))
+        self.assertGreater(spectrum[5000], 100)
+        # Harmonics above 5512.5 Hz would alias to these frequencies
+        self.assertLess(spectrum[[4025, 5025, 3025, 2025]].max(), 1e-6)
+
+    def test_preview_render(self):
+        full = os.path.join(self.dir.name, 'full.wav')
+        preview = os.path.join(self.dir.name, 'preview.wav')
+        render_song('swan_lake.csv', 0.5, full)
+        render_song('swan_lake.csv', 0.5, preview, rate=PREVIEW_RATE)
+        with wave.open(full) as a, wave.open(preview) as b:
+            self.assertEqual(PREVIEW_RATE, b.getframerate())
+            self.assertAlmostEqual(a.getnframes() / a.getframerate(),
+                                   b.getnframes() / b.getframerate(), 1)
+        out = io.BytesIO()
+        stream_song('swan_lake.csv', 0.5, out, wav_header=True,
+                    rate=PREVIEW_RATE)
+        with open(preview, 'rb') as file:
+            self.assertEqual(file.read(), out.getvalue())
+
+    def test_current_rate(self):
+        preview = os.path.join(self.dir.name, 'preview.wav')
+        current = os.path.join(self.dir.name, 'current.wav')
+        render_song('song.csv', 0.5, preview, rate=PREVIEW_RATE)
+        out = io.BytesIO()
+        with helper.use_sample_rate(PREVIEW_RATE):
+            render_song('song.csv', 0.5, current)
+            stream_song('song.csv', 0.5, out, wav_header=True)
+            renderer = IncrementalRenderer('song.csv', 0.5, current)
+            stream = render_song_stream('song.csv', 0.5)
+        with open(preview, 'rb') as p, open(current, 'rb') as c:
+            frames = p.read()
+            self.assertEqual(frames, c.read())
+        self.assertEqual(frames, out.getvalue())
+        self.assertEqual(PREVIEW_RATE, renderer.rate)
+
+        async def collect():
+            return b''.join([bar.tobytes() async for bar in stream])
+        self.assertEqual(frames[44:], asyncio.run(collect()))
+
+    def test_incremental(self):
+        out = os.path.join(self.dir.name, 'song.wav')
+        renderer = IncrementalRenderer('song.csv', 0.5, out,
+                                       rate=PREVIEW_RATE)
+        renderer.render()
+        with wave.open(out) as song:
+            self.assertEqual(PREVIEW_RATE, song.getframerate())
+        self.assertEqual(0, renderer.render())
+
+    def test_resample(self):
+        frames = np.arange(0, 400, 4, dtype=np.int16)
+        act = helper.resample(frames, PREVIEW_RATE, 44100)
+        self.assertEqual(np.int16, act.dtype)
+        self.assertEqual(400, len(act))
+        self.assertTrue(np.array_equal(np.arange(397), act[:397]))
+        self.assertEqual(25, len(helper.resample(frames, 44100, PREVIEW_RATE)))
+        self.assertIs(frames, helper.resample(frames, 44100, 44100))
+
+    def test_play_preview(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bar.csv')
+            with open(path, 'w') as song:
+                song.write('Baliset,Holophonor,Gaffophone\n')
+                song.write('1:1:1:0.5,2:1:1:1,rest:1\n1:1:1:0.5,,\n')
+            engine = PlaybackEngine()
+            play_song(path, 1.0, engine, rate=PREVIEW_RATE)
+        self.assertEqual(1, engine.bars_played)
+
+
 if __name__ == "__main__":
     unittest.main(exit=False)
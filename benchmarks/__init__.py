@@ -0,0 +1,5 @@
+"""=== Module Description
+Benchmarks for the music simulator. Each module can be run from the
+repository root with python -m benchmarks.<module>; benchmarks.suite runs
+all of them and can save and compare results.
+"""
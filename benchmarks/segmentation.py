@@ -0,0 +1,40 @@
+"""=== Module Description
+Times the one-second bar segmentation of _segment_track on synthetic
+instrument tracks of growing length, up to 100k notes, to show that it
+scales linearly.
+
+Run from the repository root with:
+    python -m benchmarks.segmentation
+"""
+import os
+import random
+import time
+
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+from make_some_noise import _segment_track
+
+_SIZES = [1000, 10000, 100000]
+_DURATIONS = [0.1, 0.2, 0.25, 0.3, 0.5, 0.7, 1.0, 1.5, 2.0, 3.2]
+
+
+def synthetic_track(size: int, seed: int = 0) -> list:
+    """Returns size random (ratio, amplitude, duration) notes"""
+    r = random.Random(seed)
+    return [(f'{r.randint(1, 9)}:{r.randint(1, 9)}', 0.5,
+             r.choice(_DURATIONS)) for _ in range(size)]
+
+
+def main() -> None:
+    print(f'{"notes":>8}{"bars":>9}{"seconds":>10}{"us/note":>10}')
+    for size in _SIZES:
+        track = synthetic_track(size)
+        start = time.perf_counter()
+        bars = sum(1 for _ in _segment_track(track))
+        seconds = time.perf_counter() - start
+        print(f'{size:>8}{bars:>9}{seconds:>10.4f}'
+              f'{seconds / size * 1e6:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
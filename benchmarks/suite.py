@@ -0,0 +1,373 @@
+"""=== Module Description
+Runs every benchmark of the music simulator headless and reports, for each
+case, the seconds it takes, samples synthesized per second, real-time factor
+(seconds of audio produced per second of wall time), peak memory and, for
+songs, time-to-first-bar. Cases cover importing the simulator, wave
+synthesis, song parsing, bar segmentation, mixing whole songs and gapless
+playback, on the bundled songs and on synthetic scores of growing size.
+
+Results can be saved as JSON and compared with an earlier run, flagging every
+metric that got worse by more than a threshold:
+    python -m benchmarks.suite --save before.json
+    python -m benchmarks.suite --compare before.json --threshold 0.1
+
+--quick runs smaller synthetic scores and --playback adds a real-time
+playback case, which takes a few seconds of wall time per song.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import numpy as np
+import helpers
+import make_some_noise as noise
+from benchmarks.segmentation import synthetic_track
+from playback import PlaybackEngine
+
+_SONGS = ['song.csv', 'swan_lake.csv', 'spanish_violin.csv',
+          os.path.join('base_songs', 'line_2_d_greater_1.csv')]
+_INSTRUMENTS = ['Baliset', 'Holophonor', 'Gaffophone']
+_MAX_PROCESS_SONG_NOTES = 50000
+_DTYPES = {'': np.float64, ' float32': np.float32}
+# Metrics where a larger value is better; for the rest smaller is better
+_HIGHER = {'samples_per_second', 'realtime_factor', 'notes_per_second'}
+
+
+def _time(func: typing.Callable[[], object], setup=None,
+          repeat: int = 5) -> float:
+    """ Returns the best time in seconds of one call to func, calling setup
+    before every call without timing it """
+
+    best = float('inf')
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def _peak_bytes(func: typing.Callable[[], object], setup=None) -> int:
+    """ Returns the most memory allocated at once during one call to func """
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _measure(func: typing.Callable[[], object], samples: int = 0,
+             notes: int = 0, setup=None, repeat: int = 5,
+             rate: typing.Optional[int] = None) -> dict:
+    """ Returns the metrics of func, which synthesizes samples samples at
+    rate (the current sample_rate() by default) or processes notes notes """
+
+    if rate is None:
+        rate = helpers.sample_rate()
+    seconds = _time(func, setup, repeat)
+    result = {'seconds': seconds, 'peak_bytes': _peak_bytes(func, setup)}
+    if samples:
+        result['samples_per_second'] = samples / seconds
+        result['realtime_factor'] = samples / rate / seconds
+    if notes:
+        result['notes_per_second'] = notes / seconds
+
+    return result
+
+
+def synthetic_song(path: str, rows: int, seed: int = 0,
+                   instruments: int = len(_INSTRUMENTS)) -> None:
+    """ Writes a song of rows random rows for each of instruments
+    instruments, cycling through the kinds of instrument, to path """
+
+    r = random.Random(seed)
+    names = [_INSTRUMENTS[i % len(_INSTRUMENTS)] for i in range(instruments)]
+    with open(path, 'w') as song:
+        song.write(','.join(names) + '\n')
+        for _ in range(rows):
+            song.write(','.join(
+                f'{r.randint(1, 4)}:{r.randint(1, 4)}:{r.choice([0.5, 1])}:'
+                f'{r.choice([0.25, 0.5, 0.75, 1, 1.5])}'
+                if r.random() < 0.9 else f'rest:{r.choice([0.25, 0.5])}'
+                for _ in names) + '\n')
+
+
+def _song_samples(song_file: str, beat: float) -> int:
+    """ Returns the number of samples render_song writes for the song """
+
+    return sum(noise._column_samples(column)
+               for column in noise._iter_song(song_file, beat))
+
+
+def bench_import(repeat: int = 5) -> dict:
+    """ Returns the time a new interpreter takes to import numpy alone and to
+    import the simulator, which should add little to numpy """
+
+    results = {}
+    for module in ['numpy', 'make_some_noise']:
+        results[f'import/{module}'] = {'seconds': _time(
+            lambda: subprocess.run([sys.executable, '-c', f'import {module}'],
+                                   check=True), repeat=repeat)}
+
+    return results
+
+
+def bench_synthesis() -> dict:
+    """ Returns the metrics of rendering single waves with a cold cache """
+
+    holophonor, gaffophone = noise.Holophonor(), noise.Gaffophone()
+    holophonor.next_notes([('3:2', 1, 0.5), ('2:1', 0.5, 0.5)])
+    gaffophone.next_notes([('3:2', 1, 0.5), ('2:1', 0.5, 0.5)])
+    r = random.Random(0)
+    cases = {
+        'SimpleWave': noise.SimpleWave(440, 1, 1),
+        'ComplexWave': noise.ComplexWave(
+            [noise.SimpleWave(r.randint(50, 5000), 1, r.random())
+             for _ in range(10)]),
+        'SawtoothWave': noise.SawtoothWave(440, 1, 1),
+        'StutterNote': noise.StutterNote(440, 1, 1),
+        'Holophonor bar': holophonor,
+        'Gaffophone bar': gaffophone,
+    }
+    oscillators = {'': None, ' wavetable': helpers.Wavetable()}
+    results = {}
+
+    for (name, wave), (suffix, oscillator) in itertools.product(
+            cases.items(), oscillators.items()):
+        with helpers.use_oscillator(oscillator):
+            results[f'synthesis/{name}{suffix}'] = _measure(
+                wave.play, samples=wave._num_samples(),
+                setup=noise.WAVE_CACHE.clear)
+
+    return results
+
+
+def bench_parsing(sizes: typing.List[int], directory: str) -> dict:
+    """ Returns the metrics of parsing the bundled songs and synthetic songs
+    of sizes rows """
+
+    songs = {song: song for song in _SONGS}
+    for rows in sizes:
+        path = os.path.join(directory, f'synthetic_{rows}.csv')
+        synthetic_song(path, rows)
+        songs[f'synthetic {rows} rows'] = path
+    results = {}
+
+    for name, path in songs.items():
+        notes = len(noise.NoteTable.from_song(path, 1.0))
+        # _process_song builds every instrument up front, which takes minutes
+        # and gigabytes beyond this size
+        if notes <= _MAX_PROCESS_SONG_NOTES:
+            results[f'parse/_process_song {name}'] = _measure(
+                lambda: noise._process_song(path, 1.0), notes=notes,
+                repeat=3)
+        results[f'parse/NoteTable {name}'] = _measure(
+            lambda: noise.NoteTable.from_song(path, 1.0), notes=notes,
+            repeat=3)
+        score = noise.compile_song(
+            path, 1.0, os.path.join(directory, 'score.bin'))
+        results[f'parse/compiled {name}'] = _measure(
+            lambda: noise.load_song(path, 1.0, score), notes=notes,
+            repeat=3)
+
+    return results
+
+
+def bench_segmentation(sizes: typing.List[int]) -> dict:
+    """ Returns the metrics of segmenting synthetic tracks of sizes notes """
+
+    results = {}
+    for size in sizes:
+        track = synthetic_track(size)
+        results[f'segment/{size} notes'] = _measure(
+            lambda: sum(1 for _ in noise._segment_track(track)), notes=size,
+            repeat=3)
+
+    return results
+
+
+def bench_render(sizes: typing.List[int], directory: str) -> dict:
+    """ Returns the metrics of rendering the bundled songs and synthetic
+    songs of sizes rows to WAV files with a cold cache """
+
+    songs = {song: song for song in _SONGS}
+    for rows in sizes:
+        path = os.path.join(directory, f'render_{rows}.csv')
+        synthetic_song(path, rows)
+        songs[f'synthetic {rows} rows'] = path
+    # The mix bus should make a large ensemble cost the same per instrument
+    # sample as three instruments
+    path = os.path.join(directory, 'ensemble.csv')
+    synthetic_song(path, sizes[0], instruments=16)
+    songs[f'synthetic {sizes[0]} rows 16 instruments'] = path
+    out_path = os.path.join(directory, 'out.wav')
+    results = {}
+
+    for (name, path), (suffix, dtype) in itertools.product(
+            songs.items(), _DTYPES.items()):
+        result = _measure(
+            lambda: noise.render_song(path, 1.0, out_path, dtype=dtype),
+            samples=_song_samples(path, 1.0), setup=noise.WAVE_CACHE.clear,
+            repeat=3)
+        with helpers.use_dtype(dtype):
+            result['first_bar_seconds'] = _time(
+                lambda: noise._render_column(
+                    next(noise._iter_song(path, 1.0))),
+                noise.WAVE_CACHE.clear)
+        results[f'render/{name}{suffix}'] = result
+
+    for name, path in songs.items():
+        with helpers.use_sample_rate(noise.PREVIEW_RATE):
+            samples = _song_samples(path, 1.0)
+        results[f'render/{name} preview'] = _measure(
+            lambda: noise.render_song(path, 1.0, out_path,
+                                      rate=noise.PREVIEW_RATE),
+            samples=samples, setup=noise.WAVE_CACHE.clear, repeat=3,
+            rate=noise.PREVIEW_RATE)
+
+    return results
+
+
+def bench_playback(bars: int = 3) -> dict:
+    """ Returns the metrics of playing the first bars of each bundled song in
+    real time through a PlaybackEngine """
+
+    results = {}
+    for song in _SONGS:
+        noise.WAVE_CACHE.clear()
+        engine = PlaybackEngine()
+        start = time.perf_counter()
+        engine.play(itertools.islice(noise._iter_song(song, 1.0), bars),
+                    noise._render_column)
+        results[f'playback/{song}'] = {
+            'seconds': time.perf_counter() - start,
+            'underruns': engine.underruns}
+
+    return results
+
+
+def run(quick: bool = False, playback: bool = False) -> dict:
+    """ Runs the benchmarks and returns their results with the environment
+    they ran in """
+
+    scale = [1] if quick else [1, 10, 100]
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        results.update(bench_import())
+        results.update(bench_synthesis())
+        results.update(bench_parsing([1000 * n for n in scale], directory))
+        results.update(bench_segmentation([1000 * n for n in scale]))
+        results.update(bench_render([4 * n for n in scale], directory))
+        if playback:
+            results.update(bench_playback())
+
+    return {'meta': {'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'machine': platform.machine(),
+                     'processor': platform.processor(),
+                     'cpus': os.cpu_count(),
+                     'date': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+
+def compare(old: dict, new: dict, threshold: float) -> typing.List[str]:
+    """ Returns a line for every metric of a case in both old and new results
+    that got worse by more than threshold, as a fraction of its old value """
+
+    regressions = []
+    for case, metrics in new['results'].items():
+        for metric, value in metrics.items():
+            before = old['results'].get(case, {}).get(metric)
+            if not before or metric == 'underruns':
+                continue
+            change = value / before - 1
+            if metric in _HIGHER:
+                change = before / value - 1 if value else float('inf')
+            if change > threshold:
+                regressions.append(f'{case} {metric}: {before:.4g} -> '
+                                   f'{value:.4g} ({change:+.0%} worse)')
+
+    return regressions
+
+
+def _format(result: dict) -> str:
+    """ Returns the metrics of one case on one line """
+
+    parts = [f'{result["seconds"] * 1e3:10.2f} ms']
+    if 'samples_per_second' in result:
+        parts.append(f'{result["samples_per_second"] / 1e6:7.2f} MS/s')
+        parts.append(f'{result["realtime_factor"]:8.1f}x rt')
+    if 'notes_per_second' in result:
+        parts.append(f'{result["notes_per_second"] / 1e3:9.1f} knotes/s')
+    if 'peak_bytes' in result:
+        parts.append(f'{result["peak_bytes"] / 2 ** 20:8.2f} MiB peak')
+    if 'first_bar_seconds' in result:
+        parts.append(f'{result["first_bar_seconds"] * 1e3:8.2f} ms to first '
+                     f'bar')
+    if 'underruns' in result:
+        parts.append(f'{result["underruns"]} underruns')
+
+    return '  '.join(parts)
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> int:
+    """ Runs the benchmark suite command line and returns its exit status,
+    which is 1 if a comparison found regressions """
+
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.suite',
+        description='Benchmark the music simulator.')
+    parser.add_argument('--quick', action='store_true',
+                        help='use smaller synthetic scores')
+    parser.add_argument('--playback', action='store_true',
+                        help='also play the songs in real time')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with those saved in FILE')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fraction a metric may get worse by before it '
+                             'is flagged (default 0.1)')
+    args = parser.parse_args(argv)
+
+    results = run(args.quick, args.playback)
+    width = max(len(case) for case in results['results'])
+    for case, result in results['results'].items():
+        print(f'{case:<{width}}  {_format(result)}')
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(json.load(file), results, args.threshold)
+        for line in regressions:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        if regressions:
+            return 1
+        print(f'no regressions against {args.compare}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
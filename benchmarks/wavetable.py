@@ -0,0 +1,63 @@
+"""=== Module Description
+Compares the accuracy and speed of the Wavetable oscillator in helpers.py
+against the exact np.sin path of make_sine_wave_array.
+
+Run from the repository root with:
+    python -m benchmarks.wavetable
+"""
+import os
+import timeit
+import numpy as np
+
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import helpers
+from make_some_noise import SawtoothWave, Holophonor, WAVE_CACHE
+
+_ERRORS = [1e-3, 1e-6, 1e-9]
+_FREQUENCIES = [13, 98, 440, 4000, 15000]
+
+
+def _time(func, repeat: int = 20) -> float:
+    """Returns the best time in seconds of one call to func, each made with
+    an empty WAVE_CACHE so that it synthesizes its waves again"""
+    return min(timeit.repeat(func, setup=WAVE_CACHE.clear, number=1,
+                             repeat=repeat))
+
+
+def _renders() -> dict:
+    """Returns the calls timed for every oscillator"""
+    holophonor = Holophonor()
+    holophonor.next_notes([('3:2', 1, 0.5), ('2:1', 0.5, 0.5)])
+    return {
+        'sine 1s': lambda: helpers.make_sine_wave_array(440, 1),
+        'sawtooth 1s': SawtoothWave(440, 1, 1).play,
+        'holophonor bar': holophonor.play,
+    }
+
+
+def main() -> None:
+    renders = _renders()
+    exact = {name: _time(func) for name, func in renders.items()}
+    print(f'{"oscillator":<26}{"max error":>12}'
+          + ''.join(f'{name:>18}' for name in renders))
+    print(f'{"np.sin":<26}{0:>12.1e}'
+          + ''.join(f'{t * 1e3:>15.3f} ms' for t in exact.values()))
+
+    for max_error in _ERRORS:
+        table = helpers.Wavetable(max_error)
+        error = 0
+        for frequency in _FREQUENCIES:
+            expected = helpers.make_sine_wave_array(frequency, 1)
+            with helpers.use_oscillator(table):
+                actual = helpers.make_sine_wave_array(frequency, 1)
+            error = max(error, np.abs(expected - actual).max())
+        with helpers.use_oscillator(table):
+            times = {name: _time(func) for name, func in renders.items()}
+        print(f'{repr(table):<26}{error:>12.1e}'
+              + ''.join(f'{t * 1e3:>8.3f} ms {exact[n] / t:>4.1f}x'
+                        for n, t in times.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -6,16 +6,16 @@ and play numpy array representations of waves as sounds.
 This file should not be modified in any way.
 """
 from contextlib import redirect_stdout
+from contextvars import ContextVar
+import importlib
 import os
-from typing import List
+import threading
+from typing import List, Optional
 import numpy as np
 from contextlib import contextmanager
 import time
 from warnings import warn
-
-with open(os.devnull, 'w') as devnull:
-    with redirect_stdout(devnull):
-        import pygame
+from tracing import span
 
 _SAMPLE_RATE = 44100
 _BITS = 16
@@ -23,36 +23,121 @@ _MAX_SAMPLE = 2**(_BITS - 1) - 1
 _MAX_CHANNELS = 3
 _MAX_AMPLITUDE = int(_MAX_SAMPLE / _MAX_CHANNELS)
 
-pygame.mixer.pre_init(_SAMPLE_RATE, -_BITS, 1)
-pygame.mixer.init()
-pygame.mixer.set_num_channels(_MAX_CHANNELS)
 
-_AVAILABLE_CHANNELS = set()
-for i in range(_MAX_CHANNELS):
-    channel = pygame.mixer.Channel(i)
-    _AVAILABLE_CHANNELS.add(channel)
+class AudioBackend:
+    """The sound device sounds are played on through pygame's mixer.
+
+    pygame is not imported and the device is not opened until a sound is
+    first played, so processes that only synthesize or render arrays never
+    need pygame or a sound device. Used as a context manager, the device is
+    opened at the start of the with block and closed at its end.
+
+    pygame has one mixer per process, so only one AudioBackend should be
+    open at a time.
+    """
+    sample_rate: int
+    num_channels: int
+
+    def __init__(self, sample_rate: int = _SAMPLE_RATE,
+                 num_channels: int = _MAX_CHANNELS) -> None:
+        self.sample_rate = sample_rate
+        self.num_channels = num_channels
+        self._pygame = None
+        self._available = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> 'AudioBackend':
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def is_open(self) -> bool:
+        return self._pygame is not None
+
+    def open(self) -> None:
+        with self._lock:
+            if self._pygame is not None:
+                return
+            with open(os.devnull, 'w') as devnull:
+                with redirect_stdout(devnull):
+                    pygame = importlib.import_module('pygame')
+            pygame.mixer.pre_init(self.sample_rate, -_BITS, 1)
+            pygame.mixer.init()
+            pygame.mixer.set_num_channels(self.num_channels)
+            self._available = {pygame.mixer.Channel(i)
+                               for i in range(self.num_channels)}
+            self._pygame = pygame
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pygame is None:
+                return
+            self._pygame.mixer.quit()
+            self._pygame, self._available = None, set()
+
+    def free_channels(self) -> int:
+        if self._pygame is None:
+            return self.num_channels
+        return len(self._available)
+
+    @contextmanager
+    def channel(self) -> None:
+        self.open()
+        try:
+            channel = self._available.pop()
+        except KeyError as e:
+            msg = f'Only {self.num_channels} sounds can be played at once'
+            raise KeyError(msg) from e
+        try:
+            yield channel
+        finally:
+            self._available.add(channel)
+
+    def make_sound(self, array: np.ndarray) -> object:
+        self.open()
+        return self._pygame.sndarray.make_sound(array)
+
+    def busy(self) -> bool:
+        return self._pygame is not None and self._pygame.mixer.get_busy()
+
+
+_BACKEND = AudioBackend()
+_AUDIO: ContextVar = ContextVar('audio', default=None)
+
 
 @contextmanager
-def _channel() -> None:
-    try:
-        channel = _AVAILABLE_CHANNELS.pop()
-    except KeyError as e:
-        msg = f'Only {_MAX_CHANNELS} sounds can be played at once'
-        raise KeyError(msg) from e
+def use_backend(backend: AudioBackend) -> None:
+    token = _AUDIO.set(backend)
     try:
-        yield channel
+        yield backend
     finally:
-        _AVAILABLE_CHANNELS.add(channel)
+        _AUDIO.reset(token)
+
+
+def audio_backend() -> AudioBackend:
+    backend = _AUDIO.get()
+    return _BACKEND if backend is None else backend
+
+
+def _channel() -> None:
+    return audio_backend().channel()
 
 
 def _play_sound(playable: object) -> None:
-    with _channel() as channel:
-        wave = playable.play() * _MAX_AMPLITUDE
-        wave = pygame.sndarray.make_sound(
-            np.ascontiguousarray(wave, dtype=np.int16))
+    backend = audio_backend()
+    with backend.channel() as channel:
+        wave = backend.make_sound(make_int16_array(playable.play()))
         channel.play(wave)
 
 
+def queue_sound(channel: object, array: np.ndarray) -> object:
+    sound = audio_backend().make_sound(array)
+    channel.queue(sound)
+    return sound
+
+
 def play_sound(playable: object) -> None:
     _play_sound(playable)
     time.sleep(playable.get_duration())
@@ -63,13 +148,299 @@ def play_sounds(playables: List[object]) -> None:
         msg = 'At least one of the sounds played has a '\
               'duration that is not exactly one second.'
         warn(msg)
-    for playable in playables:
-        _play_sound(playable)
-    while pygame.mixer.get_busy():
+    backend = audio_backend()
+    with backend.channel() as channel:
+        channel.play(backend.make_sound(MixBus().mix(playables)))
+    while backend.busy():
         time.sleep(0.01)
 
+
+async def play_sound_async(playable: object) -> None:
+    # asyncio is only imported by the coroutines that need it
+    import asyncio
+    array = await asyncio.to_thread(lambda: make_int16_array(playable.play()))
+    backend = audio_backend()
+    await asyncio.to_thread(backend.open)
+    with backend.channel() as channel:
+        channel.play(backend.make_sound(array))
+    await asyncio.sleep(playable.get_duration())
+
+
+async def play_sounds_async(playables: List[object]) -> None:
+    import asyncio
+    if any(p.get_duration() - 1 > 0.01 for p in playables):
+        msg = 'At least one of the sounds played has a '\
+              'duration that is not exactly one second.'
+        warn(msg)
+    mixed = await asyncio.to_thread(MixBus().mix, playables)
+    backend = audio_backend()
+    await asyncio.to_thread(backend.open)
+    # The channel is held until the sounds end, so that sounds played from
+    # other tasks meanwhile cannot cut them off
+    with backend.channel() as channel:
+        channel.play(backend.make_sound(mixed))
+        while channel.get_busy():
+            await asyncio.sleep(0.01)
+
+
+class Wavetable:
+    """A sine oscillator that reads a precomputed table of one sine cycle with
+    linear interpolation instead of calling np.sin on every sample.
+
+    The table is just large enough for the interpolation error to stay below
+    max_error. The phase of each sample is accumulated as a 64-bit fixed
+    point fraction of a cycle, so it does not drift over long notes.
+    """
+    max_error: float
+    size: int
+
+    def __init__(self, max_error: float = 1e-6) -> None:
+        if max_error <= 0:
+            raise ValueError('max_error must be positive')
+        # Linear interpolation of sin over a step h is off by at most h**2 / 8
+        size = 2 * np.pi / np.sqrt(8 * max_error)
+        self.max_error = max_error
+        self.size = 1 << max(2, int(np.ceil(np.log2(size))))
+        table = np.sin(2 * np.pi * np.arange(self.size + 1) / self.size)
+        self._table = table[:-1]
+        self._slope = np.diff(table)
+        self._shift = np.uint64(65 - self.size.bit_length())
+
+    def __repr__(self) -> str:
+        return f'Wavetable(max_error={self.max_error!r})'
+
+    def sine(self, frequencies: List[int], samples: int, duration: float,
+             dtype: np.dtype = np.float64) -> np.ndarray:
+        cycles = np.asarray(frequencies, dtype=float) * duration
+        cycles = (cycles / max(samples, 1)) % 1.0
+        steps = (cycles * 2.0 ** 32).astype(np.uint64) << np.uint64(32)
+        steps += ((cycles * 2.0 ** 64) % 2.0 ** 32).astype(np.uint64)
+        waves = np.empty((len(steps), samples), dtype=dtype)
+        ramp = np.arange(samples, dtype=np.uint64)
+        phase = np.empty(samples, dtype=np.uint64)
+        index = np.empty(samples, dtype=np.intp)
+        mask = (np.uint64(1) << self._shift) - np.uint64(1)
+        # One row at a time keeps the temporaries small enough to stay cached
+        for step, wave in zip(steps, waves):
+            np.multiply(ramp, step, out=phase)
+            np.right_shift(phase, self._shift, out=index.view(np.uint64))
+            phase &= mask
+            wave[:] = phase
+            wave *= 2.0 ** -int(self._shift)
+            wave *= self._slope.take(index)
+            wave += self._table.take(index)
+        return waves
+
+
+_OSCILLATOR: ContextVar = ContextVar('oscillator', default=None)
+_DTYPE: ContextVar = ContextVar('dtype', default=np.dtype(np.float64))
+_RATE: ContextVar = ContextVar('sample_rate', default=_SAMPLE_RATE)
+
+
+@contextmanager
+def use_oscillator(oscillator: Optional[Wavetable]) -> None:
+    token = _OSCILLATOR.set(oscillator)
+    try:
+        yield oscillator
+    finally:
+        _OSCILLATOR.reset(token)
+
+
+@contextmanager
+def use_dtype(dtype: np.dtype) -> None:
+    token = _DTYPE.set(np.dtype(dtype))
+    try:
+        yield _DTYPE.get()
+    finally:
+        _DTYPE.reset(token)
+
+
+def sample_dtype() -> np.dtype:
+    return _DTYPE.get()
+
+
+@contextmanager
+def use_sample_rate(rate: int) -> None:
+    if rate < 1:
+        raise ValueError('the sample rate must be at least 1')
+    token = _RATE.set(int(rate))
+    try:
+        yield _RATE.get()
+    finally:
+        _RATE.reset(token)
+
+
+def sample_rate() -> int:
+    return _RATE.get()
+
+
+def synthesis_key() -> tuple:
+    return repr(_OSCILLATOR.get()), _RATE.get(), _DTYPE.get().name
+
+
+def resample(frames: np.ndarray, from_rate: int, to_rate: int) -> np.ndarray:
+    # Linear interpolation is rough, but enough to audition a preview, which
+    # has nothing above its own Nyquist frequency to alias
+    if from_rate == to_rate:
+        return frames
+    length = len(frames) * to_rate // from_rate
+    if len(frames) == 0 or length == 0:
+        return np.zeros(length, dtype=frames.dtype)
+    t = np.arange(length) * (from_rate / to_rate)
+    out = np.interp(t, np.arange(len(frames)), frames)
+    if frames.dtype.kind == 'i':
+        np.rint(out, out=out)
+    return out.astype(frames.dtype)
+
+
+def _sin_turns(turns: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    # Reducing the phase to one turn in float64 first keeps a lower precision
+    # sine accurate however many cycles the wave has
+    turns -= np.rint(turns)
+    wave = turns.astype(dtype)
+    wave *= 2 * np.pi
+    return np.sin(wave, out=wave)
+
+
 def make_sine_wave_array(frequency: int, duration: float) -> np.ndarray:
-    samples = int(_SAMPLE_RATE * duration)
+    samples = int(_RATE.get() * duration)
+    oscillator, dtype = _OSCILLATOR.get(), _DTYPE.get()
+    if oscillator is not None:
+        return oscillator.sine([frequency], samples, duration, dtype)[0]
     t = np.linspace(0, 1, samples, endpoint=False)
+    if dtype != np.float64:
+        return _sin_turns(t * (frequency * duration), dtype)
     return np.sin(2 * np.pi * frequency * t * duration)
 
+
+def make_sine_wave_matrix(frequencies: List[int],
+                          duration: float) -> np.ndarray:
+    samples = int(_RATE.get() * duration)
+    oscillator, dtype = _OSCILLATOR.get(), _DTYPE.get()
+    if oscillator is not None:
+        return oscillator.sine(frequencies, samples, duration, dtype)
+    t = np.linspace(0, 1, samples, endpoint=False)
+    frequencies = np.asarray(frequencies, dtype=float).reshape(-1, 1)
+    if dtype != np.float64:
+        return _sin_turns(frequencies * duration * t, dtype)
+    return np.sin(2 * np.pi * frequencies * t * duration)
+
+
+def make_int16_array(wave: np.ndarray,
+                     out: Optional[np.ndarray] = None) -> np.ndarray:
+    if out is None:
+        return np.ascontiguousarray(wave * _MAX_AMPLITUDE, dtype=np.int16)
+    return np.multiply(wave, _MAX_AMPLITUDE, out=out, casting='unsafe')
+
+
+class MixBus:
+    """A software mixer that sums any number of tracks into one int16 buffer,
+    to be played on a single channel.
+
+    Every track is played into a row of one reused (tracks x samples) buffer,
+    scaled by the gain of the headroom policy and truncated to int16 the way
+    make_int16_array does, and the rows are summed at once in int32. The
+    limiter policy then brings samples beyond full scale back into int16.
+
+    headroom is 'voices' to give every track 1 / max(voices, tracks) of full
+    scale, so the sum never goes beyond it, or 'fixed' to give every track
+    1 / voices of full scale however many there are, leaving the rest to the
+    limiter. With the default three voices, up to three tracks are mixed
+    exactly as three channels of 1 / 3 of full scale play them.
+
+    limiter is 'clip' to clip samples to full scale, or 'soft' to compress
+    samples beyond knee (a fraction of full scale) smoothly towards it.
+    """
+    voices: int
+    headroom: str
+    limiter: str
+    knee: float
+
+    _HEADROOMS = ('voices', 'fixed')
+    _LIMITERS = ('clip', 'soft')
+
+    def __init__(self, voices: int = _MAX_CHANNELS, headroom: str = 'voices',
+                 limiter: str = 'clip', knee: float = 0.75) -> None:
+        if voices < 1:
+            raise ValueError('voices must be at least 1')
+        if headroom not in self._HEADROOMS:
+            raise ValueError(f'headroom must be one of {self._HEADROOMS}')
+        if limiter not in self._LIMITERS:
+            raise ValueError(f'limiter must be one of {self._LIMITERS}')
+        if not 0 < knee < 1:
+            raise ValueError('knee must be between 0 and 1')
+        self.voices = voices
+        self.headroom = headroom
+        self.limiter = limiter
+        self.knee = knee
+        self._waves = None
+        self._samples = None
+        self._sum = None
+
+    def __repr__(self) -> str:
+        return (f'MixBus(voices={self.voices!r}, '
+                f'headroom={self.headroom!r}, limiter={self.limiter!r}, '
+                f'knee={self.knee!r})')
+
+    def copy(self) -> 'MixBus':
+        return MixBus(self.voices, self.headroom, self.limiter, self.knee)
+
+    def gain(self, tracks: int) -> int:
+        if self.headroom == 'voices':
+            return int(_MAX_SAMPLE / max(self.voices, tracks))
+        return int(_MAX_SAMPLE / self.voices)
+
+    def _buffers(self, tracks: int, length: int) -> tuple:
+        dtype = _DTYPE.get()
+        if (self._waves is None or self._waves.dtype != dtype
+                or self._waves.shape[0] < tracks
+                or self._waves.shape[1] < length):
+            shape = (max(tracks, 1), length)
+            if self._waves is not None:
+                shape = (max(shape[0], self._waves.shape[0]),
+                         max(shape[1], self._waves.shape[1]))
+            self._waves = np.empty(shape, dtype=dtype)
+            self._samples = np.empty(shape, dtype=np.int16)
+            self._sum = np.empty(shape[1], dtype=np.int32)
+        return (self._waves[:tracks, :length],
+                self._samples[:tracks, :length], self._sum[:length])
+
+    def mix(self, tracks: List[object],
+            out: Optional[np.ndarray] = None) -> np.ndarray:
+        # Playables that cannot say how long they are before playing, or play
+        # into a given array, are played up front and copied into the buffer
+        played = [None if hasattr(track, '_num_samples') else track.play()
+                  for track in tracks]
+        lengths = [len(array) if array is not None else track._num_samples()
+                   for track, array in zip(tracks, played)]
+        length = max(lengths, default=0)
+        if out is None:
+            out = np.empty(length, dtype=np.int16)
+        waves, samples, total = self._buffers(len(tracks), length)
+        for track, array, n, wave in zip(tracks, played, lengths, waves):
+            with span('instrument', instrument=type(track).__name__):
+                if array is None:
+                    track.play(wave[:n])
+                else:
+                    wave[:n] = array
+                wave[n:] = 0
+        with span('int16'):
+            np.multiply(waves, self.gain(len(tracks)), out=samples,
+                        casting='unsafe')
+            np.sum(samples, axis=0, dtype=np.int32, out=total)
+            self._limit(total)
+            out[:length] = total
+        return out
+
+    def _limit(self, total: np.ndarray) -> None:
+        if self.limiter == 'clip':
+            np.clip(total, -_MAX_SAMPLE, _MAX_SAMPLE, out=total)
+            return
+        knee = self.knee * _MAX_SAMPLE
+        over = np.flatnonzero(np.abs(total) > knee)
+        if len(over):
+            loud = total[over].astype(np.float64)
+            excess = (np.abs(loud) - knee) / (_MAX_SAMPLE - knee)
+            loud = np.sign(loud) * (knee + (_MAX_SAMPLE - knee)
+                                    * np.tanh(excess))
+            total[over] = loud.astype(np.int32)
@@ -10,9 +10,206 @@ new attributes, functions, classes and methods to complete your work here.
 """
 from __future__ import annotations
 import typing
+import collections
 import csv
+import hashlib
+import itertools
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import wave as wav
 import numpy
-from helpers import play_sound, play_sounds, make_sine_wave_array
+from helpers import play_sound, play_sounds, play_sound_async, \
+    play_sounds_async, make_sine_wave_array, make_sine_wave_matrix, \
+    make_int16_array, use_oscillator, Wavetable, synthesis_key, use_dtype, \
+    sample_dtype, use_sample_rate, sample_rate, resample, audio_backend, \
+    MixBus, _SAMPLE_RATE
+from render_cache import DiskCache, _parse_size, _format_size
+from playback import PlaybackEngine, render_ahead
+from tracing import span
+
+if typing.TYPE_CHECKING:
+    import argparse
+    import concurrent.futures
+
+# Duration in seconds of each piece of a StutterNote
+_STUTTER = 0.025
+# Sample rate for quick previews of a song. Partials above its Nyquist
+# frequency of 5512.5 Hz are not synthesized at all.
+PREVIEW_RATE = 11025
+# Size in bytes of the header the wave module writes before 16-bit mono frames
+_WAV_HEADER = 44
+# Layout of that header, and the length it gives when the length is unknown
+_WAV_FORMAT = struct.Struct('<4sI4s4sIHHIIHH4sI')
+_UNKNOWN_LENGTH = 0xFFFFFFFF
+# Compiled scores start with _SCORE_MAGIC, then _SCORE_HEADER holds the
+# version, beat, SHA-256 of the song file, number of notes, number of offsets
+# and length of the instrument names. Bump _SCORE_VERSION when the layout or
+# NoteTable.DTYPE changes, so old files are compiled again.
+_SCORE_MAGIC = b'NOTETBL\0'
+_SCORE_VERSION = 2
+_SCORE_HEADER = struct.Struct('<8sI4xd32sQQQ')
+_SCORE_SUFFIX = '.bin'
+# Memory a render job takes up besides its WAVE_CACHE, and the least memory
+# its WAVE_CACHE is given, in bytes
+_JOB_OVERHEAD = 32 * 2 ** 20
+_MIN_JOB_CACHE = 16 * 2 ** 20
+
+
+class WaveCache:
+    """ A least recently used cache of the numpy arrays rendered by play,
+    keyed by the type of wave and the parameters that define it.
+
+    === Attributes ===
+    max_bytes: the most memory the cached arrays may take up together.
+    hits: number of lookups that found a cached array.
+    misses: number of lookups that did not find a cached array.
+    evictions: number of arrays dropped to stay within max_bytes.
+    disk: an optional DiskCache looked up when an array is not in memory,
+        so arrays rendered by other processes can be reused.
+    _arrays: the cached arrays, least recently used first.
+    _peaks: the index of a largest absolute value in each cached array whose
+        peak has been found, as returned by _peak.
+    _nbytes: the memory the cached arrays take up together.
+    _lock: guards the cache when waves are played from several threads.
+
+    === Representation Invariants ===
+    Every cached array is read-only.
+    _nbytes <= max_bytes
+    """
+    max_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    disk: typing.Optional[DiskCache]
+    _arrays: typing.Dict[tuple, numpy.ndarray]
+    _peaks: typing.Dict[tuple, typing.Optional[int]]
+    _nbytes: int
+    _lock: threading.Lock
+
+    def __init__(self, max_bytes: int = 64 * 2 ** 20,
+                 disk: typing.Optional[DiskCache] = None) -> None:
+        """ Initializes an empty WaveCache holding up to max_bytes """
+
+        self.max_bytes = max_bytes
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.disk = disk
+        self._arrays = collections.OrderedDict()
+        self._peaks = {}
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """ Returns the number of cached arrays """
+
+        return len(self._arrays)
+
+    def nbytes(self) -> int:
+        """ Returns the memory the cached arrays take up together """
+
+        return self._nbytes
+
+    def get(self, key: tuple) -> typing.Optional[numpy.ndarray]:
+        """ Returns the array cached under key, or None if there is none.
+        NOTE: An array found in self.disk is kept in memory from then on."""
+
+        with self._lock:
+            array = self._arrays.get(key)
+            if array is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._arrays.move_to_end(key)
+
+        if array is None and self.disk is not None:
+            array = self.disk.get(key)
+            if array is not None:
+                self._store(key, array)
+
+        return array
+
+    def put(self, key: tuple, array: numpy.ndarray,
+            peak: typing.Optional[int] = None) -> numpy.ndarray:
+        """ Caches array under key, and in self.disk if there is one, and
+        returns it made read-only. peak is the index of a largest absolute
+        value in array, if it is known.
+        NOTE: The least recently used arrays are evicted until array fits. An
+        array larger than max_bytes is returned without being kept in memory.
+        """
+
+        if self.disk is not None:
+            self.disk.put(key, array)
+
+        return self._store(key, array, peak)
+
+    def peak(self, key: tuple, array: numpy.ndarray) -> typing.Optional[int]:
+        """ Returns the index of a largest absolute value in array, which is
+        cached under key, as returned by _peak.
+        NOTE: The array is only scanned if its peak was not given to put, and
+        only the first time its peak is asked for."""
+
+        with self._lock:
+            if key in self._peaks:
+                return self._peaks[key]
+
+        peak = _peak(array)
+        with self._lock:
+            if key in self._arrays:
+                self._peaks[key] = peak
+
+        return peak
+
+    def _store(self, key: tuple, array: numpy.ndarray,
+               peak: typing.Optional[int] = None) -> numpy.ndarray:
+        """ Keeps array, and peak if it is known, in memory under key and
+        returns array made read-only """
+
+        array.flags.writeable = False
+
+        with self._lock:
+            if array.nbytes > self.max_bytes or key in self._arrays:
+                return array
+            while self._nbytes + array.nbytes > self.max_bytes:
+                self._evict()
+            self._arrays[key] = array
+            self._nbytes += array.nbytes
+            if peak is not None:
+                self._peaks[key] = peak
+
+        return array
+
+    def _evict(self) -> None:
+        """ Drops the least recently used array. The caller holds _lock. """
+
+        key, array = self._arrays.popitem(last=False)
+        self._peaks.pop(key, None)
+        self._nbytes -= array.nbytes
+        self.evictions += 1
+
+    def resize(self, max_bytes: int) -> None:
+        """ Sets max_bytes, evicting the least recently used arrays until the
+        cached arrays fit in it """
+
+        with self._lock:
+            self.max_bytes = max_bytes
+            while self._nbytes > self.max_bytes:
+                self._evict()
+
+    def clear(self) -> None:
+        """ Drops every cached array and resets the counters """
+
+        with self._lock:
+            self._arrays.clear()
+            self._peaks.clear()
+            self._nbytes = 0
+            self.hits, self.misses, self.evictions = 0, 0, 0
+
+
+WAVE_CACHE = WaveCache()
 
 
 class SimpleWave:
@@ -72,23 +269,42 @@ class SimpleWave:
         """ Returns the amplitude of the SimpleWave """
         return self._amplitude
 
-    def play(self) -> numpy.ndarray:
+    def _num_samples(self) -> int:
+        """ Returns the length of the numpy array returned by play """
+        return int(sample_rate() * self._duration)
+
+    def _cache_key(self) -> typing.Optional[tuple]:
+        """ Returns the key this SimpleWave is cached under in WAVE_CACHE """
+        return ('SimpleWave', round(self._frequency), self._duration,
+                self._amplitude)
+
+    def play(self, out: numpy.ndarray = None) -> numpy.ndarray:
         """ Returns a numpy array of the SimpleWave using a helper function.
+        If out is given, the array is written into out and out is returned.
         NOTE: Amplitude of the numpy array is scaled down to
         self._get_amplitude() value in order to preserve original amplitude.
         """
+        return _play_cached(self, out)[0]
+
+    def _play_peak(self, out: numpy.ndarray = None
+                   ) -> typing.Tuple[numpy.ndarray, typing.Optional[int]]:
+        """ Returns play(out) and the index of a largest absolute value in
+        it, as returned by _peak """
+        return _play_cached(self, out)
+
+    def _render(self, out: numpy.ndarray = None
+                ) -> typing.Tuple[numpy.ndarray, typing.Optional[int]]:
+        """ Synthesizes the numpy array returned by play, and returns it
+        with the index of a largest absolute value in it """
         array = make_sine_wave_array(round(self._frequency), self._duration)
-        array1 = numpy.absolute(array)
-
-        if len(array1) == 0:
-            abs_max = 0
-        else:
-            abs_max = array1.max()
+        peak = _peak(array)
+        abs_max = _peak_value(array, peak)
 
         if abs_max != 0:
-            return array * (self._get_amplitude() / abs_max)
+            return numpy.multiply(array, self._get_amplitude() / abs_max,
+                                  out=out), peak
         else:
-            return array * 0
+            return numpy.multiply(array, 0, out=out), peak
 
 
 class ComplexWave:
@@ -143,39 +359,98 @@ class ComplexWave:
 
         return len(self._waves)
 
-    def play(self) -> numpy.ndarray:
+    def _num_samples(self) -> int:
+        """ Returns the length of the numpy array returned by play """
+
+        return max([wave._num_samples() for wave in self._waves], default=0)
+
+    def _cache_key(self) -> typing.Optional[tuple]:
+        """ Returns the key this ComplexWave is cached under in WAVE_CACHE,
+        or None if it is made of anything other than SimpleWaves """
+
+        if any(type(wave) is not SimpleWave for wave in self._waves):
+            return None
+
+        return ('ComplexWave', self._amplitude,
+                tuple(wave._cache_key() for wave in self._waves))
+
+    def play(self, out: numpy.ndarray = None) -> numpy.ndarray:
         """ Returns a numpy array of the ComplexWave which combines all
-        the SimpleWaves that make up the ComplexWave
+        the SimpleWaves that make up the ComplexWave.
+        If out is given, the array is written into out and out is returned.
 
         NOTE: Amplitude of the numpy array is scaled down to
         self._get_amplitude() value in order to preserve original amplitude.
         """
 
-        sum_array = numpy.array([])
-        for array in self._waves:
-            array = array.play()
-            if len(array) > len(sum_array):
-                sum_array = array[:len(sum_array)] + sum_array
-                sum_array = numpy.append(sum_array, array[len(sum_array):])
-            elif len(array) < len(sum_array):
-                array = sum_array[:len(array)] + array
-                array = numpy.append(array, sum_array[len(array):])
-                sum_array = array
-            else:
-                sum_array = sum_array + array
-
-        array = numpy.absolute(sum_array)
-        amplitude = self._get_amplitude()
-
-        if len(array) == 0:
-            abs_max = 0
-        else:
-            abs_max = array.max()
-
-        if abs_max != 0:
-            return sum_array * (amplitude / abs_max)
-        else:
-            return sum_array
+        return _play_cached(self, out)[0]
+
+    def _play_peak(self, out: numpy.ndarray = None
+                   ) -> typing.Tuple[numpy.ndarray, typing.Optional[int]]:
+        """ Returns play(out) and the index of a largest absolute value in
+        it, as returned by _peak """
+
+        return _play_cached(self, out)
+
+    def _render(self, out: numpy.ndarray = None
+                ) -> typing.Tuple[numpy.ndarray, typing.Optional[int]]:
+        """ Synthesizes the numpy array returned by play, and returns it
+        with the index of a largest absolute value in it """
+
+        if out is None:
+            out = numpy.empty(self._num_samples(), dtype=sample_dtype())
+        sum_array = self._sum_waves(out)
+
+        return sum_array, _normalize(sum_array, self._get_amplitude(),
+                                     _peak(sum_array))
+
+    def _sum_waves(self, out: numpy.ndarray) -> numpy.ndarray:
+        """ Writes the sum of the numpy arrays of every wave in self._waves
+        into out and returns it.
+
+        NOTE: The waves are merged by _merge_partials first, and silent
+        SimpleWaves are not synthesized at all. SimpleWaves sharing a duration
+        are synthesized together as one (waves x samples) array instead of one
+        make_sine_wave_array call each, straight from their frequencies and
+        amplitudes. The result is the same as adding up every wave's play() in
+        order, up to rounding."""
+
+        partials = _merge_partials(self._parts())
+        arrays, groups = [None] * len(partials), {}
+
+        for i, part in enumerate(partials):
+            if type(part) is not tuple:
+                arrays[i] = part.play()
+            elif part[2] != 0:
+                groups.setdefault(part[1], []).append(i)
+
+        for duration, indices in groups.items():
+            parts = [partials[i] for i in indices]
+            rows = make_sine_wave_matrix([f for f, _, _ in parts], duration)
+            if rows.shape[1] != 0:
+                abs_max = numpy.maximum(rows.max(axis=1), -rows.min(axis=1))
+                amplitude = numpy.array([a for _, _, a in parts])
+                scale = numpy.zeros(len(parts))
+                numpy.divide(amplitude, abs_max, out=scale,
+                             where=abs_max != 0)
+                rows *= scale.reshape(-1, 1)
+            for i, row in zip(indices, rows):
+                arrays[i] = row
+
+        out[:] = 0
+        for array in arrays:
+            if array is not None:
+                out[:len(array)] += array
+
+        return out
+
+    def _parts(self) -> list:
+        """ Returns the waves of this ComplexWave, with every SimpleWave given
+        as a (rounded frequency, duration, amplitude) tuple instead """
+
+        return [(round(wave._frequency), wave.get_duration(),
+                 wave._get_amplitude()) if type(wave) is SimpleWave else wave
+                for wave in self._waves]
 
     def get_waves(self) -> typing.List[SimpleWave]:
         """ Returns the list of SimpleWaves that makes up this ComplexWave"""
@@ -194,10 +469,16 @@ class ComplexWave:
         return self._amplitude
 
     def simplify(self) -> None:
-        """ TODO: write a docstring for this method
-            REMEMBER: this is not a required part of the assignment
-        """
-        pass  # TODO: finish this method body
+        """ Merges the SimpleWaves of this ComplexWave that have the same
+        frequency and duration into one SimpleWave, and removes the ones that
+        are silent or at or above the Nyquist frequency.
+        NOTE: The merged SimpleWave's amplitude is the sum of the amplitudes
+        it replaces, even if that is greater than 1, and self._amplitude is
+        left as it is, so play returns the same array as before (up to
+        rounding) with fewer sine waves to synthesize."""
+
+        self._waves = [_part_wave(part)
+                       for part in _merge_partials(self._parts())]
 
 
 class Note:
@@ -252,112 +533,171 @@ class Note:
 
         return self.amplitude
 
-    def play(self) -> numpy.ndarray:
+    def _num_samples(self) -> int:
+        """ Returns the length of the numpy array returned by play """
+
+        return sum(wave._num_samples() for wave in self._waves)
+
+    def _cache_key(self) -> typing.Optional[tuple]:
+        """ Returns the key this Note is cached under in WAVE_CACHE, or None
+        if it is not cached """
+
+        return None
+
+    def play(self, out: numpy.ndarray = None) -> numpy.ndarray:
         """ Returns a numpy array in which each of the Note's component waves
         are played in order.
+        If out is given, the array is written into out and out is returned.
 
         NOTE: Amplitude of the numpy array is scaled down to
         self._get_amplitude() value in order to preserve original amplitude.
         """
 
-        n = numpy.array([])
+        return _play_cached(self, out)[0]
 
-        for wave in self._waves:
-            n = numpy.append(n, wave.play())
+    def _play_peak(self, out: numpy.ndarray = None
+                   ) -> typing.Tuple[numpy.ndarray, typing.Optional[int]]:
+        """ Returns play(out) and the index of a largest absolute value in
+        it, as returned by _peak """
 
-        array = numpy.absolute(n)
+        return _play_cached(self, out)
 
-        if len(array) == 0:
-            abs_max = 0
-        else:
-            abs_max = array.max()
+    def _render(self, out: numpy.ndarray = None
+                ) -> typing.Tuple[numpy.ndarray, typing.Optional[int]]:
+        """ Synthesizes the numpy array returned by play, and returns it
+        with the index of a largest absolute value in it """
 
-        if abs_max != 0:
-            return n * (self._get_amplitude() / abs_max)
-        else:
-            return n
+        return _play_in_order(self._waves, self._get_amplitude(),
+                              self._num_samples(), out)
 
 
-class SawtoothWave(ComplexWave):
-    """ A  SawtoothWave is wave composed of an
-    infinite number of components which follow a pattern.
+class _HarmonicWave(ComplexWave):
+    """ A ComplexWave made of one SimpleWave at each of a fixed set of
+    multiples of its frequency, with amplitudes falling off as 1 / multiple.
+
+    Only the frequency, duration and amplitude are stored. The SimpleWaves
+    are built the first time they are asked for, through get_waves or
+    self._waves; play synthesizes straight from the parameters and never
+    builds them.
 
     === Attributes ===
     _frequency: frequency of the wave in Hz.
     _duration: duration of the wave in seconds.
     _amplitude: amplitude of the wave.
-    _waves: A list of simple waves which make up the SawtoothWave wave
-
-    === Representation Invariants ==
-    NOTE: Amplitude of the numpy array is scaled down to
-        self._get_amplitude() value in order to preserve original amplitude.
+    _built: the SimpleWaves which make up this wave, or None if they have not
+        been built yet.
+    _harmonics: the multiples of _frequency of its SimpleWaves, in order.
     """
     # Attribute types
 
     _frequency: int
     _duration: float
     _amplitude: float
-    _waves: typing.List[SimpleWave]
+    _built: typing.Optional[typing.List[ANYWAVE]]
+    _harmonics: typing.Tuple[int, ...] = ()
 
     def __init__(self, frequency: int,
                  duration: float, amplitude: float) -> None:
-        """ Initializes an instance of class SawtoothWave
+        """ Initializes an instance of a _HarmonicWave
         NOTE: If amplitude is greater than 1, it is stored as 1"""
 
-        waves, components = [], 10
-
         if amplitude > 1:
             amplitude = 1
 
-        for component in range(1, components + 1):
-            waves.append(SimpleWave(((2 * component) - 1) * frequency,
-                                    duration,
-                                    amplitude / ((2 * component) - 1)))
-
-        ComplexWave.__init__(self, waves)
         self._frequency = frequency
+        self._duration = max(duration, 0)
         self._amplitude = amplitude
+        self._built = None
 
+    @property
+    def _waves(self) -> typing.List[ANYWAVE]:
+        """ The waves which make up this wave, built on first use """
 
-class SquareWave(ComplexWave):
-    """ A  SquareWave is wave composed of an
-    infinite number of components which follow a pattern.
+        if self._built is None:
+            self._built = [SimpleWave(m * self._frequency, self._duration,
+                                      self._amplitude / m)
+                           for m in self._harmonics]
+
+        return self._built
+
+    @_waves.setter
+    def _waves(self, waves: typing.List[ANYWAVE]) -> None:
+        """ Replaces the waves which make up this wave """
+
+        self._built = waves
+
+    def complexity(self) -> int:
+        """ Returns the number of SimpleWaves that make up this wave """
+
+        if self._built is None:
+            return len(self._harmonics)
+
+        return len(self._built)
+
+    def _num_samples(self) -> int:
+        """ Returns the length of the numpy array returned by play """
+
+        if self._built is None:
+            return int(sample_rate() * self._duration)
+
+        return ComplexWave._num_samples(self)
+
+    def _cache_key(self) -> typing.Optional[tuple]:
+        """ Returns the key this wave is cached under in WAVE_CACHE """
+
+        if self._built is not None:
+            return ComplexWave._cache_key(self)
+
+        return (type(self).__name__, self._frequency, self._duration,
+                self._amplitude)
+
+    def _parts(self) -> list:
+        """ Returns the partials of this wave as (rounded frequency, duration,
+        amplitude) tuples, without building its SimpleWaves """
+
+        if self._built is not None:
+            return ComplexWave._parts(self)
+
+        return [(round(m * self._frequency), self._duration,
+                 self._amplitude / m) for m in self._harmonics]
+
+
+class SawtoothWave(_HarmonicWave):
+    """ A  SawtoothWave is wave composed of an
+    infinite number of components which follow a pattern. It is approximated
+    by its first 10 odd harmonics.
 
     === Attributes ===
     _frequency: frequency of the wave in Hz.
     _duration: duration of the wave in seconds.
     _amplitude: amplitude of the wave.
-    _waves: A list of simple waves which make up the SquareWave wave
+    _waves: A list of simple waves which make up the SawtoothWave wave,
+        built the first time it is used.
 
     === Representation Invariants ==
     NOTE: Amplitude of the numpy array is scaled down to
         self._get_amplitude() value in order to preserve original amplitude.
     """
-    # Attribute types
+    _harmonics = tuple(range(1, 20, 2))
 
-    _frequency: int
-    _duration: float
-    _amplitude: float
-    _waves: typing.List[SimpleWave]
-
-    def __init__(self, frequency: int,
-                 duration: float, amplitude: float) -> None:
-        """Initializes an instance of class SquareWave
-        NOTE: If amplitude is greater than 1, it is stored as 1"""
-
-        waves, components = [], 10
 
-        if amplitude > 1:
-            amplitude = 1
+class SquareWave(_HarmonicWave):
+    """ A  SquareWave is wave composed of an
+    infinite number of components which follow a pattern. It is approximated
+    by its first 10 harmonics.
 
-        for component in range(1, components + 1):
-            waves.append(SimpleWave(component * frequency,
-                                    duration,
-                                    amplitude / component))
+    === Attributes ===
+    _frequency: frequency of the wave in Hz.
+    _duration: duration of the wave in seconds.
+    _amplitude: amplitude of the wave.
+    _waves: A list of simple waves which make up the SquareWave wave,
+        built the first time it is used.
 
-        ComplexWave.__init__(self, waves)
-        self._frequency = frequency
-        self._amplitude = amplitude
+    === Representation Invariants ==
+    NOTE: Amplitude of the numpy array is scaled down to
+        self._get_amplitude() value in order to preserve original amplitude.
+    """
+    _harmonics = tuple(range(1, 11))
 
 
 class Rest(ComplexWave):
@@ -391,20 +731,58 @@ class Rest(ComplexWave):
         else:
             return ComplexWave([self] + other.get_waves())
 
-    def play(self) -> numpy.ndarray:
-        """ Returns a numpy array modeling this rest period """
+    def play(self, out: numpy.ndarray = None) -> numpy.ndarray:
+        """ Returns a numpy array modeling this rest period.
+        If out is given, the array is written into out and out is returned."""
+
+        return self._play_peak(out)[0]
+
+    def _play_peak(self, out: numpy.ndarray = None
+                   ) -> typing.Tuple[numpy.ndarray, typing.Optional[int]]:
+        """ Returns play(out) and None, as this rest period has no peak """
+
+        return numpy.multiply(make_sine_wave_array(round(self._frequency),
+                                                   self._duration), 0,
+                              out=out), None
+
+
+def _stutter_pieces(duration: float) -> typing.Tuple[int, float, float]:
+    """ Returns the number of _STUTTER long pieces a StutterNote of duration
+    is cut into, the length of the shorter piece left over at its end (0 if
+    there is none) and the duration of all of them together """
+
+    cur, i = 0, 0
+
+    while (_STUTTER + cur) <= duration:
+        i += 1
+        cur += _STUTTER
+
+    tail = 0
+    if cur < duration and duration - cur > 0.0001:
+        tail = duration - cur
+        cur += tail
 
-        return make_sine_wave_array(round(self._frequency), self._duration) * 0
+    return i, tail, cur
 
 
 class StutterNote(Note):
     """ A StutterNote is a note which alternates between Rest and SawtoothWave
 
+    Only the pattern of pieces is stored. The Rests and SawtoothWaves are
+    built the first time they are asked for, through get_waves or
+    self._waves; play writes every piece straight into the array instead.
+
     === Attributes ===
-    _waves: A list of simple waves which make up the StutterNote
+    _waves: A list of simple waves which make up the StutterNote, built the
+        first time it is used.
     amplitude: Amplitude of the StutterNote.
     _duration: Total duration of StutterNote
     _frequency: Initial frequency of StutterNote
+    _built: the waves which make up the StutterNote, or None if they have not
+        been built yet.
+    _pieces: the number of pieces of _STUTTER seconds, starting with a Rest.
+    _tail: the duration of the shorter last piece, or 0 if there is none.
+    _saw_amplitude: the amplitude the SawtoothWaves are built with.
 
     === Representation Invariants ==
     NOTE: Amplitude of the numpy array is scaled down to
@@ -415,30 +793,104 @@ class StutterNote(Note):
     amplitude: float
     _duration: float
     _frequency: int
+    _built: typing.Optional[typing.List[ANYWAVE]]
+    _pieces: int
+    _tail: float
+    _saw_amplitude: float
 
     def __init__(self, frequency: int,
                  duration: float, amplitude: float) -> None:
         """ Initializes an instance of class StutterNote """
 
-        cur, i, waves = 0, 0, []
+        self._pieces, self._tail, cur = _stutter_pieces(duration)
 
-        while (0.025 + cur) <= duration:
-            if i % 2 == 1:
-                waves.append(SawtoothWave(frequency, 0.025, amplitude))
-            else:
-                waves.append(Rest(0.025))
+        self._built = None
+        self._duration = cur
+        self._frequency = frequency
+        self._saw_amplitude = amplitude
+        self.amplitude = amplitude
 
-            i += 1
-            cur += 0.025
+    @property
+    def _waves(self) -> typing.List[ANYWAVE]:
+        """ The waves which make up this StutterNote, built on first use """
 
-        if cur < duration and i % 2 == 1 and duration - cur > 0.0001:
-            waves.append(SawtoothWave(frequency, duration - cur, amplitude))
-        elif cur < duration and i % 2 == 0 and duration - cur > 0.0001:
-            waves.append(Rest(duration - cur))
+        if self._built is None:
+            self._built = [
+                SawtoothWave(self._frequency, _STUTTER, self._saw_amplitude)
+                if i % 2 == 1 else Rest(_STUTTER)
+                for i in range(self._pieces)]
+            if self._tail and self._pieces % 2 == 1:
+                self._built.append(SawtoothWave(self._frequency, self._tail,
+                                                self._saw_amplitude))
+            elif self._tail:
+                self._built.append(Rest(self._tail))
 
-        Note.__init__(self, waves)
-        self._frequency = frequency
-        self.amplitude = amplitude
+        return self._built
+
+    @_waves.setter
+    def _waves(self, waves: typing.List[ANYWAVE]) -> None:
+        """ Replaces the waves which make up this StutterNote """
+
+        self._built = waves
+
+    def _num_samples(self) -> int:
+        """ Returns the length of the numpy array returned by play """
+
+        if self._built is not None:
+            return Note._num_samples(self)
+
+        return (self._pieces * int(sample_rate() * _STUTTER)
+                + int(sample_rate() * self._tail))
+
+    def _cache_key(self) -> typing.Optional[tuple]:
+        """ Returns the key this StutterNote is cached under in WAVE_CACHE.
+        NOTE: The amplitude the SawtoothWaves were built with is part of the
+        key because self.amplitude can be changed after initialization."""
+
+        if self._built is not None:
+            a = max([wave._get_amplitude() for wave in self._built],
+                    default=0)
+        else:
+            saws = self._pieces >= 2 or (self._tail and self._pieces % 2)
+            rests = self._pieces >= 1 or self._tail
+            a = max([0] * bool(rests) + [min(self._saw_amplitude, 1)]
+                    * bool(saws), default=0)
+
+        return ('StutterNote', self._frequency, self._duration,
+                self.amplitude, a)
+
+    def _render(self, out: numpy.ndarray = None
+                ) -> typing.Tuple[numpy.ndarray, typing.Optional[int]]:
+        """ Synthesizes the numpy array returned by play, and returns it
+        with the index of a largest absolute value in it.
+        NOTE: Every full SawtoothWave piece is the same, so it is synthesized
+        once and copied into every other piece of out."""
+
+        if self._built is not None:
+            return Note._render(self, out)
+
+        if out is None:
+            out = numpy.empty(self._num_samples(), dtype=sample_dtype())
+        n = int(sample_rate() * _STUTTER)
+        pieces = out[:self._pieces * n].reshape(self._pieces, n)
+        peak = None
+
+        pieces[0::2] = 0
+        if self._pieces >= 2:
+            saw, index = SawtoothWave(self._frequency, _STUTTER,
+                                      self._saw_amplitude)._play_peak()
+            pieces[1::2] = saw
+            peak = None if index is None else n + index
+        if self._tail and self._pieces % 2 == 1:
+            _, index = SawtoothWave(self._frequency, self._tail,
+                                    self._saw_amplitude)._play_peak(
+                out[self._pieces * n:])
+            if index is not None:
+                peak = _louder(out, peak, self._pieces * n + index)
+        else:
+            out[self._pieces * n:] = 0
+
+        return out, _normalize(out, self._get_amplitude(), peak)
 
 
 class Baliset:
@@ -508,60 +960,40 @@ class Baliset:
         than 1
         """
 
-        self._waves, i, d, duration, n_i, n_f = [], 0, 0, None, note_info, 0
-
-        if len(n_i) >= 1:
-            duration = n_i[i][2]
+        self._set_notes(_parse_notes(note_info))
+        self._next_notes = note_info
 
-        while duration and i < len(n_i) and d + duration <= 1:
-            ratio = list(n_i[i][0].strip().split(':'))
-            ratio[0], ratio[1] = ratio[0].strip(), ratio[1].strip()
+    def _set_notes(self, notes: typing.Sequence[tuple]) -> None:
+        """ Stores the next notes for this Baliset, each given as a
+        (numerator, denominator, amplitude, duration) tuple """
 
-            if int(ratio[0]) != 0 and int(ratio[1]) != 0:
-                n_f = int(int(ratio[0]) / int(ratio[1]) * self._frequency)
-                self._waves.append(SawtoothWave(n_f, n_i[i][2], n_i[i][1]))
-            else:
-                self._waves.append(SawtoothWave(0, n_i[i][2], 0))
+        self._waves = _bar_waves(notes, self._frequency, SawtoothWave,
+                                 SawtoothWave)
+        self._duration = self.get_duration()
 
-            d += duration
-            i += 1
-            if i < len(n_i):
-                duration = n_i[i][2]
+    @staticmethod
+    def _note_samples(duration: float) -> int:
+        """ Returns the number of samples a Baliset plays for a note of
+        duration, without building its wave """
 
-        if not duration:
-            self._waves.append(Rest(1))
+        return int(sample_rate() * duration)
 
-        elif d < 1 and i < len(n_i):
-            a, d = n_i[i][1], 1 - d
-            self._waves.append(SawtoothWave(n_f, d, a))
+    def _num_samples(self) -> int:
+        """ Returns the length of the numpy array returned by play """
 
-        self._duration = self.get_duration()
-        self._next_notes = note_info
+        return sum(wave._num_samples() for wave in self._waves)
 
-    def play(self) -> numpy.ndarray:
+    def play(self, out: numpy.ndarray = None) -> numpy.ndarray:
         """ Returns a numpy array in which each of the Note's component waves
         are played in order.
+        If out is given, the array is written into out and out is returned.
 
         NOTE: Amplitude of the numpy array is scaled down to
         self._get_amplitude() value in order to preserve original amplitude.
         """
 
-        n = numpy.array([])
-
-        for wave in self._waves:
-            n = numpy.append(n, wave.play())
-
-        array = numpy.absolute(n)
-
-        if len(array) == 0:
-            abs_max = 0
-        else:
-            abs_max = array.max()
-
-        if abs_max != 0:
-            return n * (self._get_amplitude() / abs_max)
-        else:
-            return n
+        return _play_in_order(self._waves, self._get_amplitude(),
+                              self._num_samples(), out)[0]
 
 
 class Holophonor:
@@ -627,60 +1059,43 @@ class Holophonor:
         will partially store the wave that makes it have duration of greater
         than 1"""
 
-        self._waves, i, d, duration, n_i, n_f = [], 0, 0, None, note_info, 0
+        self._set_notes(_parse_notes(note_info))
+        self._next_notes = note_info
 
-        if len( n_i) >= 1:
-            duration = n_i[i][2]
+    def _set_notes(self, notes: typing.Sequence[tuple]) -> None:
+        """ Stores the next notes for this Holophonor, each given as a
+        (numerator, denominator, amplitude, duration) tuple """
 
-        while duration and i < len(n_i) and d + duration <= 1:
-            ratio = list(n_i[i][0].strip().split(':'))
-            ratio[0], ratio[1] = ratio[0].strip(), ratio[1].strip()
+        self._waves = _bar_waves(notes, self._frequency, StutterNote,
+                                 StutterNote)
+        self._duration = self.get_duration()
 
-            if int(ratio[0]) != 0 and int(ratio[1]) != 0:
-                n_f = int(int(ratio[0]) / int(ratio[1]) * self._frequency)
-                self._waves.append(StutterNote(n_f, n_i[i][2], n_i[i][1]))
-            else:
-                self._waves.append(StutterNote(0, n_i[i][2], 0))
+    @staticmethod
+    def _note_samples(duration: float) -> int:
+        """ Returns the number of samples a Holophonor plays for a note of
+        duration, without building its wave """
 
-            d += duration
-            i += 1
-            if i < len(n_i):
-                duration = n_i[i][2]
+        pieces, tail, _ = _stutter_pieces(duration)
 
-        if not duration:
-            self._waves.append(Rest(1))
+        return (pieces * int(sample_rate() * _STUTTER)
+                + int(sample_rate() * tail))
 
-        elif d < 1 and i < len(n_i):
-            a, d = n_i[i][1], 1 - d
-            self._waves.append(StutterNote(n_f, d, a))
+    def _num_samples(self) -> int:
+        """ Returns the length of the numpy array returned by play """
 
-        self._duration = self.get_duration()
-        self._next_notes = note_info
+        return sum(wave._num_samples() for wave in self._waves)
 
-    def play(self) -> numpy.ndarray:
+    def play(self, out: numpy.ndarray = None) -> numpy.ndarray:
         """ Returns a numpy array in which each of the Note's component waves
         are played in order.
+        If out is given, the array is written into out and out is returned.
 
         NOTE: Amplitude of the numpy array is scaled down to
         self._get_amplitude() value in order to preserve original amplitude.
         """
 
-        n = numpy.array([])
-
-        for wave in self._waves:
-            n = numpy.append(n, wave.play())
-
-        array = numpy.absolute(n)
-
-        if len(array) == 0:
-            abs_max = 0
-        else:
-            abs_max = array.max()
-
-        if abs_max != 0:
-            return n * (self._get_amplitude() / abs_max)
-        else:
-            return n
+        return _play_in_order(self._waves, self._get_amplitude(),
+                              self._num_samples(), out)[0]
 
 
 class Gaffophone:
@@ -747,63 +1162,507 @@ class Gaffophone:
         will partially store the wave that makes it have duration of greater
         than 1"""
 
-        self._waves, i, d, duration, n_i, n_f = [], 0, 0, None, note_info, 0
-
-        if len(n_i) >= 1:
-            duration = n_i[i][2]
+        self._set_notes(_parse_notes(note_info))
+        self._next_notes = note_info
 
-        while duration and i < len(n_i) and d + duration <= 1:
-            ratio = list(n_i[i][0].strip().split(':'))
-            ratio[0], ratio[1] = ratio[0].strip(), ratio[1].strip()
+    def _set_notes(self, notes: typing.Sequence[tuple]) -> None:
+        """ Stores the next notes for this Gaffophone, each given as a
+        (numerator, denominator, amplitude, duration) tuple """
 
-            if int(ratio[0]) != 0 and int(ratio[1]) != 0:
-                n_f = int(int(ratio[0]) / int(ratio[1]) * self._frequency)
-                self._waves.append(SquareWave(n_f, n_i[i][2], n_i[i][1]) +
-                                   SquareWave(int(n_f * (3 / 2)), n_i[i][2],
-                                              n_i[i][1]))
-            else:
-                self._waves.append(SquareWave(0, n_i[i][2], 0))
+        self._waves = _bar_waves(notes, self._frequency, _gaffophone_wave,
+                                 SquareWave)
+        self._duration = self.get_duration()
 
-            d += duration
-            i += 1
-            if i < len(n_i):
-                duration = n_i[i][2]
+    @staticmethod
+    def _note_samples(duration: float) -> int:
+        """ Returns the number of samples a Gaffophone plays for a note of
+        duration, without building its wave """
 
-        if not duration:
-            self._waves.append(Rest(1))
+        return int(sample_rate() * duration)
 
-        elif d < 1 and i < len(n_i):
-            a, d = n_i[i][1], 1 - d
-            self._waves.append(SquareWave(n_f, d, a) +
-                               SquareWave(int(n_f * (3 / 2)), d, a))
+    def _num_samples(self) -> int:
+        """ Returns the length of the numpy array returned by play """
 
-        self._duration = self.get_duration()
-        self._next_notes = note_info
+        return sum(wave._num_samples() for wave in self._waves)
 
-    def play(self) -> numpy.ndarray:
+    def play(self, out: numpy.ndarray = None) -> numpy.ndarray:
         """ Returns a numpy array in which each of the Note's component waves
         are played in order.
+        If out is given, the array is written into out and out is returned.
 
         NOTE: Amplitude of the numpy array is scaled down to
         self._get_amplitude() value in order to preserve original amplitude.
         """
 
-        n = numpy.array([])
+        return _play_in_order(self._waves, self._get_amplitude(),
+                              self._num_samples(), out)[0]
 
-        for wave in self._waves:
-            n = numpy.append(n, wave.play())
 
-        array = numpy.absolute(n)
+class NoteTable:
+    """ A NoteTable is the score of a whole song, stored column by column in
+    one numpy structured array with a row for every note of every bar.
 
-        if len(array) == 0:
-            abs_max = 0
+    === Attributes ===
+    instruments: the names of the song's instruments, in song order.
+    notes: the notes of the song ordered by bar, then instrument, then start,
+        with the fields:
+        instrument: index of the note's instrument in instruments.
+        bar: index of the one-second bar the note is played in.
+        start: offset of the note from the start of its bar in seconds.
+        numerator, denominator: ratio of the note's frequency to the
+            instrument's fundamental frequency.
+        frequency: frequency the note is played at in Hz, or 0 if its ratio
+            has a zero in it.
+        amplitude: amplitude of the note.
+        duration: duration of the note in seconds.
+    _offsets: index in notes of the first row of every bar of every
+        instrument, bar by bar, followed by len(notes).
+
+    === Representation Invariants ===
+    Every instrument has at least one note in every bar.
+    """
+    instruments: typing.List[str]
+    notes: numpy.ndarray
+    _offsets: numpy.ndarray
+
+    DTYPE = numpy.dtype([('instrument', numpy.uint16), ('bar', numpy.uint32),
+                         ('start', numpy.float64),
+                         ('numerator', numpy.int32),
+                         ('denominator', numpy.int32),
+                         ('frequency', numpy.int32),
+                         ('amplitude', numpy.float64),
+                         ('duration', numpy.float64)])
+
+    def __init__(self, instruments: typing.List[str],
+                 notes: numpy.ndarray,
+                 offsets: typing.Optional[numpy.ndarray] = None) -> None:
+        """ Initializes a NoteTable of instruments playing notes, a
+        structured array of dtype NoteTable.DTYPE. offsets are worked out
+        from notes unless they are given. """
+
+        self.instruments = instruments
+        self.notes = notes
+        if offsets is None:
+            cells = notes['bar'].astype(numpy.int64) * len(instruments)
+            cells += notes['instrument']
+            offsets = numpy.searchsorted(
+                cells, numpy.arange(self.num_bars() * len(instruments) + 1))
+        self._offsets = offsets
+
+    @classmethod
+    def from_song(cls, song_file: str, beat: float) -> NoteTable:
+        """ Returns the NoteTable of the given song pieces at a given beat.
+        Its bars are the same as the columns of _iter_song. """
+
+        with open(song_file) as song:
+            first = _read_header(song)
+            bases = [_new_instrument(name)._frequency for name in first]
+            rows = []
+            for bar, column in enumerate(_iter_bars(song, first, beat)):
+                for instr_i, notes in enumerate(column):
+                    start = 0.0
+                    for f, a, d in notes:
+                        numerator, denominator = _parse_ratio(f)
+                        frequency = 0
+                        if numerator != 0 and denominator != 0:
+                            frequency = int(numerator / denominator *
+                                            bases[instr_i])
+                        rows.append((instr_i, bar, start, numerator,
+                                     denominator, frequency, a, d))
+                        start += d
+
+        return cls(first, numpy.array(rows, dtype=cls.DTYPE))
+
+    @classmethod
+    def load(cls, path: str, beat: float,
+             digest: bytes) -> typing.Optional[NoteTable]:
+        """ Returns the NoteTable saved at path, with its arrays memory-mapped
+        read-only, or None if there is no such file, it was saved by another
+        version, at another beat or from a song file whose SHA-256 was not
+        digest, or it is not as long as its header says it is. """
+
+        try:
+            with open(path, 'rb') as file:
+                header = file.read(_SCORE_HEADER.size)
+                if len(header) < _SCORE_HEADER.size:
+                    return None
+                magic, version, saved_beat, saved_digest, num_notes, \
+                    num_offsets, names = _SCORE_HEADER.unpack(header)
+                if (magic, version, saved_beat, saved_digest) != (
+                        _SCORE_MAGIC, _SCORE_VERSION, beat, digest):
+                    return None
+                instruments = file.read(names).decode().split(',')
+                size = os.fstat(file.fileno()).st_size
+        except (OSError, UnicodeDecodeError):
+            return None
+
+        start = _SCORE_HEADER.size + -(-names // 8) * 8
+        if size != start + num_offsets * 8 + num_notes * cls.DTYPE.itemsize:
+            return None
+
+        try:
+            offsets = _map_array(path, '<i8', start, num_offsets)
+            notes = _map_array(path, cls.DTYPE.newbyteorder('<'),
+                               start + offsets.nbytes, num_notes)
+        except (OSError, ValueError):
+            return None
+
+        return cls(instruments if names else [], notes, offsets)
+
+    def save(self, path: str, beat: float, digest: bytes) -> None:
+        """ Saves this NoteTable at path, as read from a song file whose
+        SHA-256 is digest at the given beat.
+        NOTE: The file is replaced atomically, so load never sees a partially
+        written one."""
+
+        names = ','.join(self.instruments).encode()
+        header = _SCORE_HEADER.pack(
+            _SCORE_MAGIC, _SCORE_VERSION, beat, digest, len(self.notes),
+            len(self._offsets), len(names))
+        fd, temp = tempfile.mkstemp(
+            suffix='.tmp', dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(header)
+                file.write(names.ljust(-(-len(names) // 8) * 8, b'\0'))
+                file.write(self._offsets.astype('<i8').tobytes())
+                file.write(self.notes.astype(
+                    self.DTYPE.newbyteorder('<')).tobytes())
+            os.replace(temp, path)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+    def __len__(self) -> int:
+        """ Returns the number of notes in this NoteTable """
+
+        return len(self.notes)
+
+    def num_bars(self) -> int:
+        """ Returns the number of bars in this NoteTable """
+
+        if len(self.notes) == 0:
+            return 0
+
+        return int(self.notes['bar'][-1]) + 1
+
+    def nbytes(self) -> int:
+        """ Returns the memory taken up by the arrays of this NoteTable """
+
+        return self.notes.nbytes + self._offsets.nbytes
+
+    def bar(self, bar: int, instrument: int) -> numpy.ndarray:
+        """ Returns the rows of notes instrument plays in bar """
+
+        cell = bar * len(self.instruments) + instrument
+
+        return self.notes[self._offsets[cell]:self._offsets[cell + 1]]
+
+    def select_bars(self, start: int, stop: int) -> NoteTable:
+        """ Returns a NoteTable of bars start up to stop of this one, numbered
+        from 0 """
+
+        n, stop = len(self.instruments), min(stop, self.num_bars())
+        notes = self.notes[self._offsets[start * n]:self._offsets[stop * n]]
+        notes = notes.copy()
+        notes['bar'] -= start
+
+        return NoteTable(self.instruments, notes)
+
+    def column(self, bar: int) -> list:
+        """ Returns the instruments that play bar, one per song instrument,
+        the same as the column of _iter_song for that bar """
+
+        column = []
+        for instr_i, name in enumerate(self.instruments):
+            rows = self.bar(bar, instr_i)
+            playable = _new_instrument(name)
+            playable._set_notes(
+                rows[['numerator', 'denominator', 'amplitude',
+                      'duration']].tolist())
+            column.append(playable)
+
+        return column
+
+    def bar_samples(self) -> numpy.ndarray:
+        """ Returns the number of samples each column of this NoteTable plays,
+        the longest of its instruments, worked out from the durations of their
+        notes without building any wave """
+
+        n, offsets = len(self.instruments), self._offsets.tolist()
+        kinds = [type(_new_instrument(name)) for name in self.instruments]
+        durations = self.notes['duration'].tolist()
+
+        samples = numpy.zeros((self.num_bars(), n), dtype=numpy.int64)
+        for cell in range(self.num_bars() * n):
+            kind = kinds[cell % n]
+            samples[cell // n, cell % n] = sum(
+                int(sample_rate() * duration) if i is None
+                else kind._note_samples(duration)
+                for i, duration, _ in _bar_pieces(
+                    durations[offsets[cell]:offsets[cell + 1]]))
+
+        return samples.max(axis=1, initial=0)
+
+    def columns(self) -> typing.Iterator[list]:
+        """ Yields the columns of this NoteTable in the order they should be
+        played """
+
+        for bar in range(self.num_bars()):
+            yield self.column(bar)
+
+
+def _play_cached(wave: typing.Union[ANYWAVE, Note],
+                 out: numpy.ndarray = None
+                 ) -> typing.Tuple[numpy.ndarray, typing.Optional[int]]:
+    """ Returns wave's numpy array from WAVE_CACHE, rendering and caching it
+    first if it is not cached yet, and the index of a largest absolute value
+    in it. If out is given, the array is copied into out and out is returned;
+    otherwise the returned array is read-only. """
+
+    key = wave._cache_key()
+    if key is None:
+        with span('synthesize', wave=type(wave).__name__):
+            return wave._render(out)
+
+    key += synthesis_key()
+    array = WAVE_CACHE.get(key)
+    if array is None:
+        with span('synthesize', wave=type(wave).__name__):
+            array, peak = wave._render()
+            array = WAVE_CACHE.put(key, array, peak)
+    else:
+        peak = WAVE_CACHE.peak(key, array)
+
+    if out is None:
+        return array, peak
+    out[:] = array
+
+    return out, peak
+
+
+def _merge_partials(parts: list) -> list:
+    """ Returns parts, as returned by ComplexWave._parts, with every
+    (frequency, duration, amplitude) partial of the same frequency and
+    duration merged into one, whose amplitude is the sum of theirs, in the
+    order they first appear. Other waves are kept as they are.
+
+    NOTE: Partials that would play nothing but silence (zero amplitude or
+    frequency) or only aliasing (at or above the Nyquist frequency of the
+    current sample_rate()) are
+    dropped. If that shortens the parts, one silent partial as long as the
+    longest part is kept so that the duration does not change."""
+
+    merged, lst = {}, []
+
+    for part in parts:
+        if type(part) is not tuple:
+            lst.append(part)
+            continue
+        frequency, duration, amplitude = part
+        if amplitude == 0 or not 0 < abs(frequency) < sample_rate() / 2:
+            continue
+        if (frequency, duration) in merged:
+            merged[(frequency, duration)][2] += amplitude
         else:
-            abs_max = array.max()
+            merged[(frequency, duration)] = [frequency, duration, amplitude]
+            lst.append(merged[(frequency, duration)])
+
+    lst = [tuple(part) if type(part) is list else part for part in lst
+           if type(part) is not list or part[2] != 0]
+    longest = max(parts, key=_part_samples, default=None)
+    if longest is not None and _part_samples(longest) > max(
+            [_part_samples(part) for part in lst], default=0):
+        lst.append((0, longest[1] if type(longest) is tuple
+                    else longest.get_duration(), 0))
+
+    return lst
+
+
+def _part_samples(part: typing.Union[tuple, ANYWAVE]) -> int:
+    """ Returns the number of samples part of ComplexWave._parts plays for """
+
+    if type(part) is tuple:
+        return int(sample_rate() * part[1])
+
+    return part._num_samples()
+
+
+def _part_wave(part: typing.Union[tuple, ANYWAVE]) -> ANYWAVE:
+    """ Returns part of ComplexWave._parts as a wave. The amplitude of a
+    SimpleWave made from a partial is not capped at 1. """
+
+    if type(part) is not tuple:
+        return part
+    wave = SimpleWave(part[0], part[1], 0)
+    wave._amplitude = part[2]
+
+    return wave
+
+
+def _peak(array: numpy.ndarray) -> typing.Optional[int]:
+    """ Returns the index of a largest absolute value in array, or None if it
+    is empty.
+    NOTE: Rounding is monotonic, so scaling array in place by any factor
+    leaves a largest absolute value at the same index. A peak found once stays
+    valid however many times the array is normalized afterwards."""
+
+    if len(array) == 0:
+        return None
+    high, low = array.argmax(), array.argmin()
+
+    return int(high) if array[high] >= -array[low] else int(low)
+
+
+def _peak_value(array: numpy.ndarray, peak: typing.Optional[int]) -> float:
+    """ Returns the absolute value at index peak in array, or 0 if peak is
+    None """
+
+    if peak is None:
+        return 0
+
+    return abs(array[peak])
+
+
+def _louder(array: numpy.ndarray, first: typing.Optional[int],
+            second: typing.Optional[int]) -> typing.Optional[int]:
+    """ Returns whichever of the indices first and second, either of which
+    may be None, has the larger absolute value in array """
+
+    if first is None or (second is not None and
+                         abs(array[second]) > abs(array[first])):
+        return second
+
+    return first
+
+
+def _play_in_order(waves: list, amplitude: float, samples: int,
+                   out: numpy.ndarray = None
+                   ) -> typing.Tuple[numpy.ndarray, typing.Optional[int]]:
+    """ Returns a numpy array of length samples in which each of waves is
+    played in order, scaled to amplitude, and the index of a largest absolute
+    value in it. Each wave is written straight into its own slice of out, or
+    of a new array if out is None.
+    NOTE: The peak of out is the louder of the peaks its waves report, so out
+    is not scanned again before it is normalized."""
+
+    if out is None:
+        out = numpy.empty(samples, dtype=sample_dtype())
+    i, peak = 0, None
+
+    for wave in waves:
+        n = wave._num_samples()
+        index = wave._play_peak(out[i:i + n])[1]
+        if index is not None:
+            peak = _louder(out, peak, i + index)
+        i += n
+
+    return out, _normalize(out, amplitude, peak)
+
+
+def _normalize(out: numpy.ndarray, amplitude: float,
+               peak: typing.Optional[int]) -> typing.Optional[int]:
+    """ Scales out in place so that its largest absolute value, found at
+    index peak, is amplitude, unless it is silent, and returns peak.
+    NOTE: A scale of exactly 1 would leave out as it is, so it is skipped."""
+
+    with span('normalize'):
+        abs_max = _peak_value(out, peak)
 
         if abs_max != 0:
-            return n * (self._get_amplitude() / abs_max)
+            scale = amplitude / abs_max
+            if scale != 1:
+                out *= scale
+
+    return peak
+
+
+def _parse_ratio(ratio: str) -> typing.Tuple[int, int]:
+    """ Returns the numerator and denominator of a ratio such as '3:2' """
+
+    ratio = list(ratio.strip().split(':'))
+
+    return int(ratio[0].strip()), int(ratio[1].strip())
+
+
+def _parse_notes(note_info: typing.List[typing.Tuple[str, float, float]]
+                 ) -> typing.List[tuple]:
+    """ Returns note_info with every (ratio, amplitude, duration) note turned
+    into a (numerator, denominator, amplitude, duration) tuple """
+
+    return [_parse_ratio(f) + (a, d) for f, a, d in note_info]
+
+
+def _bar_waves(notes: typing.Sequence[tuple], frequency: int,
+               make_wave: typing.Callable[[int, float, float], object],
+               make_silent: typing.Callable[[int, float, float], object]
+               ) -> list:
+    """ Returns the waves an instrument with the fundamental frequency plays
+    for one bar of (numerator, denominator, amplitude, duration) notes. Each
+    note is played by make_wave(frequency, duration, amplitude), or by
+    make_silent(0, duration, 0) if its ratio has a zero in it.
+    NOTE: If duration of notes is less than 1, it only plays up to the given
+    duration and doesn't add rest. If duration is greater than 1, it will
+    partially play the wave that makes it have duration of greater than 1"""
+
+    waves, n_f = [], 0
+
+    for i, duration, partial in _bar_pieces([note[3] for note in notes]):
+        if i is None:
+            waves.append(Rest(1))
+            continue
+
+        numerator, denominator, amplitude, _ = notes[i]
+
+        if partial:
+            waves.append(make_wave(n_f, duration, amplitude))
+        elif numerator != 0 and denominator != 0:
+            n_f = int(numerator / denominator * frequency)
+            waves.append(make_wave(n_f, duration, amplitude))
         else:
-            return n
+            waves.append(make_silent(0, duration, 0))
+
+    return waves
+
+
+def _bar_pieces(durations: typing.Sequence[float]
+                ) -> typing.List[typing.Tuple[typing.Optional[int], float,
+                                              bool]]:
+    """ Returns the (note, duration, partial) pieces an instrument plays for
+    one bar of notes of the given durations, where note is the index of the
+    note played, or None for a Rest of the whole bar, and partial is True if
+    the note is cut short at the end of the bar.
+    NOTE: A partial note keeps the frequency of the note played before it."""
+
+    pieces, i, d, duration = [], 0, 0, None
+
+    if len(durations) >= 1:
+        duration = durations[i]
+
+    while duration and i < len(durations) and d + duration <= 1:
+        pieces.append((i, duration, False))
+
+        d += duration
+        i += 1
+        if i < len(durations):
+            duration = durations[i]
+
+    if not duration:
+        pieces.append((None, 1, False))
+
+    elif d < 1 and i < len(durations):
+        pieces.append((i, 1 - d, True))
+
+    return pieces
+
+
+def _gaffophone_wave(frequency: int, duration: float,
+                     amplitude: float) -> ComplexWave:
+    """ Returns the wave a Gaffophone plays for one note: a SquareWave at the
+    frequency together with one a fifth above it """
+
+    return SquareWave(frequency, duration, amplitude) + \
+        SquareWave(int(frequency * (3 / 2)), duration, amplitude)
 
 
 def _make_vertical_lst(o_lst: list, beat: float, first: list) -> list:
@@ -813,15 +1672,9 @@ def _make_vertical_lst(o_lst: list, beat: float, first: list) -> list:
     while i < len(first):
         temp_lst = []
         while v < len(o_lst):
-            ele = o_lst[v][i].replace(' ', '').lower().strip()
-            if 'rest' in ele:
-                temp_lst.append([("1:1", 0.0, round(float(ele[5:]) * beat, 5))])
-            elif len(ele) != 0:
-                semi_c = [e for e in range(len(ele)) if ele[e] == ':']
-                f = ele[:semi_c[1]]
-                a = round(float(ele[semi_c[1] + 1: semi_c[2]]), 5)
-                d = round(float(ele[semi_c[2] + 1:]) * beat, 5)
-                temp_lst.append([(f, a, d)])
+            note = _parse_cell(o_lst[v][i], beat)
+            if note is not None:
+                temp_lst.append([note])
             v += 1
         n_lst.append(temp_lst)
         v = 0
@@ -830,96 +1683,127 @@ def _make_vertical_lst(o_lst: list, beat: float, first: list) -> list:
     return n_lst
 
 
-def _less_than_1(v_lst: list, v: int, d: float) -> None:
-    """ Case less than 1 duration """
+def _parse_cell(cell: str, beat: float) -> typing.Optional[tuple]:
+    """ Returns the (ratio, amplitude, duration) note in one cell of a song
+    file at the given beat, or None if the cell is empty """
 
-    t = v + 1
+    ele = cell.replace(' ', '').lower().strip()
+    if 'rest' in ele:
+        return "1:1", 0.0, round(float(ele[5:]) * beat, 5)
+    elif len(ele) != 0:
+        semi_c = [e for e in range(len(ele)) if ele[e] == ':']
+        f = ele[:semi_c[1]]
+        a = round(float(ele[semi_c[1] + 1: semi_c[2]]), 5)
+        d = round(float(ele[semi_c[2] + 1:]) * beat, 5)
+        return f, a, d
 
-    while d < 1 and t < len(v_lst):
-        n_d = v_lst[t][0][2]
-        if d + n_d <= 1:
-            d += n_d
-            d = round(d, 5)
-            v_lst[v].extend(v_lst.pop(t))
-        else:
-            f_t, a_t = v_lst[t][0][0], v_lst[t][0][1]
-            v_lst[v].append((f_t, a_t, round(float(1.0 - d), 5)))
-            v_lst[t][0] = (f_t, a_t, round(float(d + n_d - 1), 5))
-            d = 1.0
-
-
-def _greater_than_1(v_lst: list, v: int, d: float) -> None:
-    """ Case greater than 1 duration """
-
-    f_v, a_v, t = v_lst[v][0][0], v_lst[v][0][1], v + 1
-
-    while d > 1:
-        if d - 1 < 1:
-            v_lst[v][-1] = (f_v, a_v, 1.0)
-            v_lst.insert(t, [(f_v, a_v, round(float(d - 1.0), 5))])
-            d -= 1.0
-            d = round(d, 5)
-        elif d - 1.0 > 1:
-            v_lst[v][-1] = (f_v, a_v, round(float(d - 1.0), 5))
-            v_lst.insert(t, [(f_v, a_v, 1.0)])
-            d -= 1.0
-            d = round(d, 5)
-        else:
-            v_lst[v][-1] = (f_v, a_v, 1.0)
-            v_lst.insert(t, v_lst[v])
-            d = 1.0
+    return None
 
 
-def _playables_list(v_lst: list, instrument: str) -> list:
-    """ Returns a playable list """
+def _segment_track(notes: typing.Iterable[tuple]) -> typing.Iterator[list]:
+    """ Yields the one-second bars of one instrument track, given its
+    (ratio, amplitude, duration) notes in order.
+
+    A note shorter than one second is followed in its bar by the next notes
+    while they fit, and the note that does not fit is split across the bar
+    line. The last note gets a rest to fill its bar. A note longer than one
+    second takes up a full bar, and what is left of it is put back in front
+    of the notes still to come, after any full-second pieces.
+
+    NOTE: Every note is read once and only as many notes are read as the next
+    bar needs, so segmenting a track takes time linear in its length."""
+
+    notes, pending = iter(notes), collections.deque()
+
+    while pending or _pull(notes, pending):
+        f_v, a_v, d = pending.popleft()
+        bar = [(f_v, a_v, d)]
+
+        if d < 1 and not (pending or _pull(notes, pending)):
+            bar.append(('1:1', 0.0, round(float(1.0 - d), 5)))
+
+        while d < 1 and (pending or _pull(notes, pending)):
+            f_t, a_t, n_d = pending[0]
+            if d + n_d <= 1:
+                d = round(d + n_d, 5)
+                bar.append(pending.popleft())
+            else:
+                bar.append((f_t, a_t, round(float(1.0 - d), 5)))
+                pending[0] = (f_t, a_t, round(float(d + n_d - 1), 5))
+                d = 1.0
+
+        while d > 1:
+            bar[-1] = (f_v, a_v, 1.0)
+            if d - 1 < 1:
+                pending.appendleft((f_v, a_v, round(float(d - 1.0), 5)))
+                d = round(d - 1.0, 5)
+            elif d - 1.0 > 1:
+                pending.appendleft((f_v, a_v, 1.0))
+                d = round(d - 1.0, 5)
+                bar[-1] = (f_v, a_v, d)
+            else:
+                pending.appendleft((f_v, a_v, 1.0))
+                d = 1.0
+
+        yield bar
+
+
+def _pull(notes: typing.Iterator[tuple],
+          pending: typing.Deque[tuple]) -> bool:
+    """ Moves the next note of notes to the end of pending and returns
+    whether there was one """
+
+    note = next(notes, None)
+    if note is None:
+        return False
+    pending.append(note)
+
+    return True
+
+
+def _new_instrument(instrument: str) -> object:
+    """ Returns a new instrument named instrument """
 
     if instrument == 'baliset':
-        lst_note = []
-        for note in v_lst:
-            b = Baliset()
-            b.next_notes(note)
-            lst_note.append(b)
+        return Baliset()
     elif instrument == 'holophonor':
-        lst_note = []
-        for note in v_lst:
-            h = Holophonor()
-            h.next_notes(note)
-            lst_note.append(h)
-    else:
-        lst_note = []
-        for note in v_lst:
-            g = Gaffophone()
-            g.next_notes(note)
-            lst_note.append(g)
+        return Holophonor()
+
+    return Gaffophone()
+
+
+def _make_instrument(instrument: str, note: list) -> object:
+    """ Returns the instrument named instrument playing note """
+
+    playable = _new_instrument(instrument)
+    playable.next_notes(note)
+
+    return playable
+
+
+def _playables_list(v_lst: list, instrument: str) -> list:
+    """ Returns a playable list """
 
-    return lst_note
+    return [_make_instrument(instrument, note) for note in v_lst]
 
 
 def _process_song(song_file: str, beat: float) -> tuple:
     """ Processes the song and returns a tuple containing a playable list,
      max_len of list and len instruments"""
 
-    with open(song_file) as song:
+    with open(song_file) as song, span('read_csv'):
         reader = csv.reader(song, skipinitialspace=True)
-        first = song.readline().split(',')
-        first = [x.strip().lower().replace(' ', '') for x in first]
+        first = _read_header(song)
         o_lst = ([x for x in reader if x])
     song.close()
 
-    v_lst = _make_vertical_lst(o_lst, beat, first)
+    with span('make_vertical_lst'):
+        v_lst = _make_vertical_lst(o_lst, beat, first)
 
     for instrument in range(len(first)):
-        v = 0
-        while v < len(v_lst[instrument]):
-            d = v_lst[instrument][v][0][2]
-            if d < 1 and v == len(v_lst[instrument]) - 1:
-                v_lst[instrument][v].append(('1:1', 0.0,
-                                             round(float(1.0 - d), 5)))
-            elif d < 1:
-                _less_than_1(v_lst[instrument], v, d)
-            elif d > 1:
-                _greater_than_1(v_lst[instrument], v, d)
-            v += 1
+        with span('segment', instrument=first[instrument]):
+            v_lst[instrument] = list(_segment_track(
+                note[0] for note in v_lst[instrument]))
 
     max_len = max([len(x) for x in v_lst])
 
@@ -928,26 +1812,1036 @@ def _process_song(song_file: str, beat: float) -> tuple:
             instr_f.append([('1:1', 0, 1)])
 
     for instr_i in range(len(first)):
-        v_lst[instr_i] = _playables_list(v_lst[instr_i], first[instr_i])
+        with span('playables', instrument=first[instr_i]):
+            v_lst[instr_i] = _playables_list(v_lst[instr_i], first[instr_i])
 
     return max_len, first, v_lst
 
 
-def play_song(song_file: str, beat: float) -> None:
+def _read_header(song: typing.TextIO) -> typing.List[str]:
+    """ Reads the first line of song and returns its instrument names """
+
+    first = song.readline().split(',')
+
+    return [x.strip().lower().replace(' ', '') for x in first]
+
+
+def _iter_song(song_file: str, beat: float) -> typing.Iterator[list]:
+    """ Yields the columns of the song one at a time, each containing one
+    instrument per song instrument, in the order they should be played.
+
+    NOTE: Unlike _process_song, rows are only read from song_file once a
+    column needs them, so the first column is ready as soon as its bar has
+    been read. The columns are the same as _process_song's."""
+
+    with open(song_file) as song:
+        first = _read_header(song)
+        for bar, column in enumerate(_iter_bars(song, first, beat)):
+            with span('playables', bar=bar):
+                playables = [_make_instrument(first[instr_i], note)
+                             for instr_i, note in enumerate(column)]
+            yield playables
+
+
+def _iter_bars(song: typing.TextIO, first: typing.List[str],
+               beat: float) -> typing.Iterator[list]:
+    """ Yields the rest of song one column at a time, as one bar of
+    (ratio, amplitude, duration) notes per instrument in first. Instruments
+    that have run out of notes get a bar of rest. """
+
+    reader = csv.reader(song, skipinitialspace=True)
+    rows = (row for row in reader if row)
+    tracks = [collections.deque() for _ in first]
+    bars = [_segment_track(_read_track(rows, tracks, i, beat))
+            for i in range(len(first))]
+
+    for i in itertools.count():
+        with span('segment', bar=i):
+            column = [next(bar, None) for bar in bars]
+        if all(note is None for note in column):
+            return
+        yield [note or [('1:1', 0, 1)] for note in column]
+
+
+def _read_track(rows: typing.Iterator[list], tracks: typing.List[typing.Deque],
+                instr_i: int, beat: float) -> typing.Iterator[tuple]:
+    """ Yields the notes of instrument instr_i, reading another row of rows
+    only when tracks[instr_i] has run out. The notes the other instruments
+    have in that row are kept in their own tracks until they are read. """
+
+    track = tracks[instr_i]
+    while True:
+        while not track:
+            with span('read_csv'):
+                row = next(rows, None)
+                if row is None:
+                    return
+                for i, other in enumerate(tracks):
+                    note = _parse_cell(row[i], beat)
+                    if note is not None:
+                        other.append(note)
+        yield track.popleft()
+
+
+def compile_song(song_file: str, beat: float,
+                 out_path: typing.Optional[str] = None) -> str:
+    """ Compiles the given song pieces at a given beat into a binary score at
+    out_path (next to song_file, with the extension .bin, by default), and
+    returns out_path. The score holds the song's segmented bars as a
+    NoteTable, so load_song can memory-map them instead of parsing
+    song_file again. """
+
+    if out_path is None:
+        out_path = _score_path(song_file)
+    digest = _song_digest(song_file)
+    with span('compile'):
+        NoteTable.from_song(song_file, beat).save(out_path, beat, digest)
+
+    return out_path
+
+
+def load_song(song_file: str, beat: float,
+              score_path: typing.Optional[str] = None) -> NoteTable:
+    """ Returns the NoteTable of the given song pieces at a given beat,
+    memory-mapped from the binary score at score_path (where compile_song
+    puts it by default) if it was compiled from song_file as it is now at
+    that beat, or read from song_file otherwise. """
+
+    if score_path is None:
+        score_path = _score_path(song_file)
+    table = NoteTable.load(score_path, beat, _song_digest(song_file))
+    if table is None:
+        with span('read_csv'):
+            table = NoteTable.from_song(song_file, beat)
+
+    return table
+
+
+def _score_path(song_file: str) -> str:
+    """ Returns the path compile_song puts the score of song_file at """
+
+    return os.path.splitext(song_file)[0] + _SCORE_SUFFIX
+
+
+def _song_digest(song_file: str) -> bytes:
+    """ Returns the SHA-256 of the contents of song_file """
+
+    digest = hashlib.sha256()
+    with open(song_file, 'rb') as song:
+        for block in iter(lambda: song.read(2 ** 16), b''):
+            digest.update(block)
+
+    return digest.digest()
+
+
+def _map_array(path: str, dtype: numpy.dtype, offset: int,
+               length: int) -> numpy.ndarray:
+    """ Returns length items of dtype starting offset bytes into path,
+    memory-mapped read-only """
+
+    if length == 0:
+        return numpy.empty(0, dtype=dtype)
+
+    return numpy.memmap(path, dtype=dtype, mode='r', offset=offset,
+                        shape=(length,))
+
+
+def _song_columns(song_file: str, beat: float) -> typing.Iterator[list]:
+    """ Yields the columns of the song the same way _iter_song does, from
+    its compiled score if there is an up to date one """
+
+    table = NoteTable.load(_score_path(song_file), beat,
+                           _song_digest(song_file))
+    if table is None:
+        return _iter_song(song_file, beat)
+
+    return table.columns()
+
+
+def _column_samples(column: list) -> int:
+    """ Returns the number of samples the longest instrument in column plays
+    """
+
+    return max([playable._num_samples() for playable in column], default=0)
+
+
+def _mix_column(column: list, out: numpy.ndarray,
+                bus: typing.Optional[MixBus] = None) -> None:
+    """ Mixes every instrument in column into the int16 array out with bus
+    (a new MixBus by default), the same way play_sounds plays them together.
+    NOTE: bus reuses its buffers from one column to the next, so pass the
+    same one for every column of a song."""
+
+    if bus is None:
+        bus = MixBus()
+    bus.mix(column, out)
+
+
+def _render_column(column: list,
+                   bus: typing.Optional[MixBus] = None) -> numpy.ndarray:
+    """ Returns every instrument in column mixed by bus (a new MixBus by
+    default) into a new int16 array """
+
+    frames = numpy.empty(_column_samples(column), dtype=numpy.int16)
+    _mix_column(column, frames, bus)
+
+    return frames
+
+
+def play_song(song_file: str, beat: float,
+              engine: typing.Optional[PlaybackEngine] = None,
+              bus: typing.Optional[MixBus] = None,
+              rate: typing.Optional[int] = None) -> None:
     """ Plays the given song pieces at a given beat.
     NOTE: The duration of the passed ins song_file is rounded to 5 decimal
-    places"""
+    places
+    NOTE: The columns are played back to back by engine (a new
+    PlaybackEngine by default), which renders the next ones while the
+    current one plays, so there is no gap between them. Pass an engine to
+    choose its lookahead or read its underruns afterwards.
+    NOTE: The instruments of each column are mixed by bus (a new MixBus by
+    default) and played on one channel, so a song can have any number of
+    instruments.
+    NOTE: If compile_song has compiled song_file at beat since it was last
+    changed, the bars are read from the compiled score instead.
+    NOTE: The columns are synthesized at rate (the current sample_rate() by
+    default) and resampled to the sample rate of the audio device, so
+    passing PREVIEW_RATE plays a quicker, duller sounding preview."""
+
+    if engine is None:
+        engine = PlaybackEngine()
+    engine.play(_song_columns(song_file, beat), _play_column(bus, rate))
+
+
+def _play_column(bus: typing.Optional[MixBus], rate: typing.Optional[int]
+                 ) -> typing.Callable[[list], numpy.ndarray]:
+    """ Returns a function that mixes a column with bus (a new MixBus by
+    default) at rate (the current sample_rate() by default) into a new int16
+    array, resampled to the sample rate of the current audio device """
+
+    if bus is None:
+        bus = MixBus()
+    if rate is None:
+        rate = sample_rate()
+    device = audio_backend().sample_rate
+
+    def render(column: list) -> numpy.ndarray:
+        with use_sample_rate(rate):
+            return resample(_render_column(column, bus), rate, device)
+
+    return render
+
+
+async def play_song_async(song_file: str, beat: float,
+                          engine: typing.Optional[PlaybackEngine] = None,
+                          bus: typing.Optional[MixBus] = None,
+                          executor: typing.Optional[
+                              concurrent.futures.Executor] = None,
+                          rate: typing.Optional[int] = None) -> None:
+    """ Plays the given song pieces at a given beat like play_song, without
+    blocking the event loop.
+    NOTE: song_file is read and its columns are mixed on executor (a thread
+    pool, the event loop's default executor by default) while the event loop
+    waits on the mixer. Cancelling the coroutine stops the song."""
+
+    if engine is None:
+        engine = PlaybackEngine()
+    await engine.play_async(_columns_later(song_file, beat),
+                            _play_column(bus, rate), executor)
+
+
+def render_song_stream(song_file: str, beat: float, lookahead: int = 2,
+                       oscillator: typing.Optional[Wavetable] = None,
+                       dtype: numpy.dtype = numpy.float64,
+                       bus: typing.Optional[MixBus] = None,
+                       executor: typing.Optional[
+                           concurrent.futures.Executor] = None,
+                       rate: typing.Optional[int] = None
+                       ) -> typing.AsyncIterator[numpy.ndarray]:
+    """ Returns an asynchronous iterator over the int16 frames of every
+    column of the given song pieces at a given beat, rendered as render_song
+    renders them at rate (the current sample_rate() by default), so that
+    together they are the frames of its WAV file.
+    NOTE: song_file is read and its columns are mixed on executor (a thread
+    pool, the event loop's default executor by default), at most lookahead
+    columns ahead of the one being consumed, so a slow consumer holds up the
+    rendering instead of letting rendered columns pile up. Many songs can be
+    streamed from one event loop at once."""
+
+    if bus is None:
+        bus = MixBus()
+    if rate is None:
+        rate = sample_rate()
+
+    def render(column: list) -> numpy.ndarray:
+        with use_oscillator(oscillator), use_dtype(dtype), \
+                use_sample_rate(rate):
+            return _render_column(column, bus)
+
+    return render_ahead(_columns_later(song_file, beat), render, lookahead,
+                        executor)
+
+
+def _columns_later(song_file: str, beat: float) -> typing.Iterator[list]:
+    """ Yields the columns of the song like _song_columns, but only looks the
+    song up once the first column is asked for, on whichever thread asks """
+
+    yield from _song_columns(song_file, beat)
+
+
+def render_song(song_file: str, beat: float, out_path: str,
+                oscillator: typing.Optional[Wavetable] = None,
+                workers: int = 1, dtype: numpy.dtype = numpy.float64,
+                bus: typing.Optional[MixBus] = None,
+                rate: typing.Optional[int] = None) -> None:
+    """ Renders the given song pieces at a given beat into a 16-bit mono WAV
+    file at out_path, sampled at rate (the current sample_rate() by default),
+    without playing them in real time.
+    PREVIEW_RATE renders a preview about four times as fast. If oscillator is
+    given, every sine wave of this render is read from that Wavetable instead
+    of being computed exactly. Waves are synthesized and mixed in dtype;
+    numpy.float32 halves the memory traffic of a render and stays within one
+    16-bit step of float64. The instruments of each column are mixed by bus
+    (a new MixBus by default), so a song can have any number of them.
+    NOTE: Each column is mixed into one preallocated buffer and written to
+    out_path as soon as it has been read from song_file, so the file sounds
+    the same as play_song
+    NOTE: If workers is greater than 1, the columns are instead mixed by that
+    many processes at once, into one shared buffer that is written to
+    out_path at the end. The file is the same either way.
+    NOTE: If compile_song has compiled song_file at beat since it was last
+    changed, the bars are read from the compiled score instead."""
+
+    if rate is None:
+        rate = sample_rate()
+
+    with use_oscillator(oscillator), use_dtype(dtype), \
+            use_sample_rate(rate), wav.open(out_path, 'wb') as out:
+        out.setnchannels(1)
+        out.setsampwidth(numpy.dtype(numpy.int16).itemsize)
+        out.setframerate(rate)
+
+        if bus is None:
+            bus = MixBus()
+        if workers > 1:
+            _render_parallel(song_file, beat, out, oscillator, workers, bus)
+            return
+
+        for bar, frames in enumerate(_mixed_columns(song_file, beat, bus)):
+            with span('write', bar=bar):
+                out.writeframes(frames.tobytes())
+
+
+def _mixed_columns(song_file: str, beat: float,
+                   bus: MixBus) -> typing.Iterator[numpy.ndarray]:
+    """ Yields the int16 frames of every column of the song mixed by bus, as
+    soon as it has been read from song_file.
+    NOTE: Every column is mixed into the same buffer, which only grows when a
+    column is longer than any before it, so each yielded array is only valid
+    until the next one is asked for."""
+
+    frames = numpy.zeros(sample_rate(), dtype=numpy.int16)
+
+    for bar, column in enumerate(_song_columns(song_file, beat)):
+        with span('mix', bar=bar):
+            length = _column_samples(column)
+            if length > len(frames):
+                frames = numpy.zeros(length, dtype=numpy.int16)
+            _mix_column(column, frames[:length], bus)
+        yield frames[:length]
+
+
+def _render_parallel(song_file: str, beat: float, out: wav.Wave_write,
+                     oscillator: typing.Optional[Wavetable],
+                     workers: int, bus: MixBus) -> None:
+    """ Writes every column of the song into out, after mixing them with
+    copies of bus in up to workers processes that read their sine waves from
+    oscillator, at the current sample_rate(). Only the
+    NoteTable rows of each column are sent to a worker, which mixes them
+    straight into its slice of one shared-memory buffer, so no audio is copied
+    between processes. """
+
+    # Process pools are imported when they are first used, so that importing
+    # this module only to synthesize waves costs little more than numpy
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    table = load_song(song_file, beat)
+    offsets = [0] + numpy.cumsum(table.bar_samples()).tolist()
+    total = offsets[-1]
+    if total == 0:
+        return
+
+    # A few chunks per worker so that one slow chunk does not hold up the rest
+    step = -(-table.num_bars() // (workers * 4))
+    memory = shared_memory.SharedMemory(create=True, size=2 * total)
+    try:
+        frames = numpy.ndarray(total, dtype=numpy.int16, buffer=memory.buf)
+        frames[:] = 0
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_render_bars, memory.name, total,
+                                   offsets[i], table.select_bars(i, i + step),
+                                   oscillator, sample_dtype(), sample_rate(),
+                                   bus.copy())
+                       for i in range(0, table.num_bars(), step)]
+            for future in futures:
+                future.result()
+        out.writeframes(frames)
+    finally:
+        frames = None
+        memory.close()
+        memory.unlink()
+
+
+def _render_bars(name: str, total: int, offset: int, table: NoteTable,
+                 oscillator: typing.Optional[Wavetable],
+                 dtype: numpy.dtype, rate: int, bus: MixBus) -> None:
+    """ Mixes the columns of table with bus into the int16 shared memory
+    called name, starting at sample offset, synthesizing them in dtype at
+    rate. """
+
+    from multiprocessing import shared_memory
+
+    memory = shared_memory.SharedMemory(name)
+    try:
+        frames = numpy.ndarray(total, dtype=numpy.int16, buffer=memory.buf)
+        with use_oscillator(oscillator), use_dtype(dtype), \
+                use_sample_rate(rate):
+            for column in table.columns():
+                length = _column_samples(column)
+                _mix_column(column, frames[offset:offset + length], bus)
+                offset += length
+    finally:
+        frames = None
+        memory.close()
+
+
+class PCMSink:
+    """ Writes 16-bit mono PCM frames to a binary file object in chunks of
+    the same number of frames, optionally after a WAV header.
+
+    === Attributes ===
+    out: the binary file object the chunks are written to, such as
+        sys.stdout.buffer, an open FIFO or a file.
+    chunk_frames: the number of frames in every chunk but the last.
+    frames_written: number of frames written to out so far.
+    chunks_written: number of chunks written to out so far.
+    _chunk: the frames of the chunk being filled.
+    _filled: number of frames of _chunk filled so far.
+    _header_at: position in out of the WAV header, if one was written and
+        out is seekable, so its lengths can be filled in once they are known.
+    _rate: the sample rate the WAV header gives.
+
+    === Representation Invariants ===
+    chunk_frames >= 1
+    0 <= _filled < chunk_frames
+    """
+    out: typing.BinaryIO
+    chunk_frames: int
+    frames_written: int
+    chunks_written: int
+    _chunk: numpy.ndarray
+    _filled: int
+    _header_at: typing.Optional[int]
+    _rate: int
+
+    def __init__(self, out: typing.BinaryIO, chunk_frames: int = 4096,
+                 wav_header: bool = False,
+                 rate: typing.Optional[int] = None) -> None:
+        """ Initializes a PCMSink writing chunks of chunk_frames frames to
+        out, after a WAV header of unknown length if wav_header is True,
+        which gives the frames' sample rate as rate (the current
+        sample_rate() by default) """
+
+        if chunk_frames < 1:
+            raise ValueError('chunk_frames must be at least 1')
+        self.out = out
+        self.chunk_frames = chunk_frames
+        self.frames_written, self.chunks_written = 0, 0
+        self._chunk = numpy.empty(chunk_frames, dtype=numpy.int16)
+        self._filled = 0
+        self._header_at = None
+        self._rate = sample_rate() if rate is None else rate
+
+        if wav_header:
+            if out.seekable():
+                self._header_at = out.tell()
+            out.write(_wav_header(None, self._rate))
+
+    def __enter__(self) -> PCMSink:
+        """ Returns this PCMSink """
+
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        """ Closes this PCMSink """
+
+        self.close()
+
+    def write(self, frames: numpy.ndarray) -> None:
+        """ Writes the int16 frames to out, as many full chunks as they
+        complete. The rest are held until more frames, or close, complete
+        the last chunk.
+        NOTE: Full chunks within frames are written straight from frames,
+        so only the frames that straddle two writes are copied."""
+
+        start = 0
+        if self._filled:
+            start = min(len(frames), self.chunk_frames - self._filled)
+            self._chunk[self._filled:self._filled + start] = frames[:start]
+            self._filled += start
+            if self._filled == self.chunk_frames:
+                self._write(self._chunk)
+                self._filled = 0
+
+        end = start + (len(frames) - start) // self.chunk_frames \
+            * self.chunk_frames
+        for i in range(start, end, self.chunk_frames):
+            self._write(frames[i:i + self.chunk_frames])
+
+        rest = len(frames) - end
+        self._chunk[self._filled:self._filled + rest] = frames[end:]
+        self._filled += rest
+
+    def close(self) -> None:
+        """ Writes the last chunk, which may be short, fills in the lengths
+        of the WAV header if out is seekable, and flushes out. out is left
+        open. """
+
+        if self._filled:
+            self._write(self._chunk[:self._filled])
+            self._filled = 0
+        if self._header_at is not None:
+            end = self.out.tell()
+            self.out.seek(self._header_at)
+            self.out.write(_wav_header(self.frames_written, self._rate))
+            self.out.seek(end)
+            self._header_at = None
+        self.out.flush()
+
+    def _write(self, chunk: numpy.ndarray) -> None:
+        """ Writes chunk to out """
+
+        self.out.write(chunk.data)
+        self.frames_written += len(chunk)
+        self.chunks_written += 1
+
+
+def _wav_header(frames: typing.Optional[int], rate: int) -> bytes:
+    """ Returns the header of a 16-bit mono WAV file of frames frames sampled
+    at rate, or of unknown length if frames is None, which readers take to
+    mean that the frames go on until the end of the file """
+
+    if frames is None or 36 + 2 * frames > _UNKNOWN_LENGTH:
+        data = riff = _UNKNOWN_LENGTH
+    else:
+        data = 2 * frames
+        riff = 36 + data
+
+    return _WAV_FORMAT.pack(b'RIFF', riff, b'WAVE', b'fmt ', 16, 1, 1,
+                            rate, 2 * rate, 2, 16, b'data',
+                            data)
+
+
+def stream_song(song_file: str, beat: float, out: typing.BinaryIO,
+                chunk_frames: int = 4096, wav_header: bool = False,
+                oscillator: typing.Optional[Wavetable] = None,
+                dtype: numpy.dtype = numpy.float64,
+                bus: typing.Optional[MixBus] = None,
+                rate: typing.Optional[int] = None) -> int:
+    """ Writes the given song pieces at a given beat to the binary file
+    object out as raw 16-bit mono PCM sampled at rate (the current
+    sample_rate() by default), in chunks of chunk_frames frames, and returns
+    the number of frames written. If wav_header is True, the frames follow a
+    WAV header whose lengths are only filled in if out is seekable.
+    oscillator, dtype and bus are used as render_song uses them.
+    NOTE: Each column is written as soon as it has been read from song_file
+    and mixed, into a buffer that is reused for the next column, so the
+    memory taken up stays that of a few columns however long the song is.
+    The frames are the same as those of render_song's WAV file."""
+
+    if bus is None:
+        bus = MixBus()
+    if rate is None:
+        rate = sample_rate()
+
+    with use_oscillator(oscillator), use_dtype(dtype), \
+            use_sample_rate(rate), \
+            PCMSink(out, chunk_frames, wav_header, rate) as sink:
+        for bar, frames in enumerate(_mixed_columns(song_file, beat, bus)):
+            with span('write', bar=bar):
+                sink.write(frames)
+
+    return sink.frames_written
+
+
+class IncrementalRenderer:
+    """ Renders a song file into a 16-bit mono WAV file the same way
+    render_song does, and keeps the notes and place in the file of every bar
+    it rendered. Rendering again after the song file has been edited only
+    synthesizes the bars whose notes are new, so the time it takes grows with
+    the size of the edit rather than the length of the song.
+
+    === Attributes ===
+    song_file: the song file that is rendered.
+    beat: the beat the song is rendered at.
+    out_path: the WAV file the song is rendered into.
+    oscillator: the Wavetable sine waves are read from, or None to compute
+        them exactly.
+    dtype: the dtype waves are synthesized and mixed in.
+    bus: the MixBus the instruments of every bar are mixed by.
+    rate: the sample rate the song is rendered at.
+    bars_synthesized: number of bars synthesized by the last render.
+    bars_reused: number of bars copied from the file by the last render.
+    in_place: whether the last render patched out_path in place instead of
+        writing it again.
+    _header: the instruments of the song as last rendered.
+    _bars: the notes of every bar as last rendered, one tuple per bar.
+    _offsets: the sample every bar starts at in out_path, followed by the
+        total number of samples.
+
+    === Representation Invariants ===
+    len(self._offsets) == len(self._bars) + 1
+    """
+    song_file: str
+    beat: float
+    out_path: str
+    oscillator: typing.Optional[Wavetable]
+    dtype: numpy.dtype
+    bus: MixBus
+    rate: int
+    bars_synthesized: int
+    bars_reused: int
+    in_place: bool
+    _header: typing.List[str]
+    _bars: typing.List[tuple]
+    _offsets: typing.List[int]
+
+    def __init__(self, song_file: str, beat: float, out_path: str,
+                 oscillator: typing.Optional[Wavetable] = None,
+                 dtype: numpy.dtype = numpy.float64,
+                 bus: typing.Optional[MixBus] = None,
+                 rate: typing.Optional[int] = None) -> None:
+        """ Initializes an IncrementalRenderer that has not rendered yet, at
+        rate (the current sample_rate() by default) """
+
+        self.song_file, self.beat, self.out_path = song_file, beat, out_path
+        self.oscillator, self.dtype = oscillator, dtype
+        self.bus = MixBus() if bus is None else bus
+        self.rate = sample_rate() if rate is None else rate
+        self.bars_synthesized, self.bars_reused = 0, 0
+        self.in_place = False
+        self._header, self._bars, self._offsets = [], [], [0]
+
+    def render(self) -> int:
+        """ Renders the song file into out_path and returns the number of
+        bars that had to be synthesized.
+        NOTE: A bar whose notes are the same as those of a bar rendered last
+        time is copied from out_path instead of being synthesized, even if it
+        has moved. If every bar still starts where it did, only the bars that
+        changed are written, into out_path in place. Otherwise out_path is
+        written again, from a temporary file that replaces it at the end.
+        NOTE: The song file is read in full before out_path is touched, so
+        out_path is left as it was if the song file cannot be read."""
+
+        with open(self.song_file) as song, span('read_csv'):
+            header = _read_header(song)
+            bars = [tuple(tuple(bar) for bar in column)
+                    for column in _iter_bars(song, header, self.beat)]
+
+        old = {}
+        if header == self._header and self._is_intact():
+            for i, bar in enumerate(self._bars):
+                old.setdefault(bar, i)
+
+        with use_oscillator(self.oscillator), use_dtype(self.dtype), \
+                use_sample_rate(self.rate):
+            columns = {i: [_make_instrument(header[j], list(notes))
+                           for j, notes in enumerate(bar)]
+                       for i, bar in enumerate(bars) if bar not in old}
+            offsets = [0]
+            for i, bar in enumerate(bars):
+                if i in columns:
+                    length = _column_samples(columns[i])
+                else:
+                    j = old[bar]
+                    length = self._offsets[j + 1] - self._offsets[j]
+                offsets.append(offsets[-1] + length)
+
+            self.in_place = bool(old) and offsets == self._offsets
+            if self.in_place:
+                self._patch(bars, offsets, columns, old)
+            else:
+                self._rewrite(bars, offsets, columns, old)
+
+        self._header, self._bars, self._offsets = header, bars, offsets
+        self.bars_synthesized = len(columns)
+        self.bars_reused = len(bars) - len(columns)
+
+        return self.bars_synthesized
+
+    def _is_intact(self) -> bool:
+        """ Returns whether out_path still holds the frames of the last
+        render """
+
+        try:
+            with wav.open(self.out_path, 'rb') as file:
+                frames = file.getnframes()
+                layout = (file.getnchannels(), file.getsampwidth(),
+                          file.getframerate())
+        except (OSError, EOFError, wav.Error):
+            return False
+
+        return (frames == self._offsets[-1] and layout == (1, 2, self.rate)
+                and os.path.getsize(self.out_path)
+                == _WAV_HEADER + 2 * frames)
+
+    def _old_frames(self, mode: str = 'r') -> numpy.ndarray:
+        """ Returns the frames of out_path memory-mapped, opened with mode """
+
+        return numpy.memmap(self.out_path, dtype='<i2', mode=mode,
+                            offset=_WAV_HEADER, shape=(self._offsets[-1],))
+
+    def _bar_frames(self, i: int, bars: typing.List[tuple],
+                    offsets: typing.List[int], columns: dict, old: dict,
+                    frames: typing.Optional[numpy.ndarray]) -> numpy.ndarray:
+        """ Returns bar i, either mixed from columns[i] or copied from the
+        old frames """
+
+        if i in columns:
+            with span('mix', bar=i):
+                return _render_column(columns[i], self.bus)
+        j = old[bars[i]]
+
+        return numpy.array(frames[self._offsets[j]:self._offsets[j + 1]])
+
+    def _patch(self, bars: typing.List[tuple], offsets: typing.List[int],
+               columns: dict, old: dict) -> None:
+        """ Writes every bar that differs from the last render into out_path
+        in place """
+
+        frames = self._old_frames('r+')
+        try:
+            changed = [i for i, bar in enumerate(bars)
+                       if bar != self._bars[i]]
+            # Bars are copied out before any are written over
+            moved = {i: self._bar_frames(i, bars, offsets, {}, old, frames)
+                     for i in changed if i not in columns}
+            for i in changed:
+                array = moved[i] if i in moved else self._bar_frames(
+                    i, bars, offsets, columns, old, frames)
+                with span('write', bar=i):
+                    frames[offsets[i]:offsets[i + 1]] = array
+            frames.flush()
+        finally:
+            del frames
+
+    def _rewrite(self, bars: typing.List[tuple], offsets: typing.List[int],
+                 columns: dict, old: dict) -> None:
+        """ Writes every bar into a new out_path """
+
+        frames = self._old_frames() if old else None
+        fd, temp = tempfile.mkstemp(
+            suffix='.wav', dir=os.path.dirname(os.path.abspath(self.out_path)))
+        try:
+            with os.fdopen(fd, 'wb') as file, wav.open(file, 'wb') as out:
+                out.setnchannels(1)
+                out.setsampwidth(2)
+                out.setframerate(self.rate)
+                for i in range(len(bars)):
+                    array = self._bar_frames(i, bars, offsets, columns, old,
+                                             frames)
+                    with span('write', bar=i):
+                        out.writeframes(array.tobytes())
+            frames = None
+            os.replace(temp, self.out_path)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+
+def watch_song(song_file: str, beat: float, out_path: str,
+               interval: float = 0.5,
+               renderer: typing.Optional[IncrementalRenderer] = None,
+               on_render: typing.Optional[typing.Callable] = None,
+               stop: typing.Optional[threading.Event] = None) -> None:
+    """ Renders song_file into out_path at the given beat, then renders it
+    again with renderer (a new IncrementalRenderer by default) every time
+    song_file is modified, checking every interval seconds, until stop is
+    set. After every render, on_render is called with the renderer, or a
+    line about the render is printed if on_render is None.
+    NOTE: If song_file cannot be read, for example because it is half way
+    through being saved, or out_path cannot be written, the error is printed
+    and out_path is left as it is until the next change."""
+
+    if renderer is None:
+        renderer = IncrementalRenderer(song_file, beat, out_path)
+    if stop is None:
+        stop = threading.Event()
+    mtime = None
+
+    while not stop.is_set():
+        try:
+            modified = os.stat(song_file).st_mtime_ns
+        except FileNotFoundError:
+            modified = None
+        if modified is not None and modified != mtime:
+            mtime = modified
+            try:
+                renderer.render()
+            except (ValueError, IndexError, csv.Error, OSError) as error:
+                print(f'{song_file}: could not render: {error}')
+            else:
+                if on_render is not None:
+                    on_render(renderer)
+                else:
+                    print(f'{out_path}: {renderer.bars_synthesized} bars '
+                          f'synthesized, {renderer.bars_reused} reused')
+        stop.wait(interval)
+
+
+def render_library(directory: str, beats: typing.List[float],
+                   out_dir: typing.Optional[str] = None, jobs: int = 1,
+                   memory_budget: int = 2 ** 30, force: bool = False,
+                   on_result: typing.Optional[typing.Callable] = None
+                   ) -> typing.List[dict]:
+    """ Renders every .csv song file under directory at each of beats into
+    out_dir (directory by default), in up to jobs processes at once, and
+    returns a result for every song and beat, in the order they finished.
+    Each result is a dict of the song file, beat, output path, status
+    ('rendered', 'up to date' or 'failed'), seconds taken and error.
+    on_result is called with every result as soon as it is known.
+
+    A song keeps the path it has under directory, with its extension
+    replaced by _<beat>.wav. Outputs that are newer than their song file are
+    skipped unless force is True, and every output is written to a
+    temporary file first, so a failed render never looks up to date.
+    NOTE: Only jobs songs are handed to the processes at a time, and each
+    process keeps its WAVE_CACHE small enough for all of them together to
+    stay within about memory_budget bytes. If memory_budget cannot hold jobs
+    processes, fewer are used."""
+
+    jobs, cache_bytes = _plan_jobs(jobs, memory_budget)
+    results, tasks = [], []
+
+    def report(result: dict) -> None:
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+
+    for song in _find_songs(directory):
+        for beat in beats:
+            out_path = _library_path(directory, song, beat, out_dir)
+            if not force and _up_to_date(song, out_path):
+                report(_job_result(song, beat, out_path, 'up to date'))
+            else:
+                tasks.append((song, beat, out_path, cache_bytes))
+
+    if jobs == 1:
+        max_bytes = WAVE_CACHE.max_bytes
+        try:
+            for task in tasks:
+                report(_render_job(*task))
+        finally:
+            WAVE_CACHE.resize(max_bytes)
+        return results
+
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    tasks.reverse()
+    with ProcessPoolExecutor(jobs) as pool:
+        running = set()
+        while tasks or running:
+            while tasks and len(running) < jobs:
+                running.add(pool.submit(_render_job, *tasks.pop()))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                report(future.result())
+
+    return results
+
+
+def _plan_jobs(jobs: int, memory_budget: int) -> typing.Tuple[int, int]:
+    """ Returns the number of render jobs to run at once, at most jobs, and
+    the WAVE_CACHE size each of them gets for all of them to fit in
+    memory_budget """
+
+    fit = memory_budget // (_JOB_OVERHEAD + _MIN_JOB_CACHE)
+    jobs = max(1, min(jobs, fit))
+
+    return jobs, max(_MIN_JOB_CACHE, memory_budget // jobs - _JOB_OVERHEAD)
+
+
+def _find_songs(directory: str) -> typing.List[str]:
+    """ Returns every .csv file under directory, in sorted order """
+
+    songs = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        songs.extend(os.path.join(root, name) for name in sorted(files)
+                     if name.lower().endswith('.csv'))
+
+    return songs
+
+
+def _library_path(directory: str, song: str, beat: float,
+                  out_dir: typing.Optional[str]) -> str:
+    """ Returns the path render_library renders song at beat to """
+
+    name = os.path.splitext(os.path.relpath(song, directory))[0]
+
+    return os.path.join(out_dir or directory, f'{name}_{beat:g}.wav')
+
+
+def _up_to_date(song: str, out_path: str) -> bool:
+    """ Returns whether out_path exists and is newer than song """
+
+    try:
+        return os.path.getmtime(out_path) >= os.path.getmtime(song)
+    except OSError:
+        return False
+
+
+def _job_result(song: str, beat: float, out_path: str, status: str,
+                seconds: float = 0.0,
+                error: typing.Optional[str] = None) -> dict:
+    """ Returns a result of render_library """
+
+    return {'song': song, 'beat': beat, 'out': out_path, 'status': status,
+            'seconds': seconds, 'error': error}
+
+
+def _render_job(song: str, beat: float, out_path: str,
+                cache_bytes: int) -> dict:
+    """ Renders song at beat to out_path with a WAVE_CACHE of cache_bytes and
+    returns its result for render_library """
+
+    WAVE_CACHE.resize(cache_bytes)
+    start, temp = time.perf_counter(), out_path + '.tmp'
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(out_path)),
+                    exist_ok=True)
+        render_song(song, beat, temp)
+        os.replace(temp, out_path)
+    except Exception as error:
+        if os.path.exists(temp):
+            os.remove(temp)
+        return _job_result(song, beat, out_path, 'failed',
+                           time.perf_counter() - start,
+                           f'{type(error).__name__}: {error}')
+
+    return _job_result(song, beat, out_path, 'rendered',
+                       time.perf_counter() - start)
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> int:
+    """ Runs the music simulator command line and returns its exit status,
+    which is 1 if any song failed to render """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m make_some_noise',
+        description='Render or stream songs of the music simulator.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    render = commands.add_parser(
+        'render', help='render every .csv song under a directory')
+    render.add_argument('directory', help='the directory to find songs in')
+    render.add_argument('--beat', type=float, action='append',
+                        help='beat to render at; may be given more than '
+                             'once (default 1.0)')
+    render.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='songs to render at once (default: one per '
+                             'CPU)')
+    render.add_argument('--out', metavar='OUTDIR',
+                        help='directory to write WAV files to (default: '
+                             'next to the songs)')
+    render.add_argument('--memory', type=_parse_size, default='1G',
+                        help='memory the renders may take up together, '
+                             'such as 512M (default 1G)')
+    render.add_argument('--force', action='store_true',
+                        help='render songs even if they are up to date')
+    render.add_argument('--report', metavar='FILE',
+                        help='save the results as JSON to FILE')
+    stream = commands.add_parser(
+        'stream', help='write a song as raw 16-bit PCM to stdout or a file')
+    stream.add_argument('song', help='the .csv song to stream')
+    stream.add_argument('--beat', type=float, default=1.0,
+                        help='beat to stream at (default 1.0)')
+    stream.add_argument('--out', default='-',
+                        help='file or FIFO to write to (default: stdout)')
+    stream.add_argument('--chunk', type=int, default=4096,
+                        help='frames written at a time (default 4096)')
+    stream.add_argument('--wav', action='store_true',
+                        help='write a WAV header first, of unknown length '
+                             'unless the output is a regular file')
+    stream.add_argument('--rate', type=int, default=_SAMPLE_RATE,
+                        help=f'sample rate to stream at, such as '
+                             f'{PREVIEW_RATE} for a quick preview (default '
+                             f'{_SAMPLE_RATE})')
+    args = parser.parse_args(argv)
+
+    if args.command == 'stream':
+        return _stream_main(parser, args)
+    if not os.path.isdir(args.directory):
+        parser.error(f'{args.directory} is not a directory')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    jobs, cache_bytes = _plan_jobs(args.jobs, args.memory)
+    print(f'rendering with {jobs} jobs, {_format_size(cache_bytes)} of wave '
+          f'cache each')
+
+    def show(result: dict) -> None:
+        print(f'{result["status"]:>10} {result["seconds"]:8.2f} s  '
+              f'{result["out"]}' + (f'  {result["error"]}'
+                                    if result['error'] else ''))
+
+    start = time.perf_counter()
+    results = render_library(args.directory, args.beat or [1.0], args.out,
+                             jobs, args.memory, args.force, show)
+    seconds = time.perf_counter() - start
+    counts = collections.Counter(result['status'] for result in results)
+    print(f'{counts["rendered"]} rendered, {counts["up to date"]} up to '
+          f'date, {counts["failed"]} failed in {seconds:.2f} s')
+
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump({'seconds': seconds, 'jobs': jobs,
+                       'cache_bytes': cache_bytes, 'counts': dict(counts),
+                       'results': results}, file, indent=2)
+
+    return 1 if counts['failed'] else 0
+
+
+def _stream_main(parser: argparse.ArgumentParser,
+                 args: argparse.Namespace) -> int:
+    """ Runs the stream command of main with its parsed args, and returns its
+    exit status """
+
+    if not os.path.isfile(args.song):
+        parser.error(f'{args.song} is not a file')
+    if args.chunk < 1:
+        parser.error('--chunk must be at least 1')
+    if args.rate < 1:
+        parser.error('--rate must be at least 1')
+
+    try:
+        if args.out == '-':
+            stream_song(args.song, args.beat, sys.stdout.buffer, args.chunk,
+                        args.wav, rate=args.rate)
+        else:
+            with open(args.out, 'wb') as out:
+                stream_song(args.song, args.beat, out, args.chunk, args.wav,
+                            rate=args.rate)
+    except BrokenPipeError:
+        # The reader stopped early. Point stdout at devnull so that flushing
+        # it on exit does not raise again.
+        if args.out == '-':
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
 
-    max_len, first, v_lst = _process_song(song_file, beat)
-    lst_notes = []
-    for column in range(max_len):
-        lst_note = []
-        for instr_i in range(len(first)):
-            lst_note.append(v_lst[instr_i][column])
-        lst_notes.append(lst_note)
+    return 0
 
-    for note in lst_notes:
-        play_sounds(note)
 
 # This is a custom type for type annotations that
 # refers to any of the following classes (do not
@@ -962,10 +2856,29 @@ ANYWAVE = typing.TypeVar('ANYWAVE',
                          Rest)
 
 
-if __name__ == '__main__':
+if __name__ == '__main__' and len(sys.argv) > 1:
+    raise SystemExit(main())
+elif __name__ == '__main__':
     import python_ta
     python_ta.check_all(config={'extra-imports': ['helpers',
                                                   'typing',
+                                                  'argparse',
+                                                  'sys',
+                                                  'time',
                                                   'csv',
+                                                  'hashlib',
+                                                  'json',
+                                                  'struct',
+                                                  'wave',
+                                                  'threading',
+                                                  'collections',
+                                                  'render_cache',
+                                                  'playback',
+                                                  'tracing',
+                                                  'itertools',
+                                                  'os',
+                                                  'tempfile',
+                                                  'concurrent.futures',
+                                                  'multiprocessing',
                                                   'numpy'],
                                 'disable':  ['E9997', 'E9998', 'W0611']})
@@ -0,0 +1,249 @@
+"""=== Module Description
+This file contains a playback engine that plays a sequence of bars without
+gaps between them. A background thread renders the next bars while the current
+one plays, and each bar is queued on a single mixer channel behind the one
+before it, so it starts as soon as that one ends.
+
+The same pipeline is available to asyncio code: render_ahead renders bars on
+an executor without blocking the event loop, and PlaybackEngine.play_async
+plays them, so many songs can be rendered or played from one event loop.
+"""
+from __future__ import annotations
+import contextvars
+import queue
+import threading
+import time
+import typing
+import numpy
+from helpers import audio_backend, queue_sound, _channel
+from tracing import span
+
+if typing.TYPE_CHECKING:
+    # asyncio is imported when it is first used, so that importing this
+    # module for blocking playback does not import it
+    import asyncio
+    import concurrent.futures
+
+# How long the engine sleeps while waiting for the mixer, in seconds
+_POLL = 0.002
+_DONE = object()
+
+
+class PlaybackEngine:
+    """ Plays int16 bars back to back on one mixer channel, rendering up to
+    lookahead bars ahead of the one that is playing on a worker thread.
+
+    === Attributes ===
+    lookahead: the most bars rendered before they are needed.
+    bars_played: number of bars handed to the mixer by the last play.
+    underruns: number of bars that were not rendered by the time the bar
+        before them finished playing, so there was a gap before them.
+
+    === Representation Invariants ===
+    lookahead >= 1
+    """
+    lookahead: int
+    bars_played: int
+    underruns: int
+
+    def __init__(self, lookahead: int = 2) -> None:
+        """ Initializes a PlaybackEngine that renders lookahead bars ahead """
+
+        if lookahead < 1:
+            raise ValueError('lookahead must be at least 1')
+        self.lookahead = lookahead
+        self.bars_played, self.underruns = 0, 0
+
+    def play(self, bars: typing.Iterable,
+             render: typing.Callable[[typing.Any], numpy.ndarray]) -> None:
+        """ Plays render(bar) for every bar in bars, in order, and returns once
+        the last one has finished playing.
+        NOTE: render is called on the worker thread, in a copy of the caller's
+        context, so context variables set by the caller still apply to it. If
+        render raises, playback stops and the error is raised here."""
+
+        self.bars_played, self.underruns = 0, 0
+        rendered = queue.Queue(self.lookahead)
+        stop = threading.Event()
+        worker = threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(_render_bars, bars, render, rendered, stop), daemon=True)
+        worker.start()
+
+        try:
+            with _channel() as channel:
+                try:
+                    self._play_rendered(channel, rendered)
+                    with span('wait_mixer'):
+                        while channel.get_busy():
+                            time.sleep(_POLL)
+                finally:
+                    channel.stop()
+        finally:
+            stop.set()
+            worker.join()
+
+    async def play_async(self, bars: typing.Iterable,
+                         render: typing.Callable[[typing.Any], numpy.ndarray],
+                         executor: typing.Optional[
+                             concurrent.futures.Executor] = None) -> None:
+        """ Plays render(bar) for every bar in bars, in order, like play, and
+        returns once the last one has finished playing, without blocking the
+        event loop.
+        NOTE: bars is iterated and render is called on executor (the event
+        loop's default executor by default), as render_ahead does. Cancelling
+        this coroutine stops playback and rendering."""
+
+        import asyncio
+
+        self.bars_played, self.underruns = 0, 0
+        loop = asyncio.get_running_loop()
+        # Opening the audio device may import pygame, which takes a while
+        await loop.run_in_executor(executor, audio_backend().open)
+        rendered = render_ahead(bars, render, self.lookahead, executor)
+
+        try:
+            with _channel() as channel:
+                try:
+                    async for item in rendered:
+                        while channel.get_queue() is not None:
+                            await asyncio.sleep(_POLL)
+                        if self.bars_played and not channel.get_busy():
+                            self.underruns += 1
+                        with span('queue', bar=self.bars_played):
+                            queue_sound(channel, item)
+                        self.bars_played += 1
+                    while channel.get_busy():
+                        await asyncio.sleep(_POLL)
+                finally:
+                    channel.stop()
+        finally:
+            await rendered.aclose()
+
+    def _play_rendered(self, channel: object, rendered: queue.Queue) -> None:
+        """ Queues each bar of rendered on channel as soon as the previous one
+        has started playing, until the worker is done. """
+
+        while True:
+            with span('wait_mixer'):
+                while channel.get_queue() is not None:
+                    time.sleep(_POLL)
+            with span('wait_render', bar=self.bars_played):
+                item = rendered.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            if self.bars_played and not channel.get_busy():
+                self.underruns += 1
+            with span('queue', bar=self.bars_played):
+                queue_sound(channel, item)
+            self.bars_played += 1
+
+
+async def render_ahead(bars: typing.Iterable,
+                       render: typing.Callable[[typing.Any], typing.Any],
+                       lookahead: int = 2,
+                       executor: typing.Optional[
+                           concurrent.futures.Executor] = None
+                       ) -> typing.AsyncIterator:
+    """ Yields render(bar) for every bar in bars, in order, rendering up to
+    lookahead bars ahead of the one being consumed.
+    NOTE: bars is iterated and render is called on executor (the event loop's
+    default executor by default), one bar at a time, in a copy of the
+    caller's context. A thread pool is needed, as bars and render are not
+    sent to other processes. Once lookahead bars are waiting to be consumed,
+    no more are rendered until one is. If render raises, the error is raised
+    here. Closing the generator or cancelling the task consuming it stops
+    the rendering, though a bar already being rendered is finished first."""
+
+    import asyncio
+
+    if lookahead < 1:
+        raise ValueError('lookahead must be at least 1')
+    loop = asyncio.get_running_loop()
+    rendered = asyncio.Queue(lookahead)
+    producer = asyncio.ensure_future(
+        _render_async(loop, iter(bars), render, rendered, executor))
+
+    try:
+        while True:
+            item = await rendered.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        producer.cancel()
+        await asyncio.wait([producer])
+
+
+async def _render_async(loop: asyncio.AbstractEventLoop,
+                        bars: typing.Iterator,
+                        render: typing.Callable[[typing.Any], typing.Any],
+                        rendered: asyncio.Queue,
+                        executor: typing.Optional[concurrent.futures.Executor]
+                        ) -> None:
+    """ Puts render(bar) for every bar in bars into rendered, followed by
+    _DONE, or by the error that stopped it. Each bar is taken and rendered on
+    executor. """
+
+    try:
+        i = 0
+        while True:
+            item = await loop.run_in_executor(
+                executor, contextvars.copy_context().run, _render_next, bars,
+                render, i)
+            if item is _DONE:
+                break
+            await rendered.put(item)
+            i += 1
+    except Exception as e:
+        item = e
+    await rendered.put(item)
+
+
+def _render_next(bars: typing.Iterator,
+                 render: typing.Callable[[typing.Any], typing.Any],
+                 index: int) -> object:
+    """ Returns render of the next bar of bars, which is bar index, or _DONE
+    if there are no more bars """
+
+    bar = next(bars, _DONE)
+    if bar is _DONE:
+        return _DONE
+    with span('render', bar=index):
+        return render(bar)
+
+
+def _render_bars(bars: typing.Iterable,
+                 render: typing.Callable[[typing.Any], numpy.ndarray],
+                 rendered: queue.Queue, stop: threading.Event) -> None:
+    """ Puts render(bar) for every bar in bars into rendered, followed by
+    _DONE, or by the error that stopped it. Gives up once stop is set. """
+
+    try:
+        for i, bar in enumerate(bars):
+            with span('render', bar=i):
+                item = render(bar)
+            if not _put(rendered, item, stop):
+                return
+        item = _DONE
+    except Exception as e:
+        item = e
+    _put(rendered, item, stop)
+
+
+def _put(rendered: queue.Queue, item: object, stop: threading.Event) -> bool:
+    """ Puts item into rendered once there is room for it, and returns whether
+    it was put there before stop was set. """
+
+    while not stop.is_set():
+        try:
+            rendered.put(item, timeout=0.05)
+            return True
+        except queue.Full:
+            pass
+
+    return False
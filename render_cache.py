@@ -0,0 +1,224 @@
+"""=== Module Description
+This file contains a render cache that keeps synthesized wave arrays on disk
+as .npy files, so they can be reused by later processes instead of being
+synthesized again. Cached arrays are opened memory-mapped and read-only.
+
+The cache can be inspected or pruned from the command line:
+    python -m render_cache DIR info
+    python -m render_cache DIR prune --max-bytes 512M
+    python -m render_cache DIR clear
+"""
+from __future__ import annotations
+import hashlib
+import os
+import tempfile
+import threading
+import typing
+import numpy
+
+# Bump this when the layout of cached arrays changes, so old files are missed
+_FORMAT_VERSION = 1
+_SUFFIX = '.npy'
+_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+# A cache that outgrows max_bytes is pruned down to this fraction of it, so
+# that it is not scanned again on every put that follows
+_LOW_WATER = 0.9
+
+
+class DiskCache:
+    """ A size-capped cache of numpy arrays stored as .npy files in one
+    directory, named by a content hash of their key.
+
+    === Attributes ===
+    directory: the directory the .npy files are stored in.
+    max_bytes: the most disk space the cached files may take up together.
+    hits: number of lookups that found a cached array.
+    misses: number of lookups that did not find a cached array.
+    evictions: number of files removed to stay within max_bytes.
+    _nbytes: the disk space the cached files take up, as last counted.
+    _lock: guards the counters when the cache is used from several threads.
+
+    === Representation Invariants ===
+    Files are only ever replaced atomically, so a reader never sees a
+    partially written array.
+    """
+    directory: str
+    max_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+    _nbytes: int
+    _lock: threading.Lock
+
+    def __init__(self, directory: str, max_bytes: int = 2 ** 30) -> None:
+        """ Initializes a DiskCache in directory, creating it if needed """
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self._nbytes = sum(size for _, size, _ in self.entries())
+        self._lock = threading.Lock()
+
+    def _path(self, key: tuple) -> str:
+        """ Returns the path key is cached under """
+
+        digest = hashlib.sha256(repr((_FORMAT_VERSION, key)).encode())
+
+        return os.path.join(self.directory, digest.hexdigest() + _SUFFIX)
+
+    def get(self, key: tuple) -> typing.Optional[numpy.ndarray]:
+        """ Returns the read-only, memory-mapped array cached under key, or
+        None if there is none. """
+
+        path = self._path(key)
+        try:
+            array = numpy.load(path, mmap_mode='r')
+            os.utime(path)
+        except (OSError, ValueError):
+            array = None
+
+        with self._lock:
+            if array is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return array
+
+    def put(self, key: tuple, array: numpy.ndarray) -> None:
+        """ Stores array under key, then evicts the least recently used files
+        down to _LOW_WATER of max_bytes if the cache has grown past it. """
+
+        path = self._path(key)
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                numpy.save(file, numpy.ascontiguousarray(array))
+            size = os.path.getsize(temp)
+            try:
+                size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(temp, path)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+        with self._lock:
+            self._nbytes += size
+            full = self._nbytes > self.max_bytes
+        if full:
+            self.prune(int(self.max_bytes * _LOW_WATER))
+
+    def entries(self) -> typing.List[typing.Tuple[str, int, float]]:
+        """ Returns the path, size and last use time of every cached file,
+        least recently used first. """
+
+        lst = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(_SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    lst.append((entry.path, stat.st_size, stat.st_mtime))
+        lst.sort(key=lambda x: x[2])
+
+        return lst
+
+    def nbytes(self) -> int:
+        """ Returns the disk space the cached files take up together """
+
+        return sum(size for _, size, _ in self.entries())
+
+    def prune(self, max_bytes: typing.Optional[int] = None) -> int:
+        """ Removes the least recently used files until the cache takes up at
+        most max_bytes (self.max_bytes by default), and returns the number of
+        files removed. """
+
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.entries()
+        total, removed = sum(size for _, size, _ in entries), 0
+
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+
+        with self._lock:
+            self._nbytes = total
+            self.evictions += removed
+
+        return removed
+
+    def clear(self) -> int:
+        """ Removes every cached file and returns the number removed """
+
+        return self.prune(0)
+
+
+def _parse_size(size: str) -> int:
+    """ Returns the number of bytes in size, such as '4096', '512K' or '2G'
+    """
+
+    size = size.strip().upper().rstrip('B')
+    unit = size[-1:] if size[-1:] in _UNITS else ''
+
+    return int(float(size[:len(size) - len(unit)]) * _UNITS[unit])
+
+
+def _format_size(size: int) -> str:
+    """ Returns size in bytes in a human readable form """
+
+    for unit in ['G', 'M', 'K']:
+        if size >= _UNITS[unit]:
+            return f'{size / _UNITS[unit]:.1f} {unit}iB'
+
+    return f'{size} B'
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> int:
+    """ Runs the render cache command line and returns its exit status """
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m render_cache',
+        description='Inspect or prune an on-disk render cache.')
+    parser.add_argument('directory', help='the cache directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('info', help='show the size of the cache')
+    prune = commands.add_parser(
+        'prune', help='remove the least recently used arrays')
+    prune.add_argument('--max-bytes', type=_parse_size, required=True,
+                       help='size to prune down to, such as 512M')
+    commands.add_parser('clear', help='remove every cached array')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.directory):
+        parser.error(f'{args.directory} is not a directory')
+    cache = DiskCache(args.directory)
+
+    if args.command == 'info':
+        entries = cache.entries()
+        print(f'{args.directory}: {len(entries)} arrays, '
+              f'{_format_size(sum(size for _, size, _ in entries))}')
+    else:
+        max_bytes = args.max_bytes if args.command == 'prune' else 0
+        removed = cache.prune(max_bytes)
+        print(f'{args.directory}: removed {removed} arrays, '
+              f'{_format_size(cache.nbytes())} left')
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
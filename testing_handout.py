@@ -154,10 +154,10 @@ def test_sawtooth_get_duration():
     st1 = noise.SawtoothWave(500, 100, 1)
     assert abs(st1.get_duration() - 100) < 0.0001
 
-# def test_sawtooth_simplify():
-#     st1 = noise.SawtoothWave(500, 100, 1)
-#     st1.simplify()
-#     assert st1.complexity() == 10
+def test_sawtooth_simplify():
+    st1 = noise.SawtoothWave(500, 100, 1)
+    st1.simplify()
+    assert st1.complexity() == 10
 
 
 def test_square_add():
@@ -184,10 +184,10 @@ def test_square_get_duration():
     st1 = noise.SquareWave(500, 100, 1)
     assert abs(st1.get_duration() - 100) < 0.0001
 
-# def test_square_simplify():
-#     sq1 = noise.SquareWave(500, 100, 1)
-#     sq1.simplify()
-#     assert sq1.complexity() == 10
+def test_square_simplify():
+    sq1 = noise.SquareWave(500, 100, 1)
+    sq1.simplify()
+    assert sq1.complexity() == 10
 
 def test_rest_add():
     r1 = noise.Rest(10)
@@ -213,10 +213,10 @@ def test_rest_get_duration():
     r1 = noise.Rest(20)
     assert abs(r1.get_duration() - 20) < 0.0001
 
-# def test_rest_simplify():
-#     r1 = noise.Rest(10)
-#     r1.simplify()
-#     assert r1.complexity() == 1
+def test_rest_simplify():
+    r1 = noise.Rest(10)
+    r1.simplify()
+    assert r1.complexity() == 1
 
 
 def test_stutter_note_add():
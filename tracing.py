@@ -0,0 +1,155 @@
+"""=== Module Description
+This file contains an opt-in tracing layer that records how long each stage
+of rendering or playing a song takes, as nested spans tagged with details such
+as the bar index and instrument.
+
+Tracing is off unless a Tracer is enabled with the tracing context manager.
+While it is off, span returns one shared no-op context manager, so the
+instrumented code pays for little more than a context variable lookup:
+
+    with tracing() as tracer:
+        play_song('swan_lake.csv', 0.2)
+    tracer.save_chrome_trace('trace.json')
+    print(tracer.summary())
+
+The saved file can be opened in chrome://tracing or https://ui.perfetto.dev.
+"""
+from __future__ import annotations
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import typing
+
+_TRACER: contextvars.ContextVar = contextvars.ContextVar('tracer',
+                                                         default=None)
+_DISABLED = contextlib.nullcontext()
+
+
+class Tracer:
+    """ Records the spans of one traced run.
+
+    === Attributes ===
+    events: one (name, args, thread id, start, end) tuple per finished span,
+        with start and end in perf_counter nanoseconds.
+    _origin: perf_counter nanoseconds when this Tracer was created.
+    """
+    events: typing.List[tuple]
+    _origin: int
+
+    def __init__(self) -> None:
+        """ Initializes a Tracer with no spans """
+
+        self.events = []
+        self._origin = time.perf_counter_ns()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args: object) -> typing.Iterator[None]:
+        """ Records the time spent in the with block as a span called name,
+        tagged with args """
+
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            # list.append is atomic, so spans can end on several threads
+            self.events.append((name, args, threading.get_ident(), start,
+                                time.perf_counter_ns()))
+
+    def chrome_trace(self) -> dict:
+        """ Returns the spans in the Chrome trace event format """
+
+        pid, threads = os.getpid(), {}
+        events = []
+        for name, args, thread, start, end in self.events:
+            tid = threads.setdefault(thread, len(threads))
+            events.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': (start - self._origin) / 1e3,
+                           'dur': (end - start) / 1e3,
+                           'args': {k: _jsonable(v) for k, v in args.items()}})
+        events.sort(key=lambda event: event['ts'])
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, path: str) -> None:
+        """ Writes the spans to path as Chrome trace event JSON """
+
+        with open(path, 'w') as file:
+            json.dump(self.chrome_trace(), file)
+
+    def totals(self) -> typing.Dict[str, typing.List[float]]:
+        """ Returns the number of spans, their total seconds and their self
+        seconds (not spent in spans nested in them) for each span name """
+
+        totals, by_thread = {}, {}
+        for event in self.events:
+            by_thread.setdefault(event[2], []).append(event)
+
+        for events in by_thread.values():
+            # Parents start no later and end no earlier than their children
+            events.sort(key=lambda e: (e[3], -e[4]))
+            stack = []
+            for name, _, _, start, end in events:
+                while stack and stack[-1][1] <= start:
+                    stack.pop()
+                seconds = (end - start) / 1e9
+                total = totals.setdefault(name, [0, 0.0, 0.0])
+                total[0] += 1
+                total[1] += seconds
+                total[2] += seconds
+                if stack:
+                    totals[stack[-1][0]][2] -= seconds
+                stack.append((name, end))
+
+        return totals
+
+    def summary(self) -> str:
+        """ Returns a table of the time spent in each kind of span, the most
+        self time first """
+
+        totals = self.totals()
+        lines = [f'{"span":<20}{"count":>8}{"total ms":>12}{"self ms":>12}'
+                 f'{"mean ms":>12}']
+        for name, (count, total, own) in sorted(
+                totals.items(), key=lambda item: -item[1][2]):
+            lines.append(f'{name:<20}{count:>8}{total * 1e3:>12.2f}'
+                         f'{own * 1e3:>12.2f}{total / count * 1e3:>12.3f}')
+
+        return '\n'.join(lines)
+
+
+def _jsonable(value: object) -> object:
+    """ Returns value if it can be written as JSON, or its repr otherwise """
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+
+    return repr(value)
+
+
+@contextlib.contextmanager
+def tracing(tracer: typing.Optional[Tracer] = None
+            ) -> typing.Iterator[Tracer]:
+    """ Records spans into tracer (a new Tracer by default) within the with
+    block, including on threads started with a copy of its context """
+
+    if tracer is None:
+        tracer = Tracer()
+    token = _TRACER.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _TRACER.reset(token)
+
+
+def span(name: str, **args: object) -> typing.ContextManager:
+    """ Returns a context manager that records its with block as a span
+    called name, tagged with args, if tracing is enabled """
+
+    tracer = _TRACER.get()
+    if tracer is None:
+        return _DISABLED
+
+    return tracer.span(name, **args)